@@ -1,10 +1,11 @@
 import json
+import os
 import traceback
 import webbrowser
 import streamlit as st
+import metrics
 import rag
 from pathlib import Path
-from ingest.stats import compute_stats
 
 # Config
 VIZ_DIR = Path("kb/visualizations")
@@ -33,7 +34,19 @@ with st.sidebar:
     st.header("Settings")
     st.markdown("---")
     k_retrieval = st.slider("Chunks to retrieve (k)", 1, 20, 5)
+    retrieval_mode = st.selectbox("Retrieval mode", rag.RETRIEVAL_MODES, help="hybrid = BM25 + dense with rank fusion")
+    rerank_results = st.checkbox(
+        "Rerank with cross-encoder",
+        value=False,
+        help=f"Score the top {rag.RERANK_CANDIDATES} candidates with {rag.RERANK_MODEL_NAME} and keep the best k",
+    )
     model_choice = st.selectbox("LLM Model", ["gpt-4o", "gpt-3.5-turbo"])
+    hedge = st.checkbox(
+        f"Hedge slow responses to {rag.LLM_HEDGE_MODEL}",
+        value=False,
+        disabled=model_choice == rag.LLM_HEDGE_MODEL,
+        help=f"Start a parallel request to {rag.LLM_HEDGE_MODEL} if no token arrives within {rag.LLM_HEDGE_AFTER_S:.0f}s",
+    )
 
     st.markdown("---")
     st.subheader("Embedding Visualizations")
@@ -61,23 +74,37 @@ with st.sidebar:
             webbrowser.open(f"file://{selected['html_path']}")
 
 
-# --- Load Resources (Cached) ---
+# --- Metrics endpoint (started once per process) ---
+@st.cache_resource
+def start_metrics_server():
+    port = os.environ.get("RAG_METRICS_PORT")
+    return metrics.start_http_server(int(port)) if port else None
+
+
+start_metrics_server()
+
+
+# --- Load Resources (once per process) ---
+# The embedding model stays loaded for the life of the process; the KB itself is
+# a snapshot that rag's watcher swaps when ingest publishes a new version.
 @st.cache_resource
-def load_resources():
-    return rag.load_resources()
+def init_resources():
+    rag.load_resources()
+    rag.start_kb_watcher()
 
 
 with st.spinner("Loading Knowledge Base..."):
     try:
-        index, chunks, embed_model = load_resources()
+        init_resources()
+        kb = rag.get_knowledge_base()
     except Exception:
         st.error("Failed to load knowledge base")
         st.code(traceback.format_exc())
         st.stop()
 
 # --- KB Stats ---
-kb_stats = compute_stats(chunks)
-with st.expander("Knowledge Base Stats"):
+kb_stats = kb.stats
+with st.expander(f"Knowledge Base Stats (version {kb.version or 'kb/'})"):
     st.markdown(
         f"| | |\n"
         f"|---|---|\n"
@@ -99,30 +126,48 @@ query = st.text_input("Ask a question about System Design:")
 
 if query:
     try:
-        # 1. Retrieve
-        retrieved_chunks = rag.retrieve(query, k=k_retrieval, resources=(index, chunks, embed_model))
-
-        # 2. Display Sources
-        with st.expander(f"View Retrieved Context ({len(retrieved_chunks)} chunks)"):
-            for i, chunk in enumerate(retrieved_chunks):
-                st.markdown(f"**{i+1}. {chunk['title']}** (Score: {chunk['score']:.4f})")
-                st.caption(f"Path: {chunk['doc_id']}")
-                st.text(chunk['text'])
-                st.divider()
-
-        # 3. Call LLM
-        st.markdown("### Answer")
-        response_placeholder = st.empty()
-        full_response = ""
-
-        response = rag.generate_answer(query, retrieved_chunks, model=model_choice, stream=True)
-
-        for chunk in response:
-            content = chunk.choices[0].delta.content or ""
-            full_response += content
-            response_placeholder.markdown(full_response + "▌")
-
-        response_placeholder.markdown(full_response)
+        with metrics.trace("chat", k=k_retrieval, mode=retrieval_mode, rerank=rerank_results, model=model_choice) as request_trace:
+            # 1. Retrieve
+            retrieved_chunks = rag.retrieve(
+                query, k=k_retrieval, resources=kb,
+                mode=retrieval_mode, rerank_results=rerank_results,
+            )
+
+            # 2. Display Sources
+            with st.expander(f"View Retrieved Context ({len(retrieved_chunks)} chunks)"):
+                for i, chunk in enumerate(retrieved_chunks):
+                    rerank_note = f", Rerank: {chunk['rerank_score']:.4f}" if "rerank_score" in chunk else ""
+                    st.markdown(f"**{i+1}. {chunk['title']}** (Score: {chunk['score']:.4f}{rerank_note})")
+                    st.caption(f"Path: {chunk['doc_id']}")
+                    also_in = [d for d in chunk.get("source_doc_ids") or [] if d != chunk["doc_id"]]
+                    if also_in:
+                        st.caption(f"Also in: {', '.join(also_in)}")
+                    st.text(chunk['text'])
+                    st.divider()
+
+            # 3. Call LLM
+            st.markdown("### Answer")
+            response_placeholder = st.empty()
+            full_response = ""
+
+            response = rag.stream_answer(
+                query, retrieved_chunks, model=model_choice,
+                hedge_model=rag.LLM_HEDGE_MODEL if hedge else None,
+            )
+
+            for content in response:
+                full_response += content
+                response_placeholder.markdown(full_response + "▌")
+
+            response_placeholder.markdown(full_response)
+
+        # 4. Latency breakdown for this request
+        with st.expander(f"Latency breakdown ({request_trace.total_s * 1000:.0f} ms total)"):
+            st.dataframe(
+                [{"Stage": stage, "ms": round(seconds * 1000, 1)} for stage, seconds in request_trace.breakdown().items()],
+                use_container_width=True,
+                hide_index=True,
+            )
     except Exception:
         st.error("Runtime error")
         st.code(traceback.format_exc())
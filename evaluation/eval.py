@@ -1,7 +1,7 @@
 import sys
-import math
 import json
 from pathlib import Path
+import numpy as np
 from pydantic import BaseModel, Field
 import openai
 from dotenv import load_dotenv
@@ -42,45 +42,72 @@ def load_tests(path="evaluation/tests.jsonl"):
             tests.append(TestQuestion(**json.loads(line)))
     return tests
 
-def calculate_mrr(keyword: str, retrieved_docs: list) -> float:
-    keyword_lower = keyword.lower()
-    for rank, doc in enumerate(retrieved_docs, start=1):
-        if keyword_lower in doc['text'].lower():
-            return 1.0 / rank
-    return 0.0
-
-def calculate_dcg(relevances: list[int], k: int) -> float:
-    dcg = 0.0
-    for i in range(min(k, len(relevances))):
-        dcg += relevances[i] / math.log2(i + 2)
-    return dcg
-
-def calculate_ndcg(keyword: str, retrieved_docs: list, k: int = 10) -> float:
-    keyword_lower = keyword.lower()
-    relevances = [1 if keyword_lower in doc['text'].lower() else 0 for doc in retrieved_docs[:k]]
-    dcg = calculate_dcg(relevances, k)
-    ideal_relevances = sorted(relevances, reverse=True)
-    idcg = calculate_dcg(ideal_relevances, k)
-    return dcg / idcg if idcg > 0 else 0.0
+def keyword_hit_matrix(keywords: list[str], texts: list[str]) -> np.ndarray:
+    """(keywords x texts) bool matrix: keyword occurs in the text, case-insensitively."""
+    lowered = [text.lower() for text in texts]
+    hits = np.zeros((len(keywords), len(texts)), dtype=bool)
+    for row, keyword in enumerate(keywords):
+        keyword = keyword.lower()
+        hits[row] = [keyword in text for text in lowered]
+    return hits
+
+def retrieval_metrics(hit_matrices: list[np.ndarray], k: int) -> dict[str, np.ndarray]:
+    """Per-test mrr, ndcg, keywords_found and total_keywords for many hit matrices at once.
+
+    Per keyword, MRR is 1 / rank of the first doc containing it (0 if none) and
+    nDCG@k uses binary relevance (doc contains the keyword) with log2(rank + 1)
+    discounts; both are averaged over each test's keywords. Matrices are padded
+    into one (tests x keywords x docs) array.
+    """
+    num_tests = len(hit_matrices)
+    max_keywords = max((m.shape[0] for m in hit_matrices), default=0)
+    max_docs = max((m.shape[1] for m in hit_matrices), default=0)
+    hits = np.zeros((num_tests, max_keywords, max_docs), dtype=bool)
+    total_keywords = np.zeros(num_tests, dtype=np.int64)
+    for i, matrix in enumerate(hit_matrices):
+        hits[i, :matrix.shape[0], :matrix.shape[1]] = matrix
+        total_keywords[i] = matrix.shape[0]
+
+    found = hits.any(axis=2)
+    first_hit = hits.argmax(axis=2) if max_docs else np.zeros(found.shape, dtype=np.int64)
+    reciprocal_rank = np.where(found, 1.0 / (first_hit + 1), 0.0)
+
+    top = hits[:, :, :k]
+    discounts = 1.0 / np.log2(np.arange(top.shape[2]) + 2)
+    dcg = top @ discounts
+    # Ideal ranking puts all relevant docs first: prefix sums of the discounts
+    idcg = np.concatenate([[0.0], np.cumsum(discounts)])[top.sum(axis=2)]
+    ndcg = np.divide(dcg, idcg, out=np.zeros_like(dcg), where=idcg > 0)
+
+    denominator = np.maximum(total_keywords, 1)
+    return {
+        "mrr": reciprocal_rank.sum(axis=1) / denominator,
+        "ndcg": ndcg.sum(axis=1) / denominator,
+        "keywords_found": found.sum(axis=1),
+        "total_keywords": total_keywords,
+    }
+
+def _build_retrieval_evals(tests: list[TestQuestion], retrieved_lists: list[list], k: int) -> list[RetrievalEval]:
+    hit_matrices = [
+        keyword_hit_matrix(test.keywords, [doc["text"] for doc in retrieved_docs])
+        for test, retrieved_docs in zip(tests, retrieved_lists)
+    ]
+    metrics = retrieval_metrics(hit_matrices, k)
+    results = []
+    for i in range(len(tests)):
+        keywords_found = int(metrics["keywords_found"][i])
+        total_keywords = int(metrics["total_keywords"][i])
+        results.append(RetrievalEval(
+            mrr=float(metrics["mrr"][i]),
+            ndcg=float(metrics["ndcg"][i]),
+            keywords_found=keywords_found,
+            total_keywords=total_keywords,
+            keyword_coverage=(keywords_found / total_keywords * 100) if total_keywords > 0 else 0.0,
+        ))
+    return results
 
 def _build_retrieval_eval(test: TestQuestion, retrieved_docs: list, k: int) -> RetrievalEval:
-    mrr_scores = [calculate_mrr(kw, retrieved_docs) for kw in test.keywords]
-    avg_mrr = sum(mrr_scores) / len(mrr_scores) if mrr_scores else 0.0
-    
-    ndcg_scores = [calculate_ndcg(kw, retrieved_docs, k) for kw in test.keywords]
-    avg_ndcg = sum(ndcg_scores) / len(ndcg_scores) if ndcg_scores else 0.0
-    
-    keywords_found = sum(1 for score in mrr_scores if score > 0)
-    total_keywords = len(test.keywords)
-    keyword_coverage = (keywords_found / total_keywords * 100) if total_keywords > 0 else 0.0
-    
-    return RetrievalEval(
-        mrr=avg_mrr,
-        ndcg=avg_ndcg,
-        keywords_found=keywords_found,
-        total_keywords=total_keywords,
-        keyword_coverage=keyword_coverage
-    )
+    return _build_retrieval_evals([test], [retrieved_docs], k)[0]
 
 def evaluate_retrieval(test: TestQuestion, k: int = 5) -> RetrievalEval:
     retrieved_docs = rag.retrieve(test.question, k=k)
@@ -91,12 +118,17 @@ def evaluate_retrieval_with_details(test: TestQuestion, k: int = 5) -> tuple[Ret
     result = _build_retrieval_eval(test, retrieved_docs, k)
     return result, retrieved_docs
 
-def evaluate_answer(test: TestQuestion) -> tuple[AnswerEval, str, list]:
-    retrieved_docs = rag.retrieve(test.question, k=5)
-    response = rag.generate_answer(test.question, retrieved_docs, model=MODEL, stream=False)
-    generated_answer = response.choices[0].message.content
+def evaluate_retrieval_batch(
+    tests: list[TestQuestion], k: int = 5, mode: str = "dense", rerank_results: bool = False
+) -> list[tuple[RetrievalEval, list]]:
+    retrieved_lists = rag.retrieve_batch(
+        [test.question for test in tests], k=k, mode=mode, rerank_results=rerank_results
+    )
+    results = _build_retrieval_evals(tests, retrieved_lists, k)
+    return list(zip(results, retrieved_lists))
 
-    judge_messages = [
+def judge_messages(test: TestQuestion, generated_answer: str) -> list[dict]:
+    return [
         {"role": "system", "content": "You are an expert evaluator assessing the quality of answers."},
         {"role": "user", "content": f"""
 Question: {test.question}
@@ -112,45 +144,70 @@ Provide scores and feedback.
 """}
     ]
 
+def evaluate_answer(test: TestQuestion) -> tuple[AnswerEval, str, list]:
+    retrieved_docs = rag.retrieve(test.question, k=5)
+    response = rag.generate_answer(test.question, retrieved_docs, model=MODEL, stream=False)
+    generated_answer = response.choices[0].message.content
+
     judge_response = openai.beta.chat.completions.parse(
         model=MODEL,
-        messages=judge_messages,
+        messages=judge_messages(test, generated_answer),
         response_format=AnswerEval
     )
     
     return judge_response.choices[0].message.parsed, generated_answer, retrieved_docs
 
-def evaluate_all_retrieval(limit=None, include_details=False):
+def evaluate_all_retrieval(limit=None, include_details=False, mode="dense", rerank_results=False):
     tests = load_tests()
     if limit:
         tests = tests[:limit]
     total = len(tests)
-    for i, test in enumerate(tests):
+    batch_results = evaluate_retrieval_batch(tests, mode=mode, rerank_results=rerank_results)
+    for i, (test, (result, retrieved_docs)) in enumerate(zip(tests, batch_results)):
         if include_details:
-            result, retrieved_docs = evaluate_retrieval_with_details(test)
             details = {
                 "retrieved_titles": [doc.get("title", "") for doc in retrieved_docs],
                 "retrieved_doc_ids": [doc.get("doc_id", "") for doc in retrieved_docs],
             }
             yield test, result, (i + 1) / total, details
         else:
-            result = evaluate_retrieval(test)
             yield test, result, (i + 1) / total
 
-def evaluate_all_answers(limit=None, include_details=False):
+def evaluate_all_answers(limit=None, include_details=False, concurrency=None):
+    """Yield answer evaluations as they finish (completion order), via the concurrent runner.
+
+    Tests already in the runner's checkpoint are yielded first without calling the API.
+    Tests that fail (after the runner's retries) raise a RuntimeError listing them
+    once every other test has been yielded.
+    """
+    from evaluation.runner import DEFAULT_CONCURRENCY, iter_answer_eval
+
     tests = load_tests()
     if limit:
         tests = tests[:limit]
-    total = len(tests)
-    for i, test in enumerate(tests):
-        result, generated_answer, retrieved_docs = evaluate_answer(test)
+    by_question = {test.question: test for test in tests}
+    failures = []
+    for event in iter_answer_eval(tests, concurrency=concurrency or DEFAULT_CONCURRENCY):
+        if event["type"] == "error":
+            failures.append(f"{event['question'][:60]}: {event['error']}")
+        if event["type"] not in ("resumed", "result"):
+            continue
+        row = event["row"]
+        test = by_question[row["question"]]
+        result = AnswerEval(
+            feedback=row["judge_feedback"], accuracy=row["accuracy"],
+            completeness=row["completeness"], relevance=row["relevance"],
+        )
+        progress = event["done"] / event["total"]
         if include_details:
             details = {
-                "generated_answer": generated_answer,
-                "judge_feedback": result.feedback,
-                "retrieved_titles": [doc.get("title", "") for doc in retrieved_docs],
-                "retrieved_doc_ids": [doc.get("doc_id", "") for doc in retrieved_docs],
+                "generated_answer": row["generated_answer"],
+                "judge_feedback": row["judge_feedback"],
+                "retrieved_titles": [doc["title"] for doc in row["retrieved_chunks"]],
+                "retrieved_doc_ids": [doc["doc_id"] for doc in row["retrieved_chunks"]],
             }
-            yield test, result, (i + 1) / total, details
+            yield test, result, progress, details
         else:
-            yield test, result, (i + 1) / total
+            yield test, result, progress
+    if failures:
+        raise RuntimeError(f"{len(failures)} of {len(tests)} answer evaluations failed:\n" + "\n".join(failures))
@@ -0,0 +1,374 @@
+"""
+Concurrent, resumable answer evaluation (retrieve -> generate -> judge).
+
+  - up to `concurrency` tests are in flight at once
+  - every LLM call first takes from a requests-per-minute and a tokens-per-minute
+    token bucket. The buckets follow the x-ratelimit-* headers the API returns and
+    pause on 429 retry-after, so a large run slows down instead of failing
+  - each finished test is appended to a JSONL checkpoint; a rerun with the same
+    model, k and KB skips the tests already in it
+  - progress is reported as events (iter_answer_eval) for the dashboard
+
+  python evaluation/runner.py --concurrency 16
+  OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=stub python evaluation/runner.py --limit 200
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import queue
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import openai
+
+# Add parent directory to path to import rag
+sys.path.append(str(Path(__file__).parent.parent))
+import rag
+from evaluation.eval import MODEL, AnswerEval, judge_messages, load_tests
+
+CHECKPOINT_FILE = Path("evaluation/answer_eval_checkpoint.jsonl")
+DEFAULT_CONCURRENCY = 8
+DEFAULT_REQUESTS_PER_MINUTE = 500
+DEFAULT_TOKENS_PER_MINUTE = 30000
+COMPLETION_TOKENS_ESTIMATE = 600  # reserved per call until the real usage is unknown
+JUDGE_MAX_RETRIES = rag.LLM_MAX_RETRIES
+RETRIEVAL_K = 5
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration(value):
+    """Seconds in an x-ratelimit-reset-* value such as '1s', '6m0s' or '20ms'."""
+    parts = _DURATION_RE.findall(value or "")
+    if not parts:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until `amount` can be taken (amounts above capacity wait for a full bucket)."""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+    def set_limit(self, per_minute):
+        if per_minute > 0 and per_minute != self.capacity:
+            self.capacity = float(per_minute)
+            self.rate = self.capacity / 60.0
+            self.level = min(self.level, self.capacity)
+
+
+class RateLimiter:
+    """Request and token buckets for one API key, corrected by the server's rate-limit headers."""
+
+    def __init__(self, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE):
+        self.buckets = {"requests": TokenBucket(requests_per_minute), "tokens": TokenBucket(tokens_per_minute)}
+        self.paused_until = 0.0
+        self.waited_s = 0.0
+        self.rate_limited = 0
+
+    async def acquire(self, tokens):
+        while True:
+            now = time.monotonic()
+            wait = max(
+                self.paused_until - now,
+                self.buckets["requests"].wait_time(1, now),
+                self.buckets["tokens"].wait_time(tokens, now),
+            )
+            if wait <= 0:
+                self.buckets["requests"].take(1)
+                self.buckets["tokens"].take(tokens)
+                return
+            self.waited_s += wait
+            await asyncio.sleep(wait)
+
+    def observe(self, response):
+        """rag LLM response observer: adopt the server's limits, remaining quota and retry-after."""
+        headers = response.headers
+        now = time.monotonic()
+        for kind, bucket in self.buckets.items():
+            try:
+                limit = int(headers.get(f"x-ratelimit-limit-{kind}", 0))
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                bucket.set_limit(limit)
+                if remaining is not None:
+                    bucket._refill(now)
+                    # Other clients may share the quota; never assume more than the server reports
+                    bucket.level = min(bucket.level, float(remaining))
+                    if float(remaining) <= 0:
+                        reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                        if reset:
+                            self.paused_until = max(self.paused_until, now + reset)
+            except ValueError:
+                continue
+        if response.status_code == 429:
+            self.rate_limited += 1
+            retry_after = parse_duration(headers.get("retry-after"))
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+
+    def snapshot(self):
+        """Current limits and counters; waited_s is summed over all waiting tests."""
+        return {
+            "requests_per_minute": self.buckets["requests"].capacity,
+            "tokens_per_minute": self.buckets["tokens"].capacity,
+            "rate_limited": self.rate_limited,
+            "waited_s": round(self.waited_s, 1),
+        }
+
+
+def estimate_tokens(messages):
+    chars = sum(len(str(m.get("content", ""))) for m in messages)
+    return chars // rag.CHARS_PER_TOKEN + COMPLETION_TOKENS_ESTIMATE
+
+
+def test_key(test):
+    return hashlib.sha256(json.dumps([test.question, test.reference_answer]).encode("utf-8")).hexdigest()[:16]
+
+
+def run_config(model, k):
+    """Checkpoint rows are only reused for the same model, k and KB build."""
+    kb = rag.get_knowledge_base()
+    return {"model": model, "k": k, "kb": kb.manifest.get("timestamp") or kb.version}
+
+
+def load_checkpoint(path, config):
+    rows = {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry.get("config") == config:
+                    rows[entry["key"]] = entry["row"]
+    except FileNotFoundError:
+        pass
+    return rows
+
+
+def chunk_summary(doc):
+    return {
+        "title": doc.get("title", ""),
+        "section_title": doc.get("section_title", ""),
+        "doc_id": doc.get("doc_id", ""),
+        "score": round(doc.get("score", 0), 4),
+        "text": doc.get("text", ""),
+    }
+
+
+def result_row(test, result, generated_answer, retrieved_docs):
+    return {
+        "question": test.question,
+        "category": test.category,
+        "keywords": test.keywords,
+        "accuracy": round(result.accuracy, 2),
+        "completeness": round(result.completeness, 2),
+        "relevance": round(result.relevance, 2),
+        "generated_answer": generated_answer,
+        "reference_answer": test.reference_answer,
+        "judge_feedback": result.feedback,
+        "retrieved_chunks": [chunk_summary(doc) for doc in retrieved_docs],
+    }
+
+
+def summarize(rows):
+    """The dashboard's answer_data dict (averages, per-category accuracy, per-test rows)."""
+    count = len(rows)
+    category_accuracy = defaultdict(list)
+    for row in rows:
+        category_accuracy[row["category"]].append(row["accuracy"])
+    return {
+        "metrics": {
+            "accuracy": sum(r["accuracy"] for r in rows) / count if count else 0.0,
+            "completeness": sum(r["completeness"] for r in rows) / count if count else 0.0,
+            "relevance": sum(r["relevance"] for r in rows) / count if count else 0.0,
+            "count": count,
+        },
+        "category_data": [
+            {"Category": category, "Average Accuracy": sum(scores) / len(scores)}
+            for category, scores in category_accuracy.items()
+        ],
+        "per_test": rows,
+    }
+
+
+async def judge(test, generated_answer, limiter, model):
+    messages = judge_messages(test, generated_answer)
+    client = rag.get_async_client()
+    for attempt in range(JUDGE_MAX_RETRIES + 1):
+        await limiter.acquire(estimate_tokens(messages))
+        try:
+            response = await client.chat.completions.parse(model=model, messages=messages, response_format=AnswerEval)
+            return response.choices[0].message.parsed
+        except rag.LLM_RETRYABLE_ERRORS as e:
+            if attempt == JUDGE_MAX_RETRIES:
+                raise
+            await asyncio.sleep(rag.backoff_delay(attempt, e))
+
+
+async def evaluate_one(test, retrieved_docs, limiter, model):
+    # agenerate_answer retries on its own; the limiter gates the first attempt
+    await limiter.acquire(estimate_tokens(rag.build_messages(test.question, retrieved_docs)))
+    parts = [part async for part in rag.agenerate_answer(test.question, retrieved_docs, model=model)]
+    generated_answer = "".join(parts)
+    result = await judge(test, generated_answer, limiter, model)
+    return result_row(test, result, generated_answer, retrieved_docs)
+
+
+async def run_answer_eval(tests, emit, model=MODEL, k=RETRIEVAL_K, concurrency=DEFAULT_CONCURRENCY,
+                          requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE,
+                          tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE,
+                          checkpoint_path=CHECKPOINT_FILE, resume=True, stop=None):
+    """Evaluate `tests`, calling emit(event) for every resumed, finished or failed test.
+
+    Events are dicts with "type" ("resumed", "result", "error" or "done"), "done",
+    "total", "rate_limit" and either "row" or "error". Authentication errors abort
+    the run; other failures are reported and left out of the checkpoint so a rerun
+    retries them.
+    """
+    checkpoint_path = Path(checkpoint_path)
+    config = run_config(model, k)
+    finished = load_checkpoint(checkpoint_path, config) if resume else {}
+    if not resume and checkpoint_path.exists():
+        checkpoint_path.unlink()
+    total = len(tests)
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    progress = {"done": 0, "failed": 0}
+
+    def event(kind, **payload):
+        emit({"type": kind, "done": progress["done"], "total": total, "rate_limit": limiter.snapshot(), **payload})
+
+    pending = []
+    for test in tests:
+        row = finished.get(test_key(test))
+        if row is None:
+            pending.append(test)
+        else:
+            progress["done"] += 1
+            event("resumed", row=row)
+
+    rag.add_llm_response_observer(limiter.observe)
+    semaphore = asyncio.Semaphore(concurrency)
+    checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        retrieved = await asyncio.to_thread(rag.retrieve_batch, [t.question for t in pending], k) if pending else []
+        with open(checkpoint_path, "a", encoding="utf-8") as checkpoint:
+
+            async def run(test, retrieved_docs):
+                async with semaphore:
+                    if stop is not None and stop.is_set():
+                        return
+                    try:
+                        row = await evaluate_one(test, retrieved_docs, limiter, model)
+                    except openai.AuthenticationError:
+                        raise
+                    except Exception as e:
+                        progress["failed"] += 1
+                        event("error", question=test.question, error=f"{type(e).__name__}: {e}")
+                        return
+                    checkpoint.write(json.dumps({"key": test_key(test), "config": config, "row": row}) + "\n")
+                    checkpoint.flush()
+                    progress["done"] += 1
+                    event("result", row=row)
+
+            tasks = [asyncio.create_task(run(t, docs)) for t, docs in zip(pending, retrieved)]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+    finally:
+        rag.remove_llm_response_observer(limiter.observe)
+    event("done", failed=progress["failed"])
+
+
+def iter_answer_eval(tests, **kwargs):
+    """Synchronous iterator over run_answer_eval events (for Streamlit), run on rag's background loop."""
+    events = queue.Queue()
+    stop = threading.Event()
+    finished = object()
+    future = asyncio.run_coroutine_threadsafe(
+        run_answer_eval(tests, events.put, stop=stop, **kwargs), rag.background_loop()
+    )
+    future.add_done_callback(lambda _: events.put(finished))
+    try:
+        while True:
+            item = events.get()
+            if item is finished:
+                future.result()  # re-raise a failed run
+                return
+            yield item
+    finally:
+        # Consumer went away (e.g. Streamlit rerun): let in-flight tests finish, start no new ones
+        stop.set()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Concurrent, resumable answer evaluation")
+    parser.add_argument("--limit", type=int, help="Only the first N tests")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--requests-per-minute", type=int, default=DEFAULT_REQUESTS_PER_MINUTE,
+                        help="Initial request budget (replaced by x-ratelimit-limit-requests)")
+    parser.add_argument("--tokens-per-minute", type=int, default=DEFAULT_TOKENS_PER_MINUTE,
+                        help="Initial token budget (replaced by x-ratelimit-limit-tokens)")
+    parser.add_argument("--model", default=MODEL)
+    parser.add_argument("--checkpoint", default=str(CHECKPOINT_FILE))
+    parser.add_argument("--fresh", action="store_true", help="Discard the checkpoint instead of resuming")
+    parser.add_argument("--output", help="Write the summary JSON here (e.g. evaluation/last_run_answer.json)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    tests = load_tests()
+    if args.limit:
+        tests = tests[:args.limit]
+    rag.load_openai_key()
+    rows, failures = [], []
+    started = time.perf_counter()
+    for event in iter_answer_eval(
+        tests, model=args.model, concurrency=args.concurrency,
+        requests_per_minute=args.requests_per_minute, tokens_per_minute=args.tokens_per_minute,
+        checkpoint_path=args.checkpoint, resume=not args.fresh,
+    ):
+        if event["type"] in ("resumed", "result"):
+            rows.append(event["row"])
+        elif event["type"] == "error":
+            failures.append(event)
+            print(f"FAILED {event['question'][:60]}: {event['error']}")
+        if event["type"] == "result":
+            print(f"[{event['done']}/{event['total']}] rate limit: {event['rate_limit']}")
+    elapsed = time.perf_counter() - started
+    summary = summarize(rows)
+    print(f"Evaluated {len(rows)} tests ({len(failures)} failed) in {elapsed:.1f}s: {json.dumps(summary['metrics'])}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+"""
+Local stand-in for the OpenAI chat-completions endpoint.
+
+Speaks the same wire protocol as POST /v1/chat/completions (JSON and SSE
+streaming), with configurable time to first token, per-token delay, injected
+429s and x-ratelimit-* headers. Point the app or evaluation at it with:
+
+  python evaluation/stub_openai.py --port 8765 --ttft gpt-4o=3.0 --rate-limit-every 5
+  OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=stub streamlit run Chat.py
+
+Or start it in-process with `serve(port=0, ...)`, which returns the running server.
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_ANSWER = "This is a stub answer from the local chat-completions server."
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Local chat-completions stub server")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8765)
+    p.add_argument("--ttft", action="append", default=[], metavar="MODEL=SECONDS",
+                   help="Time to first token per model (use '*' for all models)")
+    p.add_argument("--token-delay", type=float, default=0.01, help="Seconds between streamed tokens")
+    p.add_argument("--rate-limit-every", type=int, default=0, help="Answer every Nth request with HTTP 429")
+    p.add_argument("--retry-after", type=float, default=1.0, help="retry-after seconds sent with 429s")
+    p.add_argument("--requests-per-minute", type=int, default=500, help="Advertised x-ratelimit-limit-requests")
+    p.add_argument("--tokens-per-minute", type=int, default=30000, help="Advertised x-ratelimit-limit-tokens")
+    p.add_argument("--answer", default=DEFAULT_ANSWER)
+    return p.parse_args()
+
+
+def _sample_from_schema(schema, defs=None):
+    """Build a value that satisfies a (simple) JSON schema, for structured-output requests."""
+    defs = defs or schema.get("$defs", {})
+    if "$ref" in schema:
+        return _sample_from_schema(defs[schema["$ref"].split("/")[-1]], defs)
+    kind = schema.get("type")
+    if kind == "object":
+        return {name: _sample_from_schema(prop, defs) for name, prop in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [_sample_from_schema(schema.get("items", {}), defs)]
+    if kind in ("number", "integer"):
+        return 4
+    if kind == "boolean":
+        return True
+    return "stub"
+
+
+class StubState:
+    def __init__(self, ttft=None, token_delay=0.01, rate_limit_every=0, retry_after=1.0,
+                 requests_per_minute=500, tokens_per_minute=30000, answer=DEFAULT_ANSWER):
+        self.ttft = ttft or {}
+        self.token_delay = token_delay
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.answer = answer
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rate_limited = 0
+        self.window_start = time.time()
+        self.window_requests = 0
+        self.window_tokens = 0
+
+    def ttft_for(self, model):
+        return self.ttft.get(model, self.ttft.get("*", 0.0))
+
+    def admit(self, tokens):
+        """Count the request; return False when it should be rate limited."""
+        with self.lock:
+            self.requests += 1
+            now = time.time()
+            if now - self.window_start >= 60:
+                self.window_start, self.window_requests, self.window_tokens = now, 0, 0
+            self.window_requests += 1
+            self.window_tokens += tokens
+            if self.rate_limit_every and self.requests % self.rate_limit_every == 0:
+                self.rate_limited += 1
+                return False
+            return True
+
+    def ratelimit_headers(self):
+        with self.lock:
+            reset = max(0.0, 60 - (time.time() - self.window_start))
+            return {
+                "x-ratelimit-limit-requests": str(self.requests_per_minute),
+                "x-ratelimit-remaining-requests": str(max(0, self.requests_per_minute - self.window_requests)),
+                "x-ratelimit-reset-requests": f"{reset:.3f}s",
+                "x-ratelimit-limit-tokens": str(self.tokens_per_minute),
+                "x-ratelimit-remaining-tokens": str(max(0, self.tokens_per_minute - self.window_tokens)),
+                "x-ratelimit-reset-tokens": f"{reset:.3f}s",
+            }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: StubState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, extra_headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": []})
+        else:
+            self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        model = request.get("model", "stub")
+        prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in request.get("messages", []))
+
+        state = self.state
+        headers = state.ratelimit_headers()
+        if not state.admit(prompt_tokens):
+            headers["retry-after"] = str(state.retry_after)
+            self._send_json(429, {"error": {
+                "message": "Rate limit reached (stub)", "type": "requests", "code": "rate_limit_exceeded",
+            }}, headers)
+            return
+
+        response_format = request.get("response_format") or {}
+        if response_format.get("type") == "json_schema":
+            content = json.dumps(_sample_from_schema(response_format["json_schema"]["schema"]))
+        else:
+            content = state.answer
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        time.sleep(state.ttft_for(model))
+        if request.get("stream"):
+            self._stream(completion_id, created, model, content, headers)
+        else:
+            self._send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": len(content.split()),
+                    "total_tokens": prompt_tokens + len(content.split()),
+                },
+            }, headers)
+
+    def _stream(self, completion_id, created, model, content, headers):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.close_connection = True
+
+        def event(delta, finish_reason=None):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        try:
+            event({"role": "assistant", "content": ""})
+            for i, word in enumerate(content.split(" ")):
+                event({"content": word if i == 0 else f" {word}"})
+                time.sleep(self.state.token_delay)
+            event({}, finish_reason="stop")
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # Client cancelled the stream (e.g. a losing hedged request)
+            pass
+
+
+def serve(host="127.0.0.1", port=0, **state_kwargs):
+    """Start the stub in a daemon thread; returns the server (see server.server_address)."""
+    handler = type("BoundStubHandler", (StubHandler,), {"state": StubState(**state_kwargs)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_ttft(values):
+    ttft = {}
+    for value in values:
+        model, seconds = value.rsplit("=", 1)
+        ttft[model] = float(seconds)
+    return ttft
+
+
+def main():
+    args = parse_args()
+    server = serve(
+        host=args.host,
+        port=args.port,
+        ttft=parse_ttft(args.ttft),
+        token_delay=args.token_delay,
+        rate_limit_every=args.rate_limit_every,
+        retry_after=args.retry_after,
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        answer=args.answer,
+    )
+    host, port = server.server_address[:2]
+    print(f"Stub chat-completions server on http://{host}:{port}/v1 (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
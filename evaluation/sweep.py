@@ -0,0 +1,336 @@
+"""
+Retrieval parameter sweep: chunk size x overlap x contextual prefix x index type x k.
+
+  python evaluation/sweep.py --chunk-sizes 500 700 900 --overlaps 60 120 \\
+      --contextual on off --index-types flat hnsw ivf-flat --k 3 5 10
+
+Stages, each reusing whatever is unchanged:
+  1) chunks per (chunk size, overlap) from preprocess_kb's per-file cache
+     (kb/processed/.cache), written to a metadata store in kb/sweep/<variant>/
+  2) embeddings per (variant, contextual) in kb/sweep/<variant>-<ctx|plain>/,
+     reused as-is when the input hashes match, else taken from the previous build
+     and the embedding store (kb/cache/embeddings.sqlite), encoding only the rest
+  3) one process per (embedding set, index type) builds the index and, for every
+     k, records MRR / nDCG / keyword coverage (evaluation/eval.py metrics), index
+     build time and size, and p50/p99 dense retrieve latency
+
+Latency is index search plus chunk lookup per question, single-threaded FAISS,
+excluding query encoding (identical for every configuration). Parallel workers
+share the CPU, so use --workers 1 when the latency numbers matter most.
+
+Results and the quality/latency Pareto frontier go to evaluation/sweeps/.
+"""
+import argparse
+import datetime
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import faiss
+import numpy as np
+
+# Add parent directory to path to import rag, and ingest/ for the ingest scripts' sibling imports
+sys.path.append(str(Path(__file__).parent.parent))
+sys.path.append(str(Path(__file__).parent.parent / "ingest"))
+import ann_index
+import embed
+import preprocess_kb
+import rag
+from embed_store import EmbeddingStore
+from meta_store import MetaStore, write_meta_store
+from evaluation.eval import keyword_hit_matrix, load_tests, retrieval_metrics
+
+# Relative to the working directory (run from the repo root), like embed.py's paths and the embedding store
+RAW_DIR = Path("kb/raw")
+PREPROCESS_CACHE_DIR = Path("kb/processed/.cache")
+SWEEP_DIR = Path("kb/sweep")
+RESULTS_DIR = Path("evaluation/sweeps")
+QUALITY_METRICS = ["mrr", "ndcg", "coverage"]
+LATENCY_METRICS = ["p50_ms", "p99_ms"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Sweep chunking, contextual prefix, index type and k")
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[700], help="Chunk sizes in tokens")
+    parser.add_argument("--overlaps", type=int, nargs="+", default=[120], help="Chunk overlaps in tokens")
+    parser.add_argument("--contextual", choices=["on", "off"], nargs="+", default=["on"],
+                        help="Embed with the 'Title > Section:' prefix (on) and/or text only (off)")
+    parser.add_argument("--index-types", choices=ann_index.INDEX_TYPES, nargs="+", default=["flat"])
+    parser.add_argument("--k", type=int, nargs="+", default=[5], help="Retrieval depths to evaluate")
+    parser.add_argument("--raw-dir", default=str(RAW_DIR))
+    parser.add_argument("--encoding-name", default="cl100k_base", help="Tokenizer encoding for chunk sizing")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Parallel index build/eval processes")
+    parser.add_argument("--preprocess-workers", type=int, default=os.cpu_count() or 1, help="Worker processes for chunking")
+    parser.add_argument("--encode-token-budget", type=int, default=16384, help="Padded tokens per encode batch")
+    parser.add_argument("--latency-repeats", type=int, default=5, help="Timed passes over the test questions")
+    parser.add_argument("--limit", type=int, help="Only the first N tests")
+    parser.add_argument("--quality", choices=QUALITY_METRICS, default="ndcg", help="Quality axis of the frontier")
+    parser.add_argument("--latency", choices=LATENCY_METRICS, default="p99_ms", help="Latency axis of the frontier")
+    parser.add_argument("--output", help=f"Results JSON (default {RESULTS_DIR}/sweep_<timestamp>.json)")
+    ann_index.add_arguments(parser)
+    return parser.parse_args()
+
+
+def variant_name(chunk_size, chunk_overlap):
+    return f"cs{chunk_size}-ov{chunk_overlap}"
+
+
+def prepare_chunks(args, chunk_size, chunk_overlap, files):
+    """Chunk the raw KB with these parameters; unchanged files come from the preprocess cache."""
+    variant_dir = SWEEP_DIR / variant_name(chunk_size, chunk_overlap)
+    init_args = (str(args.raw_dir), str(PREPROCESS_CACHE_DIR), chunk_size, chunk_overlap, args.encoding_name)
+    started = time.perf_counter()
+    chunks, cache_hits = [], 0
+    for _, file_chunks, cache_hit in preprocess_kb.iter_processed(files, args.preprocess_workers, init_args):
+        chunks.extend(file_chunks)
+        cache_hits += cache_hit
+    write_meta_store(variant_dir / embed.META_FILE.name, chunks)
+    seconds = time.perf_counter() - started
+    print(f"[{variant_dir.name}] {len(chunks)} chunks ({cache_hits}/{len(files)} files cached) in {seconds:.1f}s")
+    info = {"seconds": round(seconds, 3), "files_cached": cache_hits, "num_chunks": len(chunks)}
+    return chunks, variant_dir / embed.META_FILE.name, info
+
+
+class ModelLoader:
+    """Loads the embedding model on first use, so fully cached sweeps never load it."""
+
+    def __init__(self):
+        self.model = None
+
+    def __call__(self):
+        if self.model is None:
+            self.model = embed.load_model()
+        return self.model
+
+
+def prepare_embeddings(args, set_dir, chunks, contextual, store, previous, get_model):
+    """Write embeddings.npy / embed_hashes.npy for one embedding set, encoding only unseen inputs."""
+    texts = [embed.embedding_input(c, contextual=contextual) for c in chunks]
+    hashes = [embed.input_hash(t) for t in texts]
+    embeddings_file = set_dir / "embeddings.npy"
+    hashes_file = set_dir / "embed_hashes.npy"
+    started = time.perf_counter()
+    if embeddings_file.exists() and hashes_file.exists() and np.load(hashes_file).tolist() == hashes:
+        print(f"[{set_dir.name}] embeddings unchanged")
+        return {"seconds": 0.0, "reused": len(hashes), "from_store": 0, "encoded": 0}
+
+    previous_rows, previous_vectors = previous
+    to_encode = {}
+    for row, h in enumerate(hashes):
+        if h not in previous_rows and h not in to_encode:
+            to_encode[h] = row
+    reused = sum(1 for h in hashes if h in previous_rows)
+    known = embed.lookup_store(store, to_encode)
+    encoded = {}
+    if to_encode:
+        rows = list(to_encode.values())
+        vectors, encode_stats = embed.encode_texts(
+            get_model(), [texts[r] for r in rows], [embed.estimate_tokens(chunks[r], contextual) for r in rows],
+            args.encode_token_budget,
+        )
+        encoded = dict(zip(to_encode, vectors))
+        embed.save_to_store(store, encoded)
+        print(f"[{set_dir.name}] encoding throughput: {embed.format_throughput(encode_stats)}")
+    encoded.update(known)
+
+    embeddings = np.stack([
+        encoded[h] if h in encoded else previous_vectors[previous_rows[h]] for h in hashes
+    ]).astype(np.float32, copy=False)
+    set_dir.mkdir(parents=True, exist_ok=True)
+    embed.save_array(embeddings_file, embeddings)
+    embed.save_array(hashes_file, np.asarray(hashes, dtype="S32"))
+    seconds = time.perf_counter() - started
+    print(
+        f"[{set_dir.name}] {reused} vectors from the previous build, {len(known)} from the store, "
+        f"{len(to_encode)} encoded in {seconds:.1f}s"
+    )
+    return {"seconds": round(seconds, 3), "reused": reused, "from_store": len(known), "encoded": len(to_encode)}
+
+
+def encode_questions(questions, get_model):
+    cached = all(rag.query_cache.get(rag.MODEL_NAME, q) is not None for q in questions)
+    return rag.encode_queries(questions, None if cached else get_model())
+
+
+def _init_worker():
+    # One FAISS thread per process: parallel jobs do not oversubscribe and latencies stay comparable
+    faiss.omp_set_num_threads(1)
+
+
+def evaluate_config(set_dir, meta_file, index_type, index_args, query_vectors, keywords, ks, latency_repeats):
+    """Worker: build one index over an embedding set and score it at every k."""
+    embeddings = np.load(Path(set_dir) / "embeddings.npy", mmap_mode="r")
+    chunks = MetaStore(meta_file)
+
+    started = time.perf_counter()
+    build_params, search_params = ann_index.resolve_params(index_type, len(embeddings), embeddings.shape[1], index_args)
+    train_ids, _ = ann_index.split_sample(len(embeddings), index_args.train_size, 0)
+    index = ann_index.build_index(embeddings, index_type, build_params, search_params, train_ids)
+    build_s = time.perf_counter() - started
+    index_bytes = int(faiss.serialize_index(index).nbytes)
+
+    results = []
+    for k in ks:
+        _, indices = index.search(query_vectors, k)
+        texts = [[chunks.value(int(i), "text") for i in row if i != -1] for row in indices]
+        hits = [keyword_hit_matrix(kws, row_texts) for kws, row_texts in zip(keywords, texts)]
+        scores = retrieval_metrics(hits, k)
+        total = np.maximum(scores["total_keywords"], 1)
+        coverage = np.where(scores["total_keywords"] > 0, scores["keywords_found"] / total * 100, 0.0)
+
+        # Same work as rag.retrieve's dense path after encoding: search, then materialize the rows
+        latencies = []
+        for _ in range(latency_repeats):
+            for vector in query_vectors:
+                t0 = time.perf_counter()
+                _, row = index.search(vector[None, :], k)
+                retrieved = [chunks[int(i)] for i in row[0] if i != -1]
+                latencies.append((time.perf_counter() - t0) * 1000)
+
+        results.append({
+            "k": k,
+            "mrr": round(float(scores["mrr"].mean()), 4),
+            "ndcg": round(float(scores["ndcg"].mean()), 4),
+            "coverage": round(float(coverage.mean()), 2),
+            "build_s": round(build_s, 3),
+            "index_bytes": index_bytes,
+            "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+            "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+            "build_params": build_params,
+            "search_params": search_params,
+        })
+    return results
+
+
+def pareto_frontier(rows, quality, latency):
+    """Rows not dominated by another row (quality at least as high and latency at least as low, one strictly)."""
+    frontier = []
+    for row in rows:
+        dominated = any(
+            other[quality] >= row[quality] and other[latency] <= row[latency]
+            and (other[quality] > row[quality] or other[latency] < row[latency])
+            for other in rows
+        )
+        if not dominated:
+            frontier.append(row)
+    return sorted(frontier, key=lambda r: r[latency])
+
+
+def config_label(row):
+    ctx = "ctx" if row["contextual"] else "plain"
+    return f"{variant_name(row['chunk_size'], row['chunk_overlap'])}-{ctx} {row['index_type']} k={row['k']}"
+
+
+def print_table(rows):
+    print(f"{'config':<40} {'mrr':>7} {'ndcg':>7} {'cov%':>7} {'build s':>8} {'index MB':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for row in rows:
+        print(
+            f"{config_label(row):<40} {row['mrr']:>7.4f} {row['ndcg']:>7.4f} {row['coverage']:>7.1f} "
+            f"{row['build_s']:>8.2f} {row['index_bytes'] / 1024 ** 2:>9.2f} {row['p50_ms']:>8.3f} {row['p99_ms']:>8.3f}"
+        )
+
+
+def main():
+    args = parse_args()
+    tests = load_tests()
+    if args.limit:
+        tests = tests[:args.limit]
+    variants = [(cs, ov) for cs, ov in itertools.product(args.chunk_sizes, args.overlaps) if ov < cs]
+    skipped = len(args.chunk_sizes) * len(args.overlaps) - len(variants)
+    if skipped:
+        print(f"Skipping {skipped} chunk size/overlap pairs with overlap >= chunk size")
+    if not variants:
+        print("Error: no valid chunk size/overlap pairs")
+        return
+    contextual_modes = [mode == "on" for mode in dict.fromkeys(args.contextual)]
+    ks = sorted(set(args.k))
+    files = preprocess_kb.iter_markdown_files(Path(args.raw_dir))
+    SWEEP_DIR.mkdir(parents=True, exist_ok=True)
+
+    # Stages 1-2 run here: chunking has its own process pool and the model is loaded at most once
+    get_model = ModelLoader()
+    store = EmbeddingStore(embed.EMBED_STORE_FILE)
+    previous = embed.load_previous_vectors()
+    embedding_sets = []
+    try:
+        for chunk_size, chunk_overlap in variants:
+            chunks, meta_file, prep_info = prepare_chunks(args, chunk_size, chunk_overlap, files)
+            for contextual in contextual_modes:
+                set_dir = SWEEP_DIR / f"{variant_name(chunk_size, chunk_overlap)}-{'ctx' if contextual else 'plain'}"
+                embed_info = prepare_embeddings(args, set_dir, chunks, contextual, store, previous, get_model)
+                embedding_sets.append(({
+                    "chunk_size": chunk_size,
+                    "chunk_overlap": chunk_overlap,
+                    "contextual": contextual,
+                    "num_chunks": len(chunks),
+                    "preprocess": prep_info,
+                    "embed": embed_info,
+                }, set_dir, meta_file))
+        query_vectors = encode_questions([t.question for t in tests], get_model)
+    finally:
+        store.close()
+    del previous
+
+    keywords = [t.keywords for t in tests]
+    jobs = [
+        (info, set_dir, meta_file, index_type)
+        for info, set_dir, meta_file in embedding_sets for index_type in args.index_types
+    ]
+    print(f"Evaluating {len(jobs)} index builds x {len(ks)} k values on {len(tests)} tests with {args.workers} workers...")
+    rows, failures = [], []
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker) as pool:
+        futures = {
+            pool.submit(
+                evaluate_config, str(set_dir), str(meta_file), index_type, args,
+                query_vectors, keywords, ks, args.latency_repeats,
+            ): (info, set_dir, index_type)
+            for info, set_dir, meta_file, index_type in jobs
+        }
+        for future in as_completed(futures):
+            info, set_dir, index_type = futures[future]
+            try:
+                results = future.result()
+            except Exception as e:
+                failures.append({"embedding_set": set_dir.name, "index_type": index_type, "error": str(e)})
+                print(f"[{set_dir.name} {index_type}] failed: {e}")
+                continue
+            for result in results:
+                rows.append({**info, "index_type": index_type, **result})
+            print(f"[{set_dir.name} {index_type}] done ({results[0]['build_s']:.2f}s build)")
+
+    rows.sort(key=lambda r: (r["chunk_size"], r["chunk_overlap"], not r["contextual"], r["index_type"], r["k"]))
+    frontier = pareto_frontier(rows, args.quality, args.latency)
+
+    print_table(rows)
+    print(f"\nPareto frontier ({args.quality} vs {args.latency}):")
+    print_table(frontier)
+
+    timestamp = datetime.datetime.now()
+    output = Path(args.output) if args.output else RESULTS_DIR / f"sweep_{timestamp:%Y%m%d-%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({
+            "timestamp": timestamp.isoformat(),
+            "model": embed.MODEL_NAME,
+            "num_tests": len(tests),
+            "grid": {
+                "chunk_sizes": args.chunk_sizes,
+                "overlaps": args.overlaps,
+                "contextual": args.contextual,
+                "index_types": args.index_types,
+                "k": ks,
+            },
+            "objectives": {"quality": args.quality, "latency": args.latency},
+            "results": rows,
+            "frontier": [config_label(row) for row in frontier],
+            "failures": failures,
+        }, f, indent=2)
+    print(f"\nSaved sweep results to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+FAISS index factory for embed.py plus a recall/latency report against exact search.
+
+All index types use inner product on L2-normalized vectors (cosine similarity):
+  - flat      exact brute force (IndexFlatIP)
+  - ivf-flat  inverted lists over a k-means coarse quantizer, full vectors
+  - ivf-pq    inverted lists with product-quantized codes
+  - hnsw      graph-based search (IndexHNSWFlat)
+"""
+import math
+import time
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ["flat", "ivf-flat", "ivf-pq", "hnsw"]
+TRAINED_INDEX_TYPES = {"ivf-flat", "ivf-pq"}
+
+# FAISS wants roughly this many training points per centroid
+MIN_POINTS_PER_CENTROID = 39
+
+# Rows copied out of (possibly memory-mapped) embeddings per index.add / exact-search step
+ADD_BATCH_SIZE = 65_536
+
+
+def default_nlist(num_vectors: int) -> int:
+    nlist = int(4 * math.sqrt(num_vectors))
+    return max(1, min(nlist, num_vectors // MIN_POINTS_PER_CENTROID))
+
+
+def resolve_params(index_type: str, num_vectors: int, dimension: int, args) -> tuple[dict, dict]:
+    """Fill in defaults for build-time and search-time parameters."""
+    if index_type == "flat":
+        return {}, {}
+
+    if index_type == "hnsw":
+        build_params = {"M": args.hnsw_m, "efConstruction": args.ef_construction}
+        search_params = {"efSearch": args.ef_search}
+        return build_params, search_params
+
+    nlist = args.nlist or default_nlist(num_vectors)
+    nprobe = min(args.nprobe or max(1, nlist // 16), nlist)
+    build_params = {"nlist": nlist}
+    if index_type == "ivf-pq":
+        if dimension % args.pq_m != 0:
+            raise ValueError(f"--pq-m {args.pq_m} must divide the embedding dimension {dimension}")
+        build_params.update({"M": args.pq_m, "nbits": args.pq_nbits})
+    return build_params, {"nprobe": nprobe}
+
+
+def create_index(index_type: str, dimension: int, build_params: dict):
+    if index_type == "flat":
+        return faiss.IndexFlatIP(dimension)
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, build_params["M"], faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = build_params["efConstruction"]
+        return index
+    quantizer = faiss.IndexFlatIP(dimension)
+    if index_type == "ivf-flat":
+        return faiss.IndexIVFFlat(quantizer, dimension, build_params["nlist"], faiss.METRIC_INNER_PRODUCT)
+    if index_type == "ivf-pq":
+        return faiss.IndexIVFPQ(
+            quantizer, dimension, build_params["nlist"], build_params["M"], build_params["nbits"],
+            faiss.METRIC_INNER_PRODUCT,
+        )
+    raise ValueError(f"Unknown index type: {index_type}")
+
+
+def min_training_points(index_type: str, build_params: dict) -> int:
+    if index_type == "ivf-flat":
+        return build_params["nlist"]
+    if index_type == "ivf-pq":
+        return max(build_params["nlist"], 2 ** build_params["nbits"])
+    return 0
+
+
+def apply_search_params(index, search_params: dict):
+    """Set search-time knobs (nprobe, efSearch) recorded in the embed manifest."""
+    params = faiss.ParameterSpace()
+    for name, value in search_params.items():
+        params.set_index_parameter(index, name, value)
+
+
+def split_sample(num_vectors: int, train_size: int, eval_queries: int, seed: int = 42):
+    """Pick disjoint row ids for training and for held-out recall queries."""
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(num_vectors)
+    eval_queries = min(eval_queries, num_vectors)
+    query_ids = np.sort(order[:eval_queries])
+    # Never train on the held-out queries, or the recall report is not held-out
+    train_size = min(train_size, num_vectors - eval_queries)
+    train_ids = np.sort(order[eval_queries:eval_queries + train_size])
+    return train_ids, query_ids
+
+
+def prefix_train_ids(num_vectors: int, train_size: int, query_ids) -> np.ndarray:
+    """The first `train_size` rows that are not held-out queries (for indexes filled while rows arrive)."""
+    available = np.ones(num_vectors, dtype=bool)
+    available[query_ids] = False
+    return np.flatnonzero(available)[:train_size]
+
+
+class IncrementalIndex:
+    """An index filled batch by batch from a growing (possibly memory-mapped) embedding array.
+
+    Untrained types (flat, hnsw) add each batch as it arrives. IVF types wait until
+    every row in `train_ids` has been written, train on those, then add everything
+    written so far and keep adding batch by batch.
+    """
+
+    def __init__(self, index_type: str, dimension: int, build_params: dict, search_params: dict, train_ids):
+        self.index = create_index(index_type, dimension, build_params)
+        self.search_params = search_params
+        self.train_ids = np.asarray(train_ids)
+        self.added = 0
+        if not self.index.is_trained:
+            needed = min_training_points(index_type, build_params)
+            if len(self.train_ids) < needed:
+                raise ValueError(
+                    f"{index_type} needs at least {needed} training vectors, got {len(self.train_ids)}. "
+                    f"Lower --nlist/--pq-nbits, hold out fewer --eval-queries or use --index-type flat."
+                )
+
+    def extend(self, embeddings: np.ndarray, end: int):
+        """Add rows [added, end) of `embeddings`, training first once the training rows exist."""
+        if not self.index.is_trained:
+            if end <= self.train_ids[-1]:
+                return
+            self.index.train(np.ascontiguousarray(embeddings[self.train_ids]))
+        for start in range(self.added, end, ADD_BATCH_SIZE):
+            self.index.add(np.ascontiguousarray(embeddings[start:min(start + ADD_BATCH_SIZE, end)]))
+        self.added = max(self.added, end)
+
+    def finish(self):
+        apply_search_params(self.index, self.search_params)
+        return self.index
+
+
+def build_index(embeddings: np.ndarray, index_type: str, build_params: dict, search_params: dict, train_ids):
+    """Create, train (if needed) and fill an index from normalized float32 embeddings.
+
+    `embeddings` may be a read-only memmap; rows are added ADD_BATCH_SIZE at a time.
+    """
+    builder = IncrementalIndex(index_type, embeddings.shape[1], build_params, search_params, train_ids)
+    builder.extend(embeddings, len(embeddings))
+    return builder.finish()
+
+
+def _search_latencies_ms(index, queries: np.ndarray, k: int) -> np.ndarray:
+    latencies = np.empty(len(queries), dtype=np.float64)
+    for i in range(len(queries)):
+        start = time.perf_counter()
+        index.search(queries[i:i + 1], k)
+        latencies[i] = (time.perf_counter() - start) * 1000
+    return latencies
+
+
+def exact_search_blocked(embeddings: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    """Exact top-k ids by scanning `embeddings` in blocks (no full in-memory copy)."""
+    heap = faiss.ResultHeap(len(queries), k, keep_max=True)
+    for start in range(0, len(embeddings), ADD_BATCH_SIZE):
+        block = np.ascontiguousarray(embeddings[start:start + ADD_BATCH_SIZE])
+        scores, ids = faiss.knn(queries, block, min(k, len(block)), metric=faiss.METRIC_INNER_PRODUCT)
+        heap.add_result(scores, np.where(ids >= 0, ids + start, -1))
+    heap.finalize()
+    return heap.I
+
+
+def evaluate_index(index, embeddings: np.ndarray, query_ids, k: int = 10, flat_baseline: bool = True) -> dict:
+    """Recall@k of `index` against exact flat search, plus single-query p50/p99 latency.
+
+    With flat_baseline=False the ground truth is computed block by block and no
+    second flat index is built, so memory stays bounded; flat latencies are then None.
+    """
+    queries = np.ascontiguousarray(embeddings[query_ids])
+    k = min(k, index.ntotal)
+
+    exact = None
+    if flat_baseline:
+        exact = faiss.IndexFlatIP(embeddings.shape[1])
+        exact.add(np.ascontiguousarray(embeddings))
+        _, truth = exact.search(queries, k)
+    else:
+        truth = exact_search_blocked(embeddings, queries, k)
+    _, found = index.search(queries, k)
+
+    hits = sum(len(set(t) & set(f)) for t, f in zip(truth, found))
+    recall = hits / (len(queries) * k) if len(queries) else 1.0
+
+    latencies = _search_latencies_ms(index, queries, k)
+    exact_latencies = _search_latencies_ms(exact, queries, k) if exact is not None else None
+    return {
+        "k": k,
+        "num_queries": len(queries),
+        "recall": round(recall, 4),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+        "flat_p50_ms": round(float(np.percentile(exact_latencies, 50)), 3) if exact_latencies is not None else None,
+        "flat_p99_ms": round(float(np.percentile(exact_latencies, 99)), 3) if exact_latencies is not None else None,
+    }
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group("index")
+    group.add_argument("--index-type", choices=INDEX_TYPES, default="flat", help="FAISS index type")
+    group.add_argument("--nlist", type=int, default=None, help="IVF: number of inverted lists (default 4*sqrt(n))")
+    group.add_argument("--nprobe", type=int, default=None, help="IVF: lists probed per query (default nlist/16)")
+    group.add_argument("--pq-m", type=int, default=64, help="IVF-PQ: number of sub-quantizers")
+    group.add_argument("--pq-nbits", type=int, default=8, help="IVF-PQ: bits per sub-quantizer code")
+    group.add_argument("--hnsw-m", type=int, default=32, help="HNSW: graph neighbours per node")
+    group.add_argument("--ef-construction", type=int, default=200, help="HNSW: build-time beam width")
+    group.add_argument("--ef-search", type=int, default=64, help="HNSW: search-time beam width")
+    group.add_argument("--train-size", type=int, default=100_000, help="Max vectors sampled to train IVF indexes")
+    group.add_argument("--eval-queries", type=int, default=200, help="Held-out queries for the recall report")
+    group.add_argument("--eval-k", type=int, default=10, help="k for the recall@k report")
+    return parser
@@ -0,0 +1,196 @@
+"""
+Sparse BM25 index over chunk texts (kb/index.bm25.npz).
+
+Postings are stored CSR-style: for term t, rows doc_ids[term_offsets[t]:term_offsets[t + 1]]
+hold the chunk ids (same ids as the FAISS index) and tfs hold the term frequencies.
+Scoring gathers the posting slices of the query terms and sums per-document
+contributions with NumPy, so a query costs O(postings touched), not O(corpus).
+"""
+import re
+from array import array
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by do does for from how i if in into is it its of on or "
+    "should so than that the their then there these this to was what when where which "
+    "while who why will with you your".split()
+)
+DEFAULT_K1 = 1.2
+DEFAULT_B = 0.75
+MAX_POSTINGS_IN_MEMORY = 2_000_000  # BM25Builder spills to disk past this when given a spill_dir
+
+
+def tokenize(text: str) -> list[str]:
+    return [t for t in TOKEN_RE.findall(text.lower()) if t not in STOPWORDS]
+
+
+class BM25Builder:
+    """Accumulates documents in id order and produces a BM25Index.
+
+    With `spill_dir`, postings are flushed to CSR segment files there whenever
+    more than `max_postings` are held, and build() merges the segments into
+    memory-mapped arrays, so memory does not grow with the corpus.
+    """
+
+    def __init__(self, spill_dir=None, max_postings=MAX_POSTINGS_IN_MEMORY):
+        self.postings = {}
+        self.num_postings = 0
+        self.doc_lengths = array("I")
+        self.spill_dir = Path(spill_dir) if spill_dir is not None else None
+        self.max_postings = max_postings
+        self.segments = []
+
+    def add(self, text: str):
+        doc_id = len(self.doc_lengths)
+        tokens = tokenize(text)
+        self.doc_lengths.append(len(tokens))
+        counts = Counter(tokens)
+        for term, tf in counts.items():
+            self.postings.setdefault(term, []).append((doc_id, tf))
+        self.num_postings += len(counts)
+        if self.spill_dir is not None and self.num_postings >= self.max_postings:
+            self._spill()
+
+    def _csr(self):
+        terms = sorted(self.postings)
+        term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        term_offsets[1:] = np.cumsum([len(self.postings[t]) for t in terms])
+        doc_ids = np.empty(term_offsets[-1], dtype=np.uint32)
+        tfs = np.empty(term_offsets[-1], dtype=np.uint16)
+        for i, term in enumerate(terms):
+            start, end = term_offsets[i], term_offsets[i + 1]
+            postings = np.asarray(self.postings[term], dtype=np.int64)
+            doc_ids[start:end] = postings[:, 0]
+            tfs[start:end] = np.minimum(postings[:, 1], np.iinfo(np.uint16).max)
+        return terms, term_offsets, doc_ids, tfs
+
+    def _spill(self):
+        terms, term_offsets, doc_ids, tfs = self._csr()
+        prefix = self.spill_dir / f"bm25-segment-{len(self.segments):05d}"
+        for name, values in (("term_offsets", term_offsets), ("doc_ids", doc_ids), ("tfs", tfs)):
+            np.save(f"{prefix}.{name}.npy", values)
+        self.segments.append((terms, prefix))
+        self.postings = {}
+        self.num_postings = 0
+
+    def _merge_segments(self):
+        """Concatenate the spilled segments term by term (doc ids stay ascending: segments are in id order)."""
+        terms = sorted(set().union(*(segment_terms for segment_terms, _ in self.segments)))
+        vocab = {term: i for i, term in enumerate(terms)}
+        loaded = []
+        counts = np.zeros(len(terms), dtype=np.int64)
+        for segment_terms, prefix in self.segments:
+            global_ids = np.fromiter((vocab[t] for t in segment_terms), dtype=np.int64, count=len(segment_terms))
+            offsets = np.load(f"{prefix}.term_offsets.npy")
+            lengths = np.diff(offsets)
+            counts[global_ids] += lengths
+            loaded.append((prefix, global_ids, offsets, lengths))
+
+        term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        term_offsets[1:] = np.cumsum(counts)
+        doc_ids = np.lib.format.open_memmap(
+            self.spill_dir / "bm25-doc_ids.npy", mode="w+", dtype=np.uint32, shape=(int(term_offsets[-1]),)
+        )
+        tfs = np.lib.format.open_memmap(
+            self.spill_dir / "bm25-tfs.npy", mode="w+", dtype=np.uint16, shape=(int(term_offsets[-1]),)
+        )
+        cursor = term_offsets[:-1].copy()
+        for prefix, global_ids, offsets, lengths in loaded:
+            # Destination of every posting: its term's write cursor plus its position within the term
+            within = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+            destination = np.repeat(cursor[global_ids], lengths) + within
+            doc_ids[destination] = np.load(f"{prefix}.doc_ids.npy", mmap_mode="r")
+            tfs[destination] = np.load(f"{prefix}.tfs.npy", mmap_mode="r")
+            cursor[global_ids] += lengths
+        return terms, term_offsets, doc_ids, tfs
+
+    def build(self, k1=DEFAULT_K1, b=DEFAULT_B) -> "BM25Index":
+        if self.segments:
+            if self.postings:
+                self._spill()
+            terms, term_offsets, doc_ids, tfs = self._merge_segments()
+        else:
+            terms, term_offsets, doc_ids, tfs = self._csr()
+        doc_lengths = np.frombuffer(self.doc_lengths, dtype=np.uint32) if self.doc_lengths else np.empty(0, dtype=np.uint32)
+        return BM25Index(terms, term_offsets, doc_ids, tfs, doc_lengths, k1, b)
+
+
+def build_bm25(texts, k1=DEFAULT_K1, b=DEFAULT_B) -> "BM25Index":
+    builder = BM25Builder()
+    for text in texts:
+        builder.add(text)
+    return builder.build(k1=k1, b=b)
+
+
+class BM25Index:
+    def __init__(self, terms, term_offsets, doc_ids, tfs, doc_lengths, k1=DEFAULT_K1, b=DEFAULT_B):
+        self.terms = list(terms)
+        self.vocab = {term: i for i, term in enumerate(self.terms)}
+        self.term_offsets = term_offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_lengths = doc_lengths
+        self.k1 = float(k1)
+        self.b = float(b)
+
+        num_docs = len(doc_lengths)
+        doc_freqs = np.diff(term_offsets).astype(np.float32)
+        self.idf = np.log1p((num_docs - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype(np.float32)
+        avgdl = float(doc_lengths.mean()) if num_docs else 0.0
+        self.length_norm = (
+            self.k1 * (1 - self.b + self.b * doc_lengths / avgdl) if avgdl else np.full(num_docs, self.k1)
+        ).astype(np.float32)
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def search(self, query: str, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Return (scores, ids) of the top-k chunks, best first."""
+        term_ids = sorted({self.vocab[t] for t in tokenize(query) if t in self.vocab})
+        if not term_ids:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+
+        starts = self.term_offsets[term_ids]
+        ends = self.term_offsets[np.asarray(term_ids) + 1]
+        docs = np.concatenate([self.doc_ids[s:e] for s, e in zip(starts, ends)])
+        tf = np.concatenate([self.tfs[s:e] for s, e in zip(starts, ends)]).astype(np.float32)
+        idf = np.repeat(self.idf[term_ids], ends - starts)
+
+        contributions = idf * tf * (self.k1 + 1) / (tf + self.length_norm[docs])
+        unique_docs, inverse = np.unique(docs, return_inverse=True)
+        scores = np.bincount(inverse, weights=contributions).astype(np.float32)
+
+        if len(scores) > k:
+            top = np.argpartition(-scores, k)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return scores[top], unique_docs[top].astype(np.int64)
+
+    def save(self, path):
+        encoded = [t.encode("utf-8") for t in self.terms]
+        term_text_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        term_text_offsets[1:] = np.cumsum([len(t) for t in encoded])
+        np.savez(
+            path,
+            term_text=np.frombuffer(b"".join(encoded), dtype=np.uint8),
+            term_text_offsets=term_text_offsets,
+            term_offsets=self.term_offsets,
+            doc_ids=self.doc_ids,
+            tfs=self.tfs,
+            doc_lengths=self.doc_lengths,
+            params=np.asarray([self.k1, self.b], dtype=np.float64),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(Path(path)) as data:
+            text = data["term_text"].tobytes()
+            offsets = data["term_text_offsets"]
+            terms = [text[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+            k1, b = data["params"]
+            return cls(terms, data["term_offsets"], data["doc_ids"], data["tfs"], data["doc_lengths"], k1, b)
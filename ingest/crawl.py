@@ -0,0 +1,273 @@
+"""
+Bulk crawl of KB articles into kb/raw/<url-path>.md (same layout as scrape_article.py).
+
+URLs come from a list file, --url flags and/or sitemaps. Pages are fetched
+concurrently over one pooled HTTP client, with a cap on in-flight requests and a
+request rate per host. The ETag / Last-Modified of every saved page is kept in
+kb/raw/.crawl_state.json and sent back as If-None-Match / If-Modified-Since, so
+unchanged pages cost a 304 and no extraction. HTML to markdown extraction runs in
+a process pool.
+
+  python ingest/crawl.py --sitemap https://www.hellointerview.com/sitemap.xml --include /learn/system-design/
+  python ingest/crawl.py --urls urls.txt --concurrency 16 --host-rps 2
+
+ingest/stub_site.py is a local stand-in server to try it against.
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import pathlib
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlparse
+
+import httpx
+
+from scrape_article import KB_RAW_DIR, build_frontmatter, markdown_from_html, path_from_url, save
+
+STATE_FILENAME = ".crawl_state.json"
+USER_AGENT = "rag-closed-book-copilot-crawler/1.0"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+SITEMAP_NS = "{http://www.sitemaps.org/schemas/sitemap/0.9}"
+SAVE_STATE_EVERY = 50
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Crawl many article URLs into kb/raw with conditional requests")
+    p.add_argument("--urls", help="File with one URL per line (# comments allowed)")
+    p.add_argument("--url", action="append", default=[], help="URL to crawl (repeatable)")
+    p.add_argument("--sitemap", action="append", default=[], help="Sitemap or sitemap index URL (repeatable)")
+    p.add_argument("--include", action="append", default=[], help="Only crawl URL paths starting with this prefix")
+    p.add_argument("--raw-dir", default=str(KB_RAW_DIR), help="Output root (URL paths are mirrored below it)")
+    p.add_argument("--concurrency", type=int, default=16, help="Max in-flight requests overall")
+    p.add_argument("--per-host", type=int, default=4, help="Max in-flight requests per host")
+    p.add_argument("--host-rps", type=float, default=2.0, help="Max requests started per second per host (0 = no limit)")
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Extraction processes")
+    p.add_argument("--timeout", type=float, default=30.0, help="Per-request timeout in seconds")
+    p.add_argument("--retries", type=int, default=3, help="Retries on 429/5xx/network errors")
+    p.add_argument("--force", action="store_true", help="Ignore stored validators and refetch every page")
+    return p.parse_args()
+
+
+def output_path(url, raw_dir):
+    return pathlib.Path(raw_dir) / path_from_url(url).relative_to(KB_RAW_DIR)
+
+
+def read_url_file(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+
+def extract(url, html):
+    """Runs in the extraction pool."""
+    title, markdown = markdown_from_html(html, url)
+    return build_frontmatter(url, title) + markdown
+
+
+class HostLimiter:
+    """At most `concurrency` in-flight requests and `rps` request starts per second for each host."""
+
+    def __init__(self, concurrency, rps):
+        self.concurrency = concurrency
+        self.interval = 1.0 / rps if rps > 0 else 0.0
+        self._semaphores = {}
+        self._next_start = {}
+
+    @contextlib.asynccontextmanager
+    async def slot(self, host):
+        semaphore = self._semaphores.setdefault(host, asyncio.Semaphore(self.concurrency))
+        async with semaphore:
+            now = time.monotonic()
+            start = max(now, self._next_start.get(host, now))
+            self._next_start[host] = start + self.interval
+            if start > now:
+                await asyncio.sleep(start - now)
+            yield
+
+    def back_off(self, host, seconds):
+        """Hold new requests to `host` for `seconds` (e.g. after a 429 with Retry-After)."""
+        self._next_start[host] = max(self._next_start.get(host, 0.0), time.monotonic() + seconds)
+
+
+def retry_delay(response, attempt):
+    if response is not None:
+        try:
+            return float(response.headers["retry-after"])
+        except (KeyError, ValueError):
+            pass
+    return 0.5 * 2 ** attempt
+
+
+async def fetch(client, limiter, url, headers, retries):
+    host = urlparse(url).netloc
+    for attempt in range(retries + 1):
+        response = None
+        try:
+            async with limiter.slot(host):
+                response = await client.get(url, headers=headers)
+            if response.status_code not in RETRY_STATUSES:
+                return response
+        except httpx.TransportError:
+            if attempt == retries:
+                raise
+        if attempt == retries:
+            return response
+        delay = retry_delay(response, attempt)
+        limiter.back_off(host, delay)
+        await asyncio.sleep(delay)
+
+
+async def sitemap_urls(client, limiter, sitemap_url, retries):
+    """<loc> entries of a sitemap; sitemap indexes are followed recursively."""
+    response = await fetch(client, limiter, sitemap_url, {}, retries)
+    response.raise_for_status()
+    root = ET.fromstring(response.content)
+    locs = [el.text.strip() for el in root.iter(f"{SITEMAP_NS}loc") if el.text]
+    if root.tag == f"{SITEMAP_NS}sitemapindex":
+        nested = await asyncio.gather(*(sitemap_urls(client, limiter, loc, retries) for loc in locs))
+        return [url for urls in nested for url in urls]
+    return locs
+
+
+def load_state(path):
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(path, state):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".json.tmp")
+    tmp_path.write_text(json.dumps(state, indent=2, sort_keys=True), encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
+def conditional_headers(entry):
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+async def crawl(urls, args):
+    raw_dir = pathlib.Path(args.raw_dir)
+    state_path = raw_dir / STATE_FILENAME
+    state = load_state(state_path)
+    counts = {"saved": 0, "not_modified": 0, "unchanged": 0, "failed": 0}
+    failures = []
+    limiter = HostLimiter(args.per_host, args.host_rps)
+    queue = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+    done = 0
+
+    async def crawl_one(client, pool, url):
+        out_path = output_path(url, raw_dir)
+        entry = state.get(url, {})
+        # Without the file on disk a 304 would leave nothing to serve, so fetch unconditionally
+        headers = conditional_headers(entry) if out_path.exists() and not args.force else {}
+        response = await fetch(client, limiter, url, headers, args.retries)
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        if response.status_code == 304:
+            entry["checked_at"] = now
+            state[url] = entry
+            counts["not_modified"] += 1
+            return
+        response.raise_for_status()
+        digest = hashlib.sha256(response.content).hexdigest()
+        validators = {
+            "etag": response.headers.get("etag"),
+            "last_modified": response.headers.get("last-modified"),
+            "sha256": digest,
+            "path": str(out_path),
+            "checked_at": now,
+        }
+        if entry.get("sha256") == digest and out_path.exists() and not args.force:
+            # Server ignored the validators but the page did not change
+            state[url] = {**entry, **validators}
+            counts["unchanged"] += 1
+            return
+        content = await loop.run_in_executor(pool, extract, url, response.text)
+        save(out_path, content)
+        state[url] = {**validators, "fetched_at": now}
+        counts["saved"] += 1
+        print(f"Saved {out_path}")
+
+    async def worker(client, pool):
+        nonlocal done
+        while True:
+            try:
+                url = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                await crawl_one(client, pool, url)
+            except Exception as e:
+                counts["failed"] += 1
+                failures.append((url, f"{type(e).__name__}: {e}"))
+            done += 1
+            if done % SAVE_STATE_EVERY == 0:
+                save_state(state_path, state)
+                print(f"[{done}/{len(urls)}] {counts}")
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(
+        limits=limits, timeout=args.timeout, follow_redirects=True, headers={"User-Agent": USER_AGENT}
+    ) as client:
+        for sitemap in args.sitemap:
+            found = await sitemap_urls(client, limiter, sitemap, args.retries)
+            print(f"Sitemap {sitemap}: {len(found)} URLs")
+            urls = filter_urls(urls + found, args.include)
+        for url in urls:
+            queue.put_nowait(url)
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            try:
+                await asyncio.gather(*(worker(client, pool) for _ in range(min(args.concurrency, len(urls)) or 1)))
+            finally:
+                save_state(state_path, state)
+    return counts, failures, len(urls)
+
+
+def filter_urls(urls, include):
+    """Drop duplicates, URLs without a path and (with --include) paths outside the given prefixes."""
+    kept = []
+    for url in dict.fromkeys(urls):
+        path = urlparse(url).path
+        if not path.strip("/"):
+            continue
+        if include and not any(path.startswith(prefix) for prefix in include):
+            continue
+        kept.append(url)
+    return kept
+
+
+def main():
+    args = parse_args()
+    urls = list(args.url)
+    if args.urls:
+        urls.extend(read_url_file(args.urls))
+    urls = filter_urls(urls, args.include)
+    if not urls and not args.sitemap:
+        raise SystemExit("No URLs given. Use --urls, --url or --sitemap.")
+
+    start = time.perf_counter()
+    counts, failures, total = asyncio.run(crawl(urls, args))
+    elapsed = time.perf_counter() - start
+    print(
+        f"Crawled {total} URLs in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.1f} pages/s): "
+        f"{counts['saved']} saved, {counts['not_modified']} not modified (304), "
+        f"{counts['unchanged']} unchanged, {counts['failed']} failed"
+    )
+    for url, error in failures:
+        print(f"FAILED {url}: {error}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+Collapse near-duplicate chunks between preprocess_kb.py and embed.py.
+
+Scraped pages repeat boilerplate (CTAs, footers, "what you'll learn" blocks) and
+articles quote each other, so many chunks are near-identical. This pass:
+
+1) shingles each chunk into word 5-grams and builds a MinHash signature
+2) finds candidate pairs with LSH banding (bands x rows = num_perm)
+3) confirms every candidate pair in a bucket with the full signatures and
+   clusters them with union-find, merging two clusters only when every chunk
+   being absorbed is >= --threshold similar to the surviving canonical chunk
+   (so edit chains never collapse transitively into text they don't match)
+4) writes one canonical chunk per cluster (the first in file order) with
+   `source_doc_ids` listing every document the passage appeared in
+
+  python ingest/dedupe_chunks.py
+  python ingest/embed.py --chunks-file kb/processed/chunks_dedup.jsonl
+"""
+import argparse
+import json
+import pathlib
+import re
+import zlib
+
+import numpy as np
+
+INPUT_FILE = pathlib.Path("kb/processed/chunks.jsonl")
+OUTPUT_FILE = pathlib.Path("kb/processed/chunks_dedup.jsonl")
+REPORT_FILE = pathlib.Path("kb/processed/dedup_report.json")
+MANIFEST_FILE = pathlib.Path("kb/embed_manifest.json")
+DEFAULT_DIMENSION = 1024  # mxbai-embed-large-v1, used for the index size estimate
+
+WORD_RE = re.compile(r"[a-z0-9]+")
+MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+MIX_2 = np.uint64(0x94D049BB133111EB)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Collapse near-duplicate chunks with MinHash/LSH")
+    parser.add_argument("--input", default=str(INPUT_FILE), help="Chunks JSONL from preprocess_kb.py")
+    parser.add_argument("--output", default=str(OUTPUT_FILE), help="Deduplicated chunks JSONL")
+    parser.add_argument("--threshold", type=float, default=0.85, help="Estimated Jaccard similarity to merge at")
+    parser.add_argument("--num-perm", type=int, default=128, help="MinHash permutations")
+    parser.add_argument("--bands", type=int, default=16, help="LSH bands (num-perm must be divisible by it)")
+    parser.add_argument("--shingle-size", type=int, default=5, help="Words per shingle")
+    parser.add_argument("--min-words", type=int, default=12,
+                        help="Shorter chunks (bare headings, table cells) are never merged")
+    return parser.parse_args()
+
+
+def _mix(x):
+    """splitmix64 finalizer; uint64 arithmetic wraps, which is what we want."""
+    with np.errstate(over="ignore"):
+        x = (x ^ (x >> np.uint64(30))) * MIX_1
+        x = (x ^ (x >> np.uint64(27))) * MIX_2
+        return x ^ (x >> np.uint64(31))
+
+
+def shingles(words, size):
+    if len(words) <= size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+class MinHasher:
+    def __init__(self, num_perm=128, seed=1):
+        rng = np.random.default_rng(seed)
+        self.seeds = rng.integers(0, np.iinfo(np.uint64).max, size=num_perm, dtype=np.uint64, endpoint=True)
+
+    def signature(self, shingle_set):
+        hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingle_set), dtype=np.uint64)
+        # One row per shingle, one column per permutation; keep the top 32 bits
+        values = _mix(hashes[:, None] ^ self.seeds[None, :]) >> np.uint64(32)
+        return values.min(axis=0).astype(np.uint32)
+
+
+class UnionFind:
+    def __init__(self, n):
+        self.parent = np.arange(n)
+
+    def find(self, i):
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            # Lower index (earlier in the file) becomes the canonical root
+            self.parent[max(ra, rb)] = min(ra, rb)
+
+
+def iter_chunks(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def find_clusters(signatures, eligible, bands, threshold):
+    """Union-find over eligible chunks whose signatures collide in a band and agree on >= threshold.
+
+    Every pair in a bucket is a candidate. A confirmed pair merges its two clusters
+    only if all members of the one being absorbed also agree with the surviving
+    root (the chunk that is kept) on >= threshold, so every dropped chunk is a
+    near-duplicate of the chunk that replaces it.
+    """
+    num_chunks, num_perm = signatures.shape
+    rows = num_perm // bands
+    clusters = UnionFind(num_chunks)
+    cluster_members = {}
+    candidate_pairs = confirmed_pairs = 0
+    for band in range(bands):
+        buckets = {}
+        block = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        for i in np.flatnonzero(eligible):
+            buckets.setdefault(block[i].tobytes(), []).append(i)
+        for members in buckets.values():
+            for pos, a in enumerate(members):
+                for b in members[pos + 1:]:
+                    ra, rb = clusters.find(a), clusters.find(b)
+                    if ra == rb:
+                        continue
+                    candidate_pairs += 1
+                    if np.mean(signatures[a] == signatures[b]) < threshold:
+                        continue
+                    root, absorbed = min(ra, rb), max(ra, rb)
+                    moving = cluster_members.get(absorbed, [absorbed])
+                    if np.mean(signatures[moving] == signatures[root], axis=1).min() < threshold:
+                        continue
+                    clusters.union(root, absorbed)
+                    cluster_members.setdefault(root, [root]).extend(cluster_members.pop(absorbed, [absorbed]))
+                    confirmed_pairs += 1
+    return clusters, candidate_pairs, confirmed_pairs
+
+
+def main():
+    args = parse_args()
+    if args.num_perm % args.bands:
+        raise ValueError(f"--num-perm {args.num_perm} must be divisible by --bands {args.bands}")
+    input_path, output_path = pathlib.Path(args.input), pathlib.Path(args.output)
+    if not input_path.exists():
+        raise FileNotFoundError(f"{input_path} not found. Run preprocess_kb.py first.")
+
+    print(f"Signing chunks from {input_path}...")
+    hasher = MinHasher(args.num_perm)
+    signatures = []
+    eligible = []
+    doc_ids = []
+    token_counts = []
+    for chunk in iter_chunks(input_path):
+        words = WORD_RE.findall(chunk["text"].lower())
+        signatures.append(hasher.signature(shingles(words, args.shingle_size)))
+        eligible.append(len(words) >= args.min_words)
+        doc_ids.append(chunk["doc_id"])
+        token_counts.append(chunk.get("token_count", 0))
+    signatures = np.vstack(signatures) if signatures else np.empty((0, args.num_perm), dtype=np.uint32)
+    num_chunks = len(signatures)
+
+    clusters, candidate_pairs, confirmed_pairs = find_clusters(
+        signatures, np.array(eligible, dtype=bool), args.bands, args.threshold
+    )
+    roots = np.array([clusters.find(i) for i in range(num_chunks)], dtype=np.int64)
+    members = {}
+    for i, root in enumerate(roots):
+        members.setdefault(int(root), []).append(i)
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = output_path.with_suffix(".jsonl.tmp")
+    kept = 0
+    with open(tmp_path, "w", encoding="utf-8") as out:
+        for i, chunk in enumerate(iter_chunks(input_path)):
+            if roots[i] != i:
+                continue
+            group = members[i]
+            chunk["source_doc_ids"] = list(dict.fromkeys(doc_ids[j] for j in group))
+            chunk["duplicate_count"] = len(group) - 1
+            out.write(json.dumps(chunk, ensure_ascii=False) + "\n")
+            kept += 1
+    tmp_path.replace(output_path)
+
+    dimension = DEFAULT_DIMENSION
+    if MANIFEST_FILE.exists():
+        dimension = json.loads(MANIFEST_FILE.read_text()).get("dimension", DEFAULT_DIMENSION)
+    removed = num_chunks - kept
+    removed_tokens = int(sum(token_counts[i] for i in range(num_chunks) if roots[i] != i))
+    report = {
+        "input": str(input_path),
+        "output": str(output_path),
+        "threshold": args.threshold,
+        "num_perm": args.num_perm,
+        "bands": args.bands,
+        "shingle_size": args.shingle_size,
+        "min_words": args.min_words,
+        "chunks_in": num_chunks,
+        "chunks_out": kept,
+        "chunks_removed": removed,
+        "clusters_merged": sum(1 for group in members.values() if len(group) > 1),
+        "cross_doc_clusters": sum(1 for group in members.values() if len({doc_ids[j] for j in group}) > 1),
+        "candidate_pairs": candidate_pairs,
+        "confirmed_pairs": confirmed_pairs,
+        "tokens_removed": removed_tokens,
+        "index_bytes_saved": removed * dimension * 4,
+    }
+    REPORT_FILE.parent.mkdir(parents=True, exist_ok=True)
+    REPORT_FILE.write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+    share = removed / num_chunks if num_chunks else 0.0
+    print(f"Chunks: {num_chunks} -> {kept} ({removed} near-duplicates removed, {share:.1%})")
+    print(f"Merged clusters: {report['clusters_merged']} ({report['cross_doc_clusters']} spanning several docs)")
+    print(f"Saved ~{removed_tokens:,} tokens of embedding input and ~{report['index_bytes_saved'] / 1024 ** 2:.1f} MB of flat index")
+    print(f"Wrote {output_path} and {REPORT_FILE}")
+
+
+if __name__ == "__main__":
+    main()
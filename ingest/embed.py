@@ -1,95 +1,547 @@
 import json
 import datetime
+import os
+import tempfile
+import time
 import numpy as np
 import faiss
 import pathlib
 import sentence_transformers
 import argparse
 
+import ann_index
+import kb_versions
+from bm25 import BM25Builder
+from embed_store import DEFAULT_PATH as EMBED_STORE_FILE, EmbeddingStore, content_hash
+from meta_store import MetaStoreWriter
+from stats import DocStatsBuilder, build_stats, diff_docs, load_stats, save_stats
+
 # Configuration
 CHUNKS_FILE = pathlib.Path("kb/processed/chunks.jsonl")
 INDEX_FILE = pathlib.Path("kb/index.faiss")
-META_FILE = pathlib.Path("kb/index_meta.json")
+META_FILE = pathlib.Path("kb/index_meta.bin")
+SPARSE_INDEX_FILE = pathlib.Path("kb/index.bm25.npz")
+EMBEDDINGS_FILE = pathlib.Path("kb/embeddings.npy")
+EMBED_HASHES_FILE = pathlib.Path("kb/embed_hashes.npy")
+MANIFEST_FILE = pathlib.Path("kb/embed_manifest.json")
+KB_STATS_FILE = pathlib.Path("kb/kb_stats.json")
+CHECKPOINT_FILE = pathlib.Path("kb/embed_checkpoint.json")
 MODEL_NAME = 'mixedbread-ai/mxbai-embed-large-v1'
+CHARS_PER_TOKEN = 4  # rough chars/token for text without a stored token_count
+MAX_ENCODE_BATCH = 256
 
 def parse_args():
     parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks-file", default=str(CHUNKS_FILE),
+                        help="Chunks JSONL to embed (e.g. kb/processed/chunks_dedup.jsonl from dedupe_chunks.py)")
     parser.add_argument("--no-context", action="store_true", help="Disable contextual chunking (title prepending)")
+    parser.add_argument("--full", action="store_true", help="Re-embed every chunk instead of reusing unchanged vectors")
+    parser.add_argument("--no-store", action="store_true", help=f"Do not read or write the embedding store ({EMBED_STORE_FILE})")
+    parser.add_argument("--store-max-mb", type=int, default=2048, help="Size cap of the embedding store before LRU eviction")
+    parser.add_argument("--no-publish", action="store_true",
+                        help="Build into kb/ without publishing a new served version (kb/versions + kb/CURRENT)")
+    parser.add_argument("--stream", action="store_true", help="Bounded-memory mode: read, embed and checkpoint chunks in batches")
+    parser.add_argument("--stream-batch-size", type=int, default=4096, help="Chunks per batch in --stream mode")
+    parser.add_argument("--encode-token-budget", type=int, default=16384,
+                        help="Max padded tokens (batch size x longest input) per model.encode batch")
+    ann_index.add_arguments(parser)
     return parser.parse_args()
 
-def load_chunks():
-    path = CHUNKS_FILE
+def load_chunks(path=CHUNKS_FILE):
     if not path.exists():
         raise FileNotFoundError(f"{path} not found. Run preprocess_kb.py first.")
     
     with open(path, "r", encoding="utf-8") as f:
         return [json.loads(line) for line in f]
 
-def main():
-    args = parse_args()
+def count_chunks(path=CHUNKS_FILE):
+    with open(path, "r", encoding="utf-8") as f:
+        return sum(1 for line in f if line.strip())
 
-    print(f"Loading chunks from {CHUNKS_FILE}...")
-    try:
-        chunks = load_chunks()
-    except FileNotFoundError as e:
-        print(f"Error: {e}")
-        return
+def iter_chunk_batches(path=CHUNKS_FILE, batch_size=4096, skip=0):
+    """Lazily yield lists of chunk dicts from a JSONL file, skipping the first `skip` chunks."""
+    batch = []
+    seen = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            seen += 1
+            if seen <= skip:
+                continue
+            batch.append(json.loads(line))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
 
-    print(f"Loaded {len(chunks)} chunks.")
+def embedding_input(chunk, contextual=True):
+    """Exact text that is fed to the embedding model for a chunk."""
+    if contextual:
+        return f"{chunk['title']} > {chunk['section_title']}: {chunk['text']}"
+    return chunk["text"]
+
+def estimate_tokens(chunk, contextual=True):
+    """Approximate token length of embedding_input(chunk) from the stored token_count."""
+    tokens = chunk.get("token_count") or len(chunk["text"]) // CHARS_PER_TOKEN
+    if contextual:
+        tokens += (len(chunk["title"]) + len(chunk["section_title"]) + 4) // CHARS_PER_TOKEN
+    return tokens
+
+def input_hash(text, model_name=MODEL_NAME):
+    """Content hash of one embedding input (32 hex chars, stored as S32); also its embedding store key."""
+    return content_hash(model_name, text).encode("ascii")
 
+def open_store(args):
+    if args.no_store:
+        return None
+    return EmbeddingStore(EMBED_STORE_FILE, max_bytes=args.store_max_mb * 1024 ** 2)
+
+def lookup_store(store, to_encode, read=True):
+    """Remove inputs already in the embedding store from `to_encode`; returns {hash: vector}."""
+    if store is None or not read or not to_encode:
+        return {}
+    found = store.get_many([h.decode("ascii") for h in to_encode])
+    hits = {}
+    for h in list(to_encode):
+        vector = found.get(h.decode("ascii"))
+        if vector is not None:
+            hits[h] = vector
+            del to_encode[h]
+    return hits
+
+def save_to_store(store, encoded):
+    if store is not None and encoded:
+        store.put_many(MODEL_NAME, [(h.decode("ascii"), v) for h, v in encoded.items()])
+
+def load_previous_vectors():
+    """Vectors from the last build keyed by input hash, or ({}, None) if unusable."""
+    if not (EMBEDDINGS_FILE.exists() and EMBED_HASHES_FILE.exists() and MANIFEST_FILE.exists()):
+        return {}, None
+    manifest = json.loads(MANIFEST_FILE.read_text())
+    if manifest.get("model") != MODEL_NAME:
+        return {}, None
+    vectors = np.load(EMBEDDINGS_FILE, mmap_mode="r")
+    hashes = np.load(EMBED_HASHES_FILE)
+    if len(hashes) != len(vectors):
+        return {}, None
+    return {h: row for row, h in enumerate(hashes.tolist())}, vectors
+
+def vector_dimension(encoded, previous_vectors):
+    """Embedding dimension from freshly encoded vectors, else from the previous build."""
+    if encoded:
+        return next(iter(encoded.values())).shape[0]
+    if previous_vectors is not None:
+        return previous_vectors.shape[1]
+    raise ValueError("No vectors were encoded and there is no previous build to take the dimension from.")
+
+def save_array(path, array):
+    tmp_path = path.with_suffix(".tmp.npy")
+    np.save(tmp_path, array)
+    tmp_path.replace(path)
+
+def write_json(path, data):
+    tmp_path = path.with_suffix(".tmp.json")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    tmp_path.replace(path)
+
+def load_model():
     print(f"Loading model '{MODEL_NAME}' from Hugging Face...")
-    try:
-        model = sentence_transformers.SentenceTransformer(MODEL_NAME)
-    except Exception as e:
-        print(f"Failed to download/load model: {e}")
-        return
-    
-    print("Generating embeddings (this may take a moment)...")
-    
-    if args.no_context:
-        print("Mode: Standard Chunking (Text only)")
-        texts = [c["text"] for c in chunks]
-    else:
-        print("Mode: Contextual Chunking (Title > Section: Text)")
-        texts = [f"{c['title']} > {c['section_title']}: {c['text']}" for c in chunks]
+    return sentence_transformers.SentenceTransformer(MODEL_NAME)
+
+def length_batches(token_counts, token_budget, max_batch=MAX_ENCODE_BATCH):
+    """Group input positions longest-first so each batch pads to at most `token_budget` tokens."""
+    order = np.argsort(-np.asarray(token_counts), kind="stable")
+    batches = []
+    start = 0
+    while start < len(order):
+        longest = max(1, int(token_counts[order[start]]))
+        size = max(1, min(max_batch, token_budget // longest))
+        batches.append(order[start:start + size])
+        start += size
+    return batches
+
+def encode_texts(model, texts, token_counts, token_budget):
+    """L2-normalized float32 embeddings for `texts`, in input order, plus throughput stats.
+
+    Inputs are encoded in length-sorted batches sized to a padded-token budget, so
+    short chunks are not padded up to the longest chunk in file order.
+    """
+    max_seq_length = getattr(model, "max_seq_length", None)
+    if max_seq_length:
+        token_counts = [min(t, max_seq_length) for t in token_counts]
+    batches = length_batches(token_counts, token_budget)
+
+    vectors = None
+    start_time = time.perf_counter()
+    for i, batch in enumerate(batches):
+        batch_vectors = model.encode(
+            [texts[j] for j in batch], batch_size=len(batch), show_progress_bar=False, convert_to_numpy=True
+        )
+        if vectors is None:
+            # CAST TO FLOAT32 FOR FAISS
+            vectors = np.empty((len(texts), batch_vectors.shape[1]), dtype=np.float32)
+        vectors[batch] = batch_vectors
+        if len(batches) > 20 and (i + 1) % 20 == 0:
+            print(f"  encoded {sum(len(b) for b in batches[:i + 1])}/{len(texts)} inputs")
+    seconds = time.perf_counter() - start_time
 
-    embeddings = model.encode(texts, show_progress_bar=True, convert_to_numpy=True)
-    
-    # CAST TO FLOAT32 FOR FAISS
-    embeddings = embeddings.astype(np.float32)
-    
     # L2 normalize embeddings for Cosine Similarity search with IndexFlatIP
-    faiss.normalize_L2(embeddings)
-    
-    dimension = embeddings.shape[1]
-    print(f"Embedding dimension: {dimension}")
+    faiss.normalize_L2(vectors)
+    stats = {"chunks": len(texts), "tokens": int(sum(token_counts)), "batches": len(batches), "seconds": seconds}
+    return vectors, stats
 
-    print("Building FAISS index...")
-    # IndexFlatIP = Exact search using Inner Product (Cosine Similarity since we normalized)
-    index = faiss.IndexFlatIP(dimension) 
-    index.add(embeddings)
-    
+def format_throughput(stats):
+    seconds = max(stats["seconds"], 1e-9)
+    return (
+        f"{stats['chunks']} inputs in {stats['batches']} batches, {stats['seconds']:.1f}s: "
+        f"{stats['chunks'] / seconds:.1f} chunks/sec, {stats['tokens'] / seconds:.0f} tokens/sec"
+    )
+
+def throughput_summary(stats):
+    seconds = stats["seconds"]
+    return {
+        **stats,
+        "seconds": round(seconds, 3),
+        "chunks_per_sec": round(stats["chunks"] / seconds, 2) if seconds else None,
+        "tokens_per_sec": round(stats["tokens"] / seconds, 1) if seconds else None,
+    }
+
+def build_and_save_index(args, embeddings, flat_baseline=True):
+    """Build the configured index from (possibly memory-mapped) embeddings, report recall and save it."""
+    print(f"Building FAISS index ({args.index_type})...")
+    build_params, search_params = ann_index.resolve_params(args.index_type, len(embeddings), embeddings.shape[1], args)
+    train_ids, query_ids = ann_index.split_sample(len(embeddings), args.train_size, args.eval_queries)
+    index = ann_index.build_index(embeddings, args.index_type, build_params, search_params, train_ids)
+    return save_index(args, index, embeddings, build_params, search_params, train_ids, query_ids, flat_baseline)
+
+def save_index(args, index, embeddings, build_params, search_params, train_ids, query_ids, flat_baseline=True):
+    """Report recall on the held-out `query_ids`, write the index and return its manifest entry."""
     print(f"Index contains {index.ntotal} vectors.")
 
+    report = ann_index.evaluate_index(index, embeddings, query_ids, k=args.eval_k, flat_baseline=flat_baseline)
+    line = (
+        f"Recall@{report['k']} vs flat on {report['num_queries']} held-out queries: {report['recall']:.4f} | "
+        f"search p50 {report['p50_ms']:.3f} ms, p99 {report['p99_ms']:.3f} ms"
+    )
+    if report["flat_p50_ms"] is not None:
+        line += f" (flat p50 {report['flat_p50_ms']:.3f} ms, p99 {report['flat_p99_ms']:.3f} ms)"
+    print(line)
+
     print(f"Saving index to {INDEX_FILE}...")
-    faiss.write_index(index, str(INDEX_FILE))
-    
-    print(f"Saving metadata to {META_FILE}...")
-    with open(META_FILE, "w", encoding="utf-8") as f:
-        json.dump(chunks, f, indent=2)
+    # Written beside the target and renamed, so published versions hard-linking the old file stay intact
+    tmp_path = INDEX_FILE.with_suffix(".tmp.faiss")
+    faiss.write_index(index, str(tmp_path))
+    tmp_path.replace(INDEX_FILE)
+    return {
+        "type": args.index_type,
+        "build_params": build_params,
+        "search_params": search_params,
+        "train_size": len(train_ids) if args.index_type in ann_index.TRAINED_INDEX_TYPES else 0,
+        "report": report,
+    }
+
+def write_kb_stats(doc_stats):
+    """Write this build's per-document stats to kb/kb_stats.json, reporting what changed since the last build."""
+    docs = doc_stats.entries()
+    changes = diff_docs(load_stats(KB_STATS_FILE), docs)
+    stats = build_stats(docs)
+    save_stats(KB_STATS_FILE, stats)
+    print(
+        f"Saved KB stats to {KB_STATS_FILE}: {stats['total_docs']} docs "
+        f"({len(changes['added'])} added, {len(changes['changed'])} changed, {len(changes['removed'])} removed)."
+    )
+
+def write_chunk_stores(chunks, contextual):
+    """One pass over `chunks` writing the metadata store, the BM25 index and the KB stats.
 
+    BM25 postings are spilled to segment files past bm25.MAX_POSTINGS_IN_MEMORY,
+    so this pass stays bounded in memory for streamed builds.
+    """
+    print(f"Saving metadata to {META_FILE} and BM25 index to {SPARSE_INDEX_FILE}...")
+    doc_stats = DocStatsBuilder()
+    with tempfile.TemporaryDirectory(dir=SPARSE_INDEX_FILE.parent) as spill_dir:
+        bm25_builder = BM25Builder(spill_dir=spill_dir)
+        with MetaStoreWriter(META_FILE) as writer:
+            for chunk in chunks:
+                writer.append(chunk)
+                bm25_builder.add(embedding_input(chunk, contextual=contextual))
+                doc_stats.add(chunk)
+        write_kb_stats(doc_stats)
+        sparse_index = bm25_builder.build()
+        tmp_path = SPARSE_INDEX_FILE.with_suffix(".tmp.npz")
+        sparse_index.save(tmp_path)
+        tmp_path.replace(SPARSE_INDEX_FILE)
+        print(f"BM25 vocabulary: {len(sparse_index.terms)} terms, {len(sparse_index.doc_ids)} postings.")
+        return {
+            "type": "bm25",
+            "k1": sparse_index.k1,
+            "b": sparse_index.b,
+            "num_terms": len(sparse_index.terms),
+            "num_postings": int(len(sparse_index.doc_ids)),
+        }
+
+def write_manifest(args, dimension, num_chunks, index_info, reused, from_store, encoded, encode_stats, sparse_info):
     embed_manifest = {
         "model": MODEL_NAME,
         "dimension": dimension,
-        "num_chunks": len(chunks),
+        "num_chunks": num_chunks,
+        "chunks_file": str(args.chunks_file),
         "contextual": not args.no_context,
+        "index": index_info,
+        "incremental": {
+            "reused": reused,
+            "from_store": from_store,
+            "encoded": encoded,
+        },
+        "encoding": throughput_summary(encode_stats),
+        "sparse": sparse_info,
         "timestamp": datetime.datetime.now().isoformat(),
     }
-    manifest_path = pathlib.Path("kb/embed_manifest.json")
-    with open(manifest_path, "w", encoding="utf-8") as f:
-        json.dump(embed_manifest, f, indent=2)
-    print(f"Saved embed manifest to {manifest_path}")
+    write_json(MANIFEST_FILE, embed_manifest)
+    print(f"Saved embed manifest to {MANIFEST_FILE}")
+
+def publish(args):
+    if args.no_publish:
+        return
+    version = kb_versions.publish(MANIFEST_FILE.parent)
+    print(f"Published KB version {version} (kb/{kb_versions.VERSIONS_DIRNAME}/{version}); running apps will reload it.")
+
+def partial_path(path):
+    return path.with_suffix(".partial.npy")
+
+def load_checkpoint(source):
+    """Progress of an interrupted --stream run over the same inputs, or None."""
+    if not CHECKPOINT_FILE.exists():
+        return None
+    checkpoint = json.loads(CHECKPOINT_FILE.read_text())
+    if checkpoint.get("source") != source:
+        print("Ignoring checkpoint from a different chunks file / model / mode.")
+        return None
+    if not (partial_path(EMBEDDINGS_FILE).exists() and partial_path(EMBED_HASHES_FILE).exists()):
+        return None
+    return checkpoint
+
+def run_stream(args):
+    """Embed chunks batch by batch into memory-mapped .npy files, checkpointing after each batch."""
+    chunks_file = pathlib.Path(args.chunks_file)
+    if not chunks_file.exists():
+        print(f"Error: {chunks_file} not found. Run preprocess_kb.py first.")
+        return
+    contextual = not args.no_context
+    stat = chunks_file.stat()
+    source = {
+        "chunks_file": str(chunks_file),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "model": MODEL_NAME,
+        "contextual": contextual,
+    }
+    num_chunks = count_chunks(chunks_file)
+    if not num_chunks:
+        print(f"Error: {chunks_file} contains no chunks.")
+        return
+    print(f"Streaming {num_chunks} chunks from {chunks_file} in batches of {args.stream_batch_size}.")
+
+    checkpoint = load_checkpoint(source)
+    embeddings = hashes_out = index_builder = None
+    done = reused = from_store = encoded_count = 0
+    dimension = None
+    if checkpoint:
+        done, reused, encoded_count = checkpoint["done"], checkpoint["reused"], checkpoint["encoded"]
+        from_store = checkpoint.get("from_store", 0)
+        dimension = checkpoint["dimension"]
+        embeddings = np.load(partial_path(EMBEDDINGS_FILE), mmap_mode="r+")
+        hashes_out = np.load(partial_path(EMBED_HASHES_FILE), mmap_mode="r+")
+        print(f"Resuming from checkpoint: {done}/{num_chunks} chunks already embedded.")
+
+    # IVF types train on the first --train-size rows as they arrive instead of a random sample
+    _, query_ids = ann_index.split_sample(num_chunks, args.train_size, args.eval_queries)
+    train_ids = ann_index.prefix_train_ids(num_chunks, args.train_size, query_ids)
+    build_params = search_params = None
+
+    def start_index():
+        nonlocal build_params, search_params
+        build_params, search_params = ann_index.resolve_params(args.index_type, num_chunks, dimension, args)
+        print(f"Building FAISS index ({args.index_type}) batch by batch...")
+        return ann_index.IncrementalIndex(args.index_type, dimension, build_params, search_params, train_ids)
+
+    # Row of the first occurrence of each input hash, so repeats in later batches are copied, not re-encoded
+    seen_rows = {}
+    if checkpoint:
+        index_builder = start_index()
+        # The index itself is not checkpointed; rebuild it from the vectors already on disk
+        index_builder.extend(embeddings, done)
+        for row, h in enumerate(hashes_out[:done].tolist()):
+            seen_rows.setdefault(h, row)
+
+    previous_rows, previous_vectors = ({}, None) if args.full else load_previous_vectors()
+    store = open_store(args)
+    model = None
+    encode_stats = {"chunks": 0, "tokens": 0, "batches": 0, "seconds": 0.0}
+    for batch in iter_chunk_batches(chunks_file, args.stream_batch_size, skip=done):
+        texts = [embedding_input(c, contextual=contextual) for c in batch]
+        hashes = [input_hash(t) for t in texts]
+        to_encode = {}
+        for row, h in enumerate(hashes):
+            if h not in previous_rows and h not in seen_rows and h not in to_encode:
+                to_encode[h] = row
+
+        known = lookup_store(store, to_encode, read=not args.full)
+        encoded = {}
+        if to_encode:
+            if model is None:
+                try:
+                    model = load_model()
+                except Exception as e:
+                    print(f"Failed to download/load model: {e}")
+                    return
+            rows = list(to_encode.values())
+            new_vectors, stats = encode_texts(
+                model, [texts[r] for r in rows], [estimate_tokens(batch[r], contextual) for r in rows],
+                args.encode_token_budget,
+            )
+            encoded = dict(zip(to_encode, new_vectors))
+            save_to_store(store, encoded)
+            for key in encode_stats:
+                encode_stats[key] += stats[key]
+        encoded.update(known)
+
+        if embeddings is None:
+            dimension = vector_dimension(encoded, previous_vectors)
+            embeddings = np.lib.format.open_memmap(
+                partial_path(EMBEDDINGS_FILE), mode="w+", dtype=np.float32, shape=(num_chunks, dimension)
+            )
+            hashes_out = np.lib.format.open_memmap(
+                partial_path(EMBED_HASHES_FILE), mode="w+", dtype="S32", shape=(num_chunks,)
+            )
+            index_builder = start_index()
+        for offset, h in enumerate(hashes):
+            if h in encoded:
+                embeddings[done + offset] = encoded[h]
+            elif h in seen_rows:
+                embeddings[done + offset] = embeddings[seen_rows[h]]
+            else:
+                embeddings[done + offset] = previous_vectors[previous_rows[h]]
+            seen_rows.setdefault(h, done + offset)
+        hashes_out[done:done + len(hashes)] = hashes
+        embeddings.flush()
+        hashes_out.flush()
+
+        done += len(batch)
+        index_builder.extend(embeddings, done)
+        reused += sum(1 for h in hashes if h in previous_rows)
+        from_store += len(known)
+        encoded_count += len(to_encode)
+        write_json(CHECKPOINT_FILE, {
+            "source": source,
+            "dimension": dimension,
+            "done": done,
+            "reused": reused,
+            "from_store": from_store,
+            "encoded": encoded_count,
+        })
+        print(f"Embedded {done}/{num_chunks} chunks ({encoded_count} encoded, {reused} reused, {from_store} from store).")
+
+    if encode_stats["chunks"]:
+        print(f"Encoding throughput: {format_throughput(encode_stats)}")
+
+    print(f"Embedding dimension: {dimension}")
+    index = index_builder.finish()
+    index_info = save_index(args, index, embeddings, build_params, search_params, train_ids, query_ids, flat_baseline=False)
+    del index, index_builder
+
+    # Close the maps before swapping the finished arrays into place
+    del embeddings, hashes_out, previous_vectors
+    os.replace(partial_path(EMBEDDINGS_FILE), EMBEDDINGS_FILE)
+    os.replace(partial_path(EMBED_HASHES_FILE), EMBED_HASHES_FILE)
+    CHECKPOINT_FILE.unlink()
+
+    chunks = (c for batch in iter_chunk_batches(chunks_file, args.stream_batch_size) for c in batch)
+    sparse_info = write_chunk_stores(chunks, contextual)
+    if store is not None:
+        store.close()
+    write_manifest(args, dimension, num_chunks, index_info, reused, from_store, encoded_count, encode_stats, sparse_info)
+    publish(args)
+    print("Done!")
+
+def main():
+    args = parse_args()
+    if args.no_context:
+        print("Mode: Standard Chunking (Text only)")
+    else:
+        print("Mode: Contextual Chunking (Title > Section: Text)")
+    if args.stream:
+        run_stream(args)
+        return
+
+    print(f"Loading chunks from {args.chunks_file}...")
+    try:
+        chunks = load_chunks(pathlib.Path(args.chunks_file))
+    except FileNotFoundError as e:
+        print(f"Error: {e}")
+        return
+
+    if not chunks:
+        print(f"Error: {args.chunks_file} contains no chunks.")
+        return
+    print(f"Loaded {len(chunks)} chunks.")
+
+    texts = [embedding_input(c, contextual=not args.no_context) for c in chunks]
+    hashes = [input_hash(t) for t in texts]
+
+    previous_rows, previous_vectors = ({}, None) if args.full else load_previous_vectors()
+    to_encode = {}
+    for row, h in enumerate(hashes):
+        if h not in previous_rows and h not in to_encode:
+            to_encode[h] = row
+    reused = sum(1 for h in hashes if h in previous_rows)
+    store = open_store(args)
+    known = lookup_store(store, to_encode, read=not args.full)
+    print(
+        f"Reusing {reused} vectors from the previous build and {len(known)} from the embedding store; "
+        f"{len(to_encode)} unique inputs to encode."
+    )
+
+    encoded = {}
+    encode_stats = {"chunks": 0, "tokens": 0, "batches": 0, "seconds": 0.0}
+    if to_encode:
+        try:
+            model = load_model()
+        except Exception as e:
+            print(f"Failed to download/load model: {e}")
+            return
+
+        print("Generating embeddings (this may take a moment)...")
+        rows = list(to_encode.values())
+        new_vectors, encode_stats = encode_texts(
+            model, [texts[r] for r in rows], [estimate_tokens(chunks[r], not args.no_context) for r in rows],
+            args.encode_token_budget,
+        )
+        encoded = dict(zip(to_encode, new_vectors))
+        save_to_store(store, encoded)
+        print(f"Encoding throughput: {format_throughput(encode_stats)}")
+    encoded.update(known)
+    if store is not None:
+        store.close()
+
+    dimension = vector_dimension(encoded, previous_vectors)
+    embeddings = np.empty((len(chunks), dimension), dtype=np.float32)
+    for row, h in enumerate(hashes):
+        embeddings[row] = encoded[h] if h in encoded else previous_vectors[previous_rows[h]]
+    del previous_vectors
+
+    print(f"Embedding dimension: {dimension}")
+    save_array(EMBEDDINGS_FILE, embeddings)
+    save_array(EMBED_HASHES_FILE, np.asarray(hashes, dtype="S32"))
+
+    index_info = build_and_save_index(args, embeddings)
+    sparse_info = write_chunk_stores(chunks, contextual=not args.no_context)
+    write_manifest(args, dimension, len(chunks), index_info, reused, len(known), len(to_encode), encode_stats, sparse_info)
 
+    publish(args)
     print("Done!")
 
 if __name__ == "__main__":
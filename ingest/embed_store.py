@@ -0,0 +1,225 @@
+"""
+Content-addressed embedding store (kb/cache/embeddings.sqlite).
+
+Vectors are keyed by content_hash(model name, exact input text), so any build
+that feeds the model a string it has seen before (another chunk size, overlap or
+contextual mode in a sweep, or a repeated user query) gets the stored vector
+instead of a forward pass. The store is a single SQLite file in WAL mode, safe to
+share between embed runs and the app; when it grows past `max_bytes` the least
+recently used vectors are evicted. Reads refresh a vector's last-used time at most
+once per `touch_interval`, so hot lookups stay read-only.
+
+  python ingest/embed_store.py stats
+  python ingest/embed_store.py compact --max-mb 1024
+"""
+import argparse
+import hashlib
+import pathlib
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_PATH = pathlib.Path("kb/cache/embeddings.sqlite")
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+EVICT_TO_FRACTION = 0.9  # evict down to this share of max_bytes so eviction is not triggered on every put
+SQLITE_MAX_PARAMS = 500
+TOUCH_INTERVAL_SECONDS = 3600.0  # LRU resolution; reads skip the UPDATE while last_used is this recent
+
+
+def content_hash(model_name, text):
+    """Store key for one embedding input (32 hex chars)."""
+    return hashlib.blake2b(f"{model_name}\0{text}".encode("utf-8"), digest_size=16).hexdigest()
+
+
+class EmbeddingStore:
+    """Thread-safe float32 vector store keyed by content_hash()."""
+
+    def __init__(self, path=DEFAULT_PATH, max_bytes=DEFAULT_MAX_BYTES, timeout=30.0,
+                 touch_interval=TOUCH_INTERVAL_SECONDS):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=timeout, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS vectors ("
+            " key TEXT PRIMARY KEY, model TEXT NOT NULL, dim INTEGER NOT NULL,"
+            " vector BLOB NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS vectors_last_used ON vectors(last_used)")
+        # Vector bytes are kept in the database by triggers, so every process sharing the file sees
+        # writes made by the others; seeded once from the table for stores created before it existed
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS store_size (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS vectors_size_insert AFTER INSERT ON vectors BEGIN"
+                " UPDATE store_size SET bytes = bytes + LENGTH(NEW.vector) WHERE id = 0; END"
+            )
+            self._conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS vectors_size_delete AFTER DELETE ON vectors BEGIN"
+                " UPDATE store_size SET bytes = bytes - LENGTH(OLD.vector) WHERE id = 0; END"
+            )
+            self._conn.execute(
+                "INSERT OR IGNORE INTO store_size (id, bytes) SELECT 0, COALESCE(SUM(LENGTH(vector)), 0) FROM vectors"
+            )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _total_bytes(self):
+        """Vector bytes currently in the store, including rows other processes wrote."""
+        (total,) = self._conn.execute("SELECT bytes FROM store_size WHERE id = 0").fetchone()
+        return total
+
+    def get_many(self, keys):
+        """{key: vector} for the keys that are stored.
+
+        Hits whose last_used is older than `touch_interval` are marked as recently
+        used in one transaction; fresher hits cost no write.
+        """
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        now = time.time()
+        stale = []
+        with self._lock:
+            for start in range(0, len(keys), SQLITE_MAX_PARAMS):
+                part = keys[start:start + SQLITE_MAX_PARAMS]
+                placeholders = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT key, vector, last_used FROM vectors WHERE key IN ({placeholders})", part
+                ).fetchall()
+                for key, blob, last_used in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+                    if now - last_used >= self.touch_interval:
+                        stale.append((now, key))
+            if stale:
+                self._conn.execute("BEGIN")
+                try:
+                    self._conn.executemany("UPDATE vectors SET last_used = ? WHERE key = ?", stale)
+                    self._conn.execute("COMMIT")
+                except BaseException:
+                    self._conn.execute("ROLLBACK")
+                    raise
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def put_many(self, model_name, items):
+        """Store (key, vector) pairs; existing keys are left as they are."""
+        now = time.time()
+        rows = []
+        for key, vector in items:
+            vector = np.ascontiguousarray(vector, dtype=np.float32)
+            rows.append((key, model_name, vector.shape[-1], vector.tobytes(), now, now))
+        if not rows:
+            return 0
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO vectors (key, model, dim, vector, created, last_used) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            inserted = self._conn.total_changes - before
+            # Read back rather than tracked here: the app and embed runs write to the same file
+            if self.max_bytes and inserted and self._total_bytes() > self.max_bytes:
+                self._evict(int(self.max_bytes * EVICT_TO_FRACTION))
+        return inserted
+
+    def put(self, model_name, key, vector):
+        self.put_many(model_name, [(key, vector)])
+
+    def _evict(self, target_bytes):
+        """Drop least recently used vectors until the store holds at most target_bytes."""
+        excess = self._total_bytes() - target_bytes
+        if excess <= 0:
+            return 0
+        victims, freed = [], 0
+        for key, size in self._conn.execute("SELECT key, LENGTH(vector) FROM vectors ORDER BY last_used"):
+            victims.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self._conn.execute("BEGIN")
+        self._conn.executemany("DELETE FROM vectors WHERE key = ?", victims)
+        self._conn.execute("COMMIT")
+        self.evictions += len(victims)
+        return len(victims)
+
+    def evict(self, target_bytes=None):
+        with self._lock:
+            return self._evict(self.max_bytes if target_bytes is None else target_bytes)
+
+    def compact(self, target_bytes=None):
+        """Evict down to target_bytes (default max_bytes), then reclaim the file space."""
+        removed = self.evict(target_bytes)
+        with self._lock:
+            self._conn.execute("VACUUM")
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return removed
+
+    def stats(self):
+        with self._lock:
+            count, models = self._conn.execute("SELECT COUNT(*), COUNT(DISTINCT model) FROM vectors").fetchone()
+            return {
+                "path": str(self.path),
+                "vectors": count,
+                "models": models,
+                "vector_bytes": self._total_bytes(),
+                "file_bytes": sum(
+                    p.stat().st_size for p in (self.path, self.path.with_name(self.path.name + "-wal")) if p.exists()
+                ),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or compact the embedding store")
+    parser.add_argument("command", choices=["stats", "compact"])
+    parser.add_argument("--path", default=str(DEFAULT_PATH), help="SQLite store file")
+    parser.add_argument("--max-mb", type=int, default=DEFAULT_MAX_BYTES // 1024 ** 2,
+                        help="compact: evict least recently used vectors down to this size")
+    args = parser.parse_args()
+
+    store = EmbeddingStore(args.path, max_bytes=args.max_mb * 1024 ** 2)
+    if args.command == "compact":
+        before = store.stats()["file_bytes"]
+        removed = store.compact()
+        print(f"Evicted {removed} vectors; file size {before / 1024 ** 2:.1f} MB -> "
+              f"{store.stats()['file_bytes'] / 1024 ** 2:.1f} MB")
+    for name, value in store.stats().items():
+        print(f"{name}: {value}")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,34 @@
 """
 Convert locally saved .html files into KB markdown.
 
-Usage: python ingest/ingest_local_html.py
+The input directory is scanned once into a sorted filename index; MAPPING
+prefixes are resolved against it by binary search. With --all, every other
+.html file whose source URL can be read from the page (browser "saved from url"
+comment, canonical link or og:url) is converted too, into the path_from_url
+layout. Extraction runs in a process pool and is cached by HTML content hash in
+kb/cache/html, so re-running over a large dump only extracts new or changed
+pages.
+
+Usage: python ingest/ingest_local_html.py [--input-dir ~/Downloads] [--all] [--workers 8]
 """
+import argparse
+import bisect
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 from pathlib import Path
+
 import trafilatura
 
-from scrape_article import KB_RAW_DIR, extract_title, save
+from scrape_article import KB_RAW_DIR, extract_title, path_from_url, save
 
 DOWNLOADS = Path("/Users/segalmax/Downloads")
 KB_BASE = "learn/system-design"
+CACHE_DIR = Path("kb/cache/html")
+CACHE_VERSION = 1
 
 # filename prefix → (section, slug, url-path)
 MAPPING = [
@@ -37,16 +56,52 @@ BASE_URLS = {
     "advanced-topics":  "https://www.hellointerview.com/learn/system-design/advanced-topics",
 }
 
+SOURCE_URL_PATTERNS = [
+    re.compile(r"<!--\s*saved from url=\(\d+\)(\S+?)\s*-->", re.I),
+    re.compile(r"<link[^>]+rel=[\"']canonical[\"'][^>]+href=[\"']([^\"']+)", re.I),
+    re.compile(r"<link[^>]+href=[\"']([^\"']+)[\"'][^>]+rel=[\"']canonical", re.I),
+    re.compile(r"<meta[^>]+property=[\"']og:url[\"'][^>]+content=[\"']([^\"']+)", re.I),
+]
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Convert saved HTML pages into KB markdown")
+    p.add_argument("--input-dir", default=str(DOWNLOADS), help="Directory with saved .html files")
+    p.add_argument("--recursive", action="store_true",
+                   help="Also scan subdirectories (off by default: browsers save asset pages under *_files/)")
+    p.add_argument("--all", action="store_true",
+                   help="Also convert files outside MAPPING whose source URL is found in the HTML")
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Extraction processes")
+    p.add_argument("--cache-dir", default=str(CACHE_DIR), help="Extraction cache keyed by HTML content hash")
+    p.add_argument("--no-cache", action="store_true", help="Always re-extract")
+    return p.parse_args()
+
+
+class HtmlIndex:
+    """Sorted filename index of one directory scan; prefix lookups are binary searches."""
+
+    def __init__(self, input_dir: Path, recursive: bool = False):
+        found = input_dir.rglob("*.html") if recursive else input_dir.glob("*.html")
+        self.paths = sorted(found, key=lambda p: (p.name, str(p)))
+        self.names = [p.name for p in self.paths]
+
+    def find(self, prefix: str) -> Path:
+        i = bisect.bisect_left(self.names, prefix)
+        if i < len(self.names) and self.names[i].startswith(prefix):
+            return self.paths[i]
+        raise FileNotFoundError(f"No HTML file starting with: {prefix!r}")
 
-def find_html_file(prefix: str) -> Path:
-    for html_file in DOWNLOADS.glob("*.html"):
-        if html_file.name.startswith(prefix):
-            return html_file
-    raise FileNotFoundError(f"No HTML file starting with: {prefix!r}")
 
+def source_url(html: str):
+    """URL the page was saved from, if the HTML records it."""
+    for pattern in SOURCE_URL_PATTERNS:
+        match = pattern.search(html)
+        if match:
+            return match.group(1)
+    return None
 
-def html_to_markdown(html_path: Path) -> tuple:
-    html = html_path.read_text(encoding="utf-8", errors="ignore")
+
+def extract_markdown(html: str, name: str) -> tuple:
     markdown = trafilatura.extract(
         html,
         output_format="markdown",
@@ -54,17 +109,47 @@ def html_to_markdown(html_path: Path) -> tuple:
         favor_precision=True,
     )
     if not markdown:
-        raise ValueError(f"trafilatura returned empty content for {html_path.name}")
+        raise ValueError(f"trafilatura returned empty content for {name}")
     title = extract_title(markdown)
     return title, markdown.strip()
 
 
+def convert(path_str: str, cache_dir):
+    """Worker entry point: (title, markdown, source url, cache_hit) for one HTML file."""
+    path = Path(path_str)
+    data = path.read_bytes()
+    cache_file = None
+    if cache_dir is not None:
+        key = hashlib.sha256(f"v{CACHE_VERSION}:{trafilatura.__version__}:".encode() + data).hexdigest()
+        cache_file = Path(cache_dir) / key[:2] / f"{key}.json"
+        if cache_file.exists():
+            cached = json.loads(cache_file.read_text(encoding="utf-8"))
+            return cached["title"], cached["markdown"], cached["url"], True
+
+    html = data.decode("utf-8", errors="ignore")
+    title, markdown = extract_markdown(html, path.name)
+    url = source_url(html)
+    if cache_file is not None:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+        tmp_file.write_text(json.dumps({"title": title, "markdown": markdown, "url": url}, ensure_ascii=False),
+                            encoding="utf-8")
+        tmp_file.replace(cache_file)
+    return title, markdown, url, False
+
+
+def convert_safe(path_str: str, cache_dir):
+    try:
+        return convert(path_str, cache_dir)
+    except ValueError as e:
+        return e
+
+
 def kb_path(section: str, slug: str) -> Path:
     return KB_RAW_DIR / KB_BASE / section / f"{slug}.md"
 
 
 def build_frontmatter(url: str, title: str) -> str:
-    from datetime import datetime
     return (
         f"---\n"
         f"url: {url}\n"
@@ -75,15 +160,69 @@ def build_frontmatter(url: str, title: str) -> str:
     )
 
 
-def main():
+def build_jobs(index: HtmlIndex, include_all: bool):
+    """[(html path, url or None, output path or None)]; None = take both from the page itself."""
+    jobs, mapped = [], set()
     for prefix, section, slug in MAPPING:
-        html_file = find_html_file(prefix)
-        title, markdown = html_to_markdown(html_file)
-        url = f"{BASE_URLS[section]}/{slug}"
-        content = build_frontmatter(url, title) + markdown
-        out_path = kb_path(section, slug)
-        save(out_path, content)
-        print(f"OK  {section}/{slug}.md  ({len(markdown)} chars)")
+        try:
+            html_file = index.find(prefix)
+        except FileNotFoundError as e:
+            # A dump for a new KB need not contain the mapped pages
+            if not include_all:
+                raise
+            print(f"SKIP {e}")
+            continue
+        mapped.add(html_file)
+        jobs.append((html_file, f"{BASE_URLS[section]}/{slug}", kb_path(section, slug)))
+    if include_all:
+        jobs.extend((path, None, None) for path in index.paths if path not in mapped)
+    return jobs
+
+
+def main():
+    args = parse_args()
+    input_dir = Path(args.input_dir).expanduser()
+    if not input_dir.is_dir():
+        raise FileNotFoundError(f"Input directory not found: {input_dir}")
+    cache_dir = None if args.no_cache else args.cache_dir
+
+    index = HtmlIndex(input_dir, recursive=args.recursive)
+    print(f"Indexed {len(index.paths)} HTML files in {input_dir}")
+    jobs = build_jobs(index, args.all)
+    paths = [str(path) for path, _, _ in jobs]
+
+    if args.workers <= 1 or len(paths) <= 1:
+        results = (convert_safe(path, cache_dir) for path in paths)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=args.workers)
+        results = pool.map(convert_safe, paths, [cache_dir] * len(paths),
+                           chunksize=max(1, len(paths) // (args.workers * 8)))
+
+    written = cache_hits = skipped = 0
+    try:
+        for (html_file, url, out_path), result in zip(jobs, results):
+            if isinstance(result, ValueError):
+                if url is not None:
+                    raise result
+                print(f"SKIP {html_file.name}: {result}")
+                skipped += 1
+                continue
+            title, markdown, page_url, cache_hit = result
+            if out_path is None:
+                if not page_url:
+                    print(f"SKIP {html_file.name}: no source URL in the page")
+                    skipped += 1
+                    continue
+                url, out_path = page_url, path_from_url(page_url)
+            save(out_path, build_frontmatter(url, title) + markdown)
+            written += 1
+            cache_hits += cache_hit
+            print(f"OK  {out_path.relative_to(KB_RAW_DIR)}  ({len(markdown)} chars{', cached' if cache_hit else ''})")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    print(f"Wrote {written} files ({cache_hits} from cache), skipped {skipped}.")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,122 @@
+"""
+Versioned knowledge-base snapshots served by the app.
+
+  kb/versions/<version>/{index.faiss, index_meta.bin, index.bm25.npz, embed_manifest.json, kb_stats.json}
+  kb/CURRENT  -> name of the served version (replaced atomically with os.replace)
+
+embed.py builds into kb/ as before and then publishes: the served files are
+hard-linked (copied if linking is not possible) into a new version directory and
+CURRENT is switched to it. A running app notices the new pointer and swaps the
+snapshot in without a restart (see rag.start_kb_watcher). Without CURRENT the
+app serves the flat files in kb/ directly.
+
+  python ingest/kb_versions.py list
+  python ingest/kb_versions.py use <version>     # roll back / forward
+"""
+import argparse
+import datetime
+import os
+import pathlib
+import shutil
+
+KB_DIR = pathlib.Path("kb")
+VERSIONS_DIRNAME = "versions"
+CURRENT_FILENAME = "CURRENT"
+SERVED_FILES = ("index.faiss", "index_meta.bin", "index.bm25.npz", "embed_manifest.json", "kb_stats.json")
+REQUIRED_FILES = ("index.faiss", "index_meta.bin")
+KEEP_VERSIONS = 3
+
+
+def versions_dir(kb_dir=KB_DIR):
+    return pathlib.Path(kb_dir) / VERSIONS_DIRNAME
+
+
+def current_version(kb_dir=KB_DIR):
+    """Name of the served version, or None when kb/CURRENT does not exist."""
+    try:
+        name = (pathlib.Path(kb_dir) / CURRENT_FILENAME).read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        return None
+    return name or None
+
+
+def resolve_kb_dir(kb_dir=KB_DIR):
+    """(version name or None, directory holding the served files)."""
+    version = current_version(kb_dir)
+    if version is None:
+        return None, pathlib.Path(kb_dir)
+    return version, versions_dir(kb_dir) / version
+
+
+def list_versions(kb_dir=KB_DIR):
+    root = versions_dir(kb_dir)
+    if not root.exists():
+        return []
+    return sorted(p.name for p in root.iterdir() if p.is_dir() and not p.name.startswith("."))
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def set_current(version, kb_dir=KB_DIR):
+    kb_dir = pathlib.Path(kb_dir)
+    target = versions_dir(kb_dir) / version
+    missing = [name for name in REQUIRED_FILES if not (target / name).exists()]
+    if missing:
+        raise FileNotFoundError(f"KB version {version} is missing {', '.join(missing)}")
+    tmp_path = kb_dir / f".{CURRENT_FILENAME}.{os.getpid()}.tmp"
+    tmp_path.write_text(version + "\n", encoding="utf-8")
+    os.replace(tmp_path, kb_dir / CURRENT_FILENAME)
+
+
+def publish(kb_dir=KB_DIR, keep=KEEP_VERSIONS):
+    """Snapshot the freshly built files in kb_dir as a new version and make it current."""
+    kb_dir = pathlib.Path(kb_dir)
+    version = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    staging = versions_dir(kb_dir) / f".{version}.tmp"
+    staging.mkdir(parents=True)
+    for name in SERVED_FILES:
+        if (kb_dir / name).exists():
+            _link_or_copy(kb_dir / name, staging / name)
+    os.replace(staging, versions_dir(kb_dir) / version)
+    set_current(version, kb_dir)
+    prune(kb_dir, keep)
+    return version
+
+
+def prune(kb_dir=KB_DIR, keep=KEEP_VERSIONS):
+    """Delete all but the newest `keep` versions (never the current one)."""
+    current = current_version(kb_dir)
+    others = [v for v in list_versions(kb_dir) if v != current]
+    old = others[:max(0, len(others) - max(0, keep - 1))]
+    for version in old:
+        shutil.rmtree(versions_dir(kb_dir) / version, ignore_errors=True)
+    return old
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List or switch served knowledge-base versions")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list")
+    use = sub.add_parser("use")
+    use.add_argument("version")
+    parser.add_argument("--kb-dir", default=str(KB_DIR))
+    args = parser.parse_args()
+
+    if args.command == "use":
+        set_current(args.version, args.kb_dir)
+        print(f"Serving KB version {args.version}")
+        return
+    current = current_version(args.kb_dir)
+    for version in list_versions(args.kb_dir):
+        print(f"{'*' if version == current else ' '} {version}")
+    if current is None:
+        print("(no CURRENT pointer; the app serves the flat files in kb/)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""
+Compact, memory-mapped chunk metadata store (kb/index_meta.bin).
+
+Row i describes the vector with FAISS id i. Layout:
+
+  b"RAGMETA1" | uint64 header length | JSON header | 8-byte aligned arrays
+
+Column kinds:
+  - text      per-row UTF-8 strings: uint64 offsets[n + 1] + blob
+  - interned  repeated strings: uint32 codes[n] + string table (offsets + blob)
+  - int       int64[n]
+  - json      per-row JSON values stored like text (lists such as source_doc_ids)
+
+Opening the store only parses the header; rows are decoded on access, so
+startup cost and resident memory do not grow with the size of the KB.
+"""
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from array import array
+from pathlib import Path
+
+import numpy as np
+
+MAGIC = b"RAGMETA1"
+FORMAT_VERSION = 1
+ALIGNMENT = 8
+
+TEXT_COLUMNS = ("chunk_id", "section_id", "text")
+INTERNED_COLUMNS = ("doc_id", "source_path", "url", "title", "section_title", "section_path")
+INT_COLUMNS = ("token_count",)
+
+
+def _column_kind(name, value):
+    if name in TEXT_COLUMNS:
+        return "text"
+    if name in INTERNED_COLUMNS:
+        return "interned"
+    if name in INT_COLUMNS:
+        return "int"
+    if isinstance(value, bool):
+        return "json"
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, str):
+        return "text"
+    return "json"
+
+
+class _ColumnWriter:
+    def __init__(self, name, kind, rows_before, tmp_dir):
+        self.name = name
+        self.kind = kind
+        if kind in ("text", "json"):
+            self.offsets = array("Q", [0])
+            self.blob = tempfile.TemporaryFile(dir=tmp_dir)
+            self.size = 0
+        elif kind == "interned":
+            self.codes = array("I")
+            self.table = {}
+        else:
+            self.values = array("q")
+        # Backfill rows written before this column first appeared
+        for _ in range(rows_before):
+            self.missing()
+
+    def append(self, value):
+        if self.kind in ("text", "json"):
+            if self.kind == "json":
+                data = json.dumps(value, ensure_ascii=False).encode("utf-8")
+            else:
+                data = ("" if value is None else str(value)).encode("utf-8")
+            self.blob.write(data)
+            self.size += len(data)
+            self.offsets.append(self.size)
+        elif self.kind == "interned":
+            value = "" if value is None else str(value)
+            code = self.table.get(value)
+            if code is None:
+                code = self.table[value] = len(self.table)
+            self.codes.append(code)
+        else:
+            self.values.append(int(value or 0))
+
+    def missing(self):
+        self.append(None)
+
+    def arrays(self):
+        """Yield (array name, dtype, bytes or file) in file order."""
+        if self.kind in ("text", "json"):
+            self.blob.seek(0)
+            yield "offsets", "<u8", self.offsets.tobytes()
+            yield "data", "|u1", self.blob
+        elif self.kind == "interned":
+            strings = [s.encode("utf-8") for s in self.table]
+            table_offsets = array("Q", [0])
+            for s in strings:
+                table_offsets.append(table_offsets[-1] + len(s))
+            yield "codes", "<u4", self.codes.tobytes()
+            yield "table_offsets", "<u8", table_offsets.tobytes()
+            yield "table_data", "|u1", b"".join(strings)
+        else:
+            yield "values", "<i8", self.values.tobytes()
+
+
+class MetaStoreWriter:
+    """Streaming writer: rows are appended one at a time and laid out on close()."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.columns = {}
+        self.num_rows = 0
+
+    def append(self, row: dict):
+        for name, value in row.items():
+            if name not in self.columns:
+                kind = _column_kind(name, value)
+                self.columns[name] = _ColumnWriter(name, kind, self.num_rows, self.path.parent)
+        for name, column in self.columns.items():
+            if name in row:
+                column.append(row[name])
+            else:
+                column.missing()
+        self.num_rows += 1
+
+    def close(self):
+        sources = []
+        header_columns = []
+        position = 0
+        for column in self.columns.values():
+            arrays = {}
+            for array_name, dtype, source in column.arrays():
+                size = column.size if array_name == "data" else len(source)
+                position = _align(position)
+                arrays[array_name] = {"offset": position, "size": size, "dtype": dtype}
+                sources.append((position, source))
+                position += size
+            header_columns.append({"name": column.name, "kind": column.kind, "arrays": arrays})
+
+        header = json.dumps({
+            "version": FORMAT_VERSION,
+            "num_rows": self.num_rows,
+            "columns": header_columns,
+        }).encode("utf-8")
+        data_start = _align(len(MAGIC) + 8 + len(header))
+
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<Q", len(header)))
+            f.write(header)
+            for offset, source in sources:
+                f.write(b"\0" * (data_start + offset - f.tell()))
+                if isinstance(source, bytes):
+                    f.write(source)
+                else:
+                    shutil.copyfileobj(source, f)
+                    source.close()
+            f.write(b"\0" * (_align(f.tell()) - f.tell()))
+        os.replace(tmp_path, self.path)
+        return self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+
+def _align(position):
+    return (position + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_meta_store(path, rows):
+    """Write an iterable of chunk dicts to a metadata store at `path`."""
+    with MetaStoreWriter(path) as writer:
+        for row in rows:
+            writer.append(row)
+    return writer.num_rows
+
+
+class MetaStore:
+    """Read-only, memory-mapped view over a metadata store; behaves like a list of dicts."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{self.path} is not a chunk metadata store")
+        (header_len,) = struct.unpack_from("<Q", self._mm, len(MAGIC))
+        header_start = len(MAGIC) + 8
+        header = json.loads(self._mm[header_start:header_start + header_len])
+        if header["version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported metadata store version {header['version']} in {self.path}")
+        self._data_start = _align(header_start + header_len)
+        self.num_rows = header["num_rows"]
+        self.columns = {}
+        self._interned_cache = {}
+        for column in header["columns"]:
+            views = {name: self._view(spec) for name, spec in column["arrays"].items()}
+            self.columns[column["name"]] = (column["kind"], views)
+            if column["kind"] == "interned":
+                self._interned_cache[column["name"]] = {}
+
+    def _view(self, spec):
+        dtype = np.dtype(spec["dtype"])
+        if spec["size"] == 0:
+            return np.empty(0, dtype=dtype)
+        return np.frombuffer(
+            self._mm, dtype=dtype, count=spec["size"] // dtype.itemsize,
+            offset=self._data_start + spec["offset"],
+        )
+
+    def __len__(self):
+        return self.num_rows
+
+    def value(self, idx, name):
+        kind, views = self.columns[name]
+        if kind in ("text", "json"):
+            start, end = views["offsets"][idx], views["offsets"][idx + 1]
+            raw = views["data"][start:end].tobytes().decode("utf-8")
+            return json.loads(raw) if kind == "json" else raw
+        if kind == "interned":
+            code = int(views["codes"][idx])
+            cache = self._interned_cache[name]
+            value = cache.get(code)
+            if value is None:
+                start, end = views["table_offsets"][code], views["table_offsets"][code + 1]
+                value = cache[code] = views["table_data"][start:end].tobytes().decode("utf-8")
+            return value
+        return int(views["values"][idx])
+
+    def row(self, idx, columns=None):
+        """Materialize one row as a fresh dict (optionally only some columns)."""
+        idx = int(idx)
+        if idx < 0:
+            idx += self.num_rows
+        if not 0 <= idx < self.num_rows:
+            raise IndexError(f"row {idx} out of range for {self.num_rows} rows")
+        names = columns if columns is not None else self.columns
+        row = {}
+        for name in names:
+            value = self.value(idx, name)
+            # json columns hold None for rows that never had the field
+            if value is not None:
+                row[name] = value
+        return row
+
+    def __getitem__(self, idx):
+        return self.row(idx)
+
+    def __iter__(self):
+        for idx in range(self.num_rows):
+            yield self.row(idx)
+
+    def int_column(self, name):
+        """Zero-copy int64 view of an int column."""
+        kind, views = self.columns[name]
+        if kind != "int":
+            raise TypeError(f"column {name!r} is {kind}, not int")
+        return views["values"]
+
+    def interned_column(self, name):
+        """(zero-copy uint32 codes per row, list of distinct values) of an interned column."""
+        kind, views = self.columns[name]
+        if kind != "interned":
+            raise TypeError(f"column {name!r} is {kind}, not interned")
+        offsets, data = views["table_offsets"], views["table_data"]
+        values = [data[offsets[i]:offsets[i + 1]].tobytes().decode("utf-8") for i in range(len(offsets) - 1)]
+        return views["codes"], values
+
+    def close(self):
+        self.columns = {}
+        try:
+            self._mm.close()
+        except BufferError:
+            # Views handed out by int_column() are still alive; the map closes with them
+            pass
@@ -1,28 +1,40 @@
 """
-Clean preprocessing for RAG using LangChain splitters.
+Clean preprocessing for RAG.
 
 Pipeline:
 1) Parse markdown files + YAML frontmatter
-2) Split into sections with MarkdownHeaderTextSplitter
-3) Split sections into token-aware chunks with RecursiveCharacterTextSplitter
+2) Split into sections with LangChain's MarkdownHeaderTextSplitter
+3) Split sections into token-aware chunks with TokenChunker (token_chunker.py),
+   which tokenizes each section once and records token/char offsets per chunk
 4) Write JSONL artifacts:
    - kb/processed/sections.jsonl
    - kb/processed/chunks.jsonl
+
+Files are processed in a process pool and written in sorted path order as
+they complete. Each file's sections and chunks are cached under
+kb/processed/.cache keyed on its path, content hash, splitter parameters and
+chunker version, so unchanged files are not re-split on the next run.
 """
 from __future__ import annotations
 
 import argparse
+import hashlib
 import json
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import tiktoken
 import yaml
 import langchain_text_splitters
 
+from token_chunker import CHUNKER_VERSION, TokenChunker
+
 
 DEFAULT_RAW_DIR = Path(__file__).parent.parent / "kb" / "raw"
 DEFAULT_PROCESSED_DIR = Path(__file__).parent.parent / "kb" / "processed"
+CACHE_VERSION = 2  # bump when preprocess_file output changes for the same inputs
 
 
 def parse_args():
@@ -40,6 +52,9 @@ def parse_args():
         default="cl100k_base",
         help="Tokenizer encoding name for chunk sizing",
     )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Worker processes")
+    parser.add_argument("--cache_dir", default=None, help="Per-file cache directory (default <processed_dir>/.cache)")
+    parser.add_argument("--no_cache", action="store_true", help="Ignore and do not write the per-file cache")
     return parser.parse_args()
 
 
@@ -83,12 +98,7 @@ def build_splitters(chunk_size: int, chunk_overlap: int, encoding_name: str):
         headers_to_split_on=[("#", "h1"), ("##", "h2"), ("###", "h3")],
         strip_headers=False,
     )
-    chunk_splitter = langchain_text_splitters.RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-        encoding_name=encoding_name,
-        chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap,
-        separators=["\n\n", "\n", " ", ""],
-    )
+    chunk_splitter = TokenChunker(tiktoken.get_encoding(encoding_name), chunk_size, chunk_overlap)
     return section_splitter, chunk_splitter
 
 
@@ -99,7 +109,7 @@ def iter_markdown_files(raw_dir: Path):
     return files
 
 
-def preprocess_file(path: Path, raw_dir: Path, section_splitter, chunk_splitter, encoder):
+def preprocess_file(path: Path, raw_dir: Path, section_splitter, chunk_splitter):
     text = path.read_text(encoding="utf-8")
     fm_text, body = split_frontmatter_and_body(text)
     metadata = yaml.safe_load(fm_text) or {}
@@ -123,7 +133,7 @@ def preprocess_file(path: Path, raw_dir: Path, section_splitter, chunk_splitter,
         section_title, section_level = get_section_title(section_doc.metadata, title)
         section_path = get_section_path(section_doc.metadata, title)
         section_id = f"{doc_id}::section-{section_idx:03d}"
-        section_tokens = len(encoder.encode(section_text))
+        section_tokens, chunk_spans = chunk_splitter.split(section_text)
 
         sections.append(
             {
@@ -140,11 +150,7 @@ def preprocess_file(path: Path, raw_dir: Path, section_splitter, chunk_splitter,
             }
         )
 
-        chunk_docs = chunk_splitter.create_documents([section_text])
-        for chunk_idx, chunk_doc in enumerate(chunk_docs, start=1):
-            chunk_text = normalize_text(chunk_doc.page_content)
-            if not chunk_text:
-                continue
+        for chunk_idx, span in enumerate(chunk_spans, start=1):
             chunk_id = f"{section_id}::chunk-{chunk_idx:03d}"
             chunks.append(
                 {
@@ -156,19 +162,87 @@ def preprocess_file(path: Path, raw_dir: Path, section_splitter, chunk_splitter,
                     "title": title,
                     "section_title": section_title,
                     "section_path": section_path,
-                    "token_count": len(encoder.encode(chunk_text)),
-                    "text": chunk_text,
+                    "token_count": span["token_count"],
+                    "token_start": span["token_start"],
+                    "token_end": span["token_end"],
+                    "char_start": span["char_start"],
+                    "char_end": span["char_end"],
+                    "text": span["text"],
                 }
             )
 
     return sections, chunks
 
 
-def write_jsonl(path: Path, rows: list[dict]):
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("w", encoding="utf-8") as f:
-        for row in rows:
-            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+def cache_key(path: Path, raw_dir: Path, content: bytes, chunk_size: int, chunk_overlap: int, encoding_name: str) -> str:
+    # The file itself (resolved, so "kb/raw" and an absolute raw_dir share entries) and its doc_id are part of
+    # the key; process_path rewrites the cached rows' source_path to the path as given
+    key = {
+        "version": CACHE_VERSION,
+        "doc_id": str(path.relative_to(raw_dir)),
+        "source_path": str(path.resolve()),
+        "content_sha256": hashlib.sha256(content).hexdigest(),
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "encoding_name": encoding_name,
+        "chunker": CHUNKER_VERSION,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+# Per-process state, built once by init_worker so splitters are never pickled
+_worker = {}
+
+
+def init_worker(raw_dir: str, cache_dir, chunk_size: int, chunk_overlap: int, encoding_name: str):
+    section_splitter, chunk_splitter = build_splitters(chunk_size, chunk_overlap, encoding_name)
+    _worker.update(
+        raw_dir=Path(raw_dir),
+        cache_dir=Path(cache_dir) if cache_dir else None,
+        params=(chunk_size, chunk_overlap, encoding_name),
+        section_splitter=section_splitter,
+        chunk_splitter=chunk_splitter,
+    )
+
+
+def process_path(path_str: str):
+    """Worker entry point: (sections, chunks, cache_hit) for one markdown file."""
+    path = Path(path_str)
+    raw_dir = _worker["raw_dir"]
+    cache_dir = _worker["cache_dir"]
+    cache_file = None
+    if cache_dir is not None:
+        key = cache_key(path, raw_dir, path.read_bytes(), *_worker["params"])
+        cache_file = cache_dir / key[:2] / f"{key}.json"
+        if cache_file.exists():
+            cached = json.loads(cache_file.read_text(encoding="utf-8"))
+            for row in cached["sections"] + cached["chunks"]:
+                row["source_path"] = str(path)
+            return cached["sections"], cached["chunks"], True
+
+    sections, chunks = preprocess_file(
+        path,
+        raw_dir,
+        _worker["section_splitter"],
+        _worker["chunk_splitter"],
+    )
+    if cache_file is not None:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+        tmp_file.write_text(json.dumps({"sections": sections, "chunks": chunks}, ensure_ascii=False), encoding="utf-8")
+        tmp_file.replace(cache_file)
+    return sections, chunks, False
+
+
+def iter_processed(files: list[Path], workers: int, init_args: tuple):
+    """Yield per-file results in input order, in a process pool when workers > 1."""
+    paths = [str(f) for f in files]
+    if workers <= 1 or len(paths) <= 1:
+        init_worker(*init_args)
+        yield from map(process_path, paths)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=init_args) as pool:
+        yield from pool.map(process_path, paths, chunksize=max(1, len(paths) // (workers * 8)))
 
 
 def main():
@@ -177,38 +251,36 @@ def main():
     processed_dir = Path(args.processed_dir)
     sections_file = processed_dir / "sections.jsonl"
     chunks_file = processed_dir / "chunks.jsonl"
+    cache_dir = None if args.no_cache else Path(args.cache_dir or processed_dir / ".cache")
 
     if not raw_dir.exists():
         raise FileNotFoundError(f"Raw directory not found: {raw_dir}")
 
-    section_splitter, chunk_splitter = build_splitters(
-        chunk_size=args.chunk_size,
-        chunk_overlap=args.chunk_overlap,
-        encoding_name=args.encoding_name,
-    )
-    encoder = tiktoken.get_encoding(args.encoding_name)
-
-    all_sections = []
-    all_chunks = []
-    for md_file in iter_markdown_files(raw_dir):
-        sections, chunks = preprocess_file(
-            md_file,
-            raw_dir,
-            section_splitter,
-            chunk_splitter,
-            encoder,
-        )
-        all_sections.extend(sections)
-        all_chunks.extend(chunks)
-
-    write_jsonl(sections_file, all_sections)
-    write_jsonl(chunks_file, all_chunks)
-
-    print(f"Processed files: {len(iter_markdown_files(raw_dir))}")
-    print(f"Sections: {len(all_sections)} -> {sections_file}")
-    print(f"Chunks: {len(all_chunks)} -> {chunks_file}")
-    if all_chunks:
-        avg_tokens = sum(c["token_count"] for c in all_chunks) / len(all_chunks)
+    files = iter_markdown_files(raw_dir)
+    init_args = (str(raw_dir), str(cache_dir) if cache_dir else None, args.chunk_size, args.chunk_overlap, args.encoding_name)
+
+    processed_dir.mkdir(parents=True, exist_ok=True)
+    sections_tmp = sections_file.with_suffix(".jsonl.tmp")
+    chunks_tmp = chunks_file.with_suffix(".jsonl.tmp")
+    num_sections = num_chunks = chunk_tokens = cache_hits = 0
+    with sections_tmp.open("w", encoding="utf-8") as sections_out, chunks_tmp.open("w", encoding="utf-8") as chunks_out:
+        for sections, chunks, cache_hit in iter_processed(files, args.workers, init_args):
+            for row in sections:
+                sections_out.write(json.dumps(row, ensure_ascii=False) + "\n")
+            for row in chunks:
+                chunks_out.write(json.dumps(row, ensure_ascii=False) + "\n")
+            num_sections += len(sections)
+            num_chunks += len(chunks)
+            chunk_tokens += sum(c["token_count"] for c in chunks)
+            cache_hits += cache_hit
+    sections_tmp.replace(sections_file)
+    chunks_tmp.replace(chunks_file)
+
+    print(f"Processed files: {len(files)} ({cache_hits} from cache)")
+    print(f"Sections: {num_sections} -> {sections_file}")
+    print(f"Chunks: {num_chunks} -> {chunks_file}")
+    if num_chunks:
+        avg_tokens = chunk_tokens / num_chunks
         print(f"Avg chunk tokens: {avg_tokens:.1f}")
 
 
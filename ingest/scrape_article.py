@@ -41,21 +41,25 @@ def clean_markdown(markdown: str) -> str:
     return "\n".join(cleaned).strip()
 
 
-def fetch_markdown(url: str):
-    html = trafilatura.fetch_url(url)
-    if not html:
-        raise ValueError(f"Failed to fetch HTML from {url}")
-
+def markdown_from_html(html: str, source: str):
+    """(title, cleaned markdown) extracted from a page's HTML; `source` is only used in errors."""
     markdown = trafilatura.extract(html, output_format="markdown", include_tables=True,
                                    favor_precision=True)
     if not markdown:
-        raise ValueError(f"trafilatura returned empty content for {url}")
+        raise ValueError(f"trafilatura returned empty content for {source}")
 
     markdown = clean_markdown(markdown)
     title = extract_title(markdown)
     return title, markdown
 
 
+def fetch_markdown(url: str):
+    html = trafilatura.fetch_url(url)
+    if not html:
+        raise ValueError(f"Failed to fetch HTML from {url}")
+    return markdown_from_html(html, url)
+
+
 def build_frontmatter(url: str, title: str) -> str:
     return (
         f"---\n"
@@ -1,51 +1,72 @@
+"""
+Per-document KB statistics.
+
+embed.py writes them to kb/kb_stats.json next to the manifest (and publishes them
+with each KB version), so the app and this CLI load a small precomputed table
+instead of walking every chunk. Without that artifact (or with --recompute) the
+CLI falls back to computing them from kb/processed/chunks.jsonl. Section counts
+always come from the chunks' section_ids (sections with at least one chunk), so
+both paths agree.
+"""
+import argparse
 import json
+import os
 from pathlib import Path
 from collections import defaultdict
 
 CHUNKS_FILE = Path("kb/processed/chunks.jsonl")
-SECTIONS_FILE = Path("kb/processed/sections.jsonl")
+KB_DIR = Path("kb")
+STATS_FILE = KB_DIR / "kb_stats.json"
+STATS_VERSION = 1
 
 
-def compute_stats(chunks, sections=None):
-    """Pure function: chunks -> stats dict. Chunks from chunks.jsonl or index_meta.json.
-    If sections (list of section dicts with doc_id) is provided, use it for section count;
-    otherwise derive from unique section_id in chunks (sections with ≥1 chunk)."""
-    doc_stats = defaultdict(lambda: {"title": "Unknown", "section_count": 0, "chunks": 0, "chunk_tokens": []})
-    for c in chunks:
-        doc_id = c.get("doc_id", "unknown")
-        doc_stats[doc_id]["chunks"] += 1
-        doc_stats[doc_id]["chunk_tokens"].append(c.get("token_count", 0))
-        doc_stats[doc_id]["title"] = c.get("title", "Unknown")
-
-    if sections:
-        for s in sections:
-            doc_stats[s.get("doc_id", "unknown")]["section_count"] += 1
-    else:
-        section_ids_by_doc = defaultdict(set)
-        for c in chunks:
-            sid = c.get("section_id")
-            if sid:
-                section_ids_by_doc[c.get("doc_id", "unknown")].add(sid)
-        for doc_id, sids in section_ids_by_doc.items():
-            doc_stats[doc_id]["section_count"] = len(sids)
+class DocStatsBuilder:
+    """Per-document aggregates from one streaming pass over chunks (no per-chunk lists kept)."""
+
+    def __init__(self):
+        self.docs = {}
+        self._section_ids = defaultdict(set)
+
+    def add(self, chunk):
+        doc_id = chunk.get("doc_id", "unknown")
+        doc = self.docs.get(doc_id)
+        if doc is None:
+            doc = self.docs[doc_id] = {"title": "Unknown", "sections": 0, "chunks": 0, "total_tokens": 0, "max_tokens": 0}
+        tokens = chunk.get("token_count", 0)
+        doc["chunks"] += 1
+        doc["total_tokens"] += tokens
+        doc["max_tokens"] = max(doc["max_tokens"], tokens)
+        doc["title"] = chunk.get("title", "Unknown")
+        sid = chunk.get("section_id")
+        if sid:
+            self._section_ids[doc_id].add(sid)
+
+    def entries(self):
+        """{doc_id: entry}; section counts are the distinct section_ids seen in each document's chunks."""
+        for doc_id, sids in self._section_ids.items():
+            self.docs[doc_id]["sections"] = len(sids)
+        return self.docs
+
+
+def build_stats(docs):
+    """Stats dict (table rows + totals) from per-document entries; O(number of documents)."""
     rows = []
-    for doc_id, s in doc_stats.items():
-        toks = s["chunk_tokens"]
-        total_tok = sum(toks)
-        avg_tok = total_tok / len(toks) if toks else 0
+    for doc_id, d in docs.items():
         rows.append({
             "File": doc_id.split("/")[-1],
-            "Title": s["title"],
-            "Sections": s["section_count"],
-            "Chunks": s["chunks"],
-            "Total Tok": total_tok,
-            "Avg Tok/Chunk": round(avg_tok, 1),
-            "Max Tok": max(toks) if toks else 0,
+            "Title": d["title"],
+            "Sections": d["sections"],
+            "Chunks": d["chunks"],
+            "Total Tok": d["total_tokens"],
+            "Avg Tok/Chunk": round(d["total_tokens"] / d["chunks"], 1) if d["chunks"] else 0,
+            "Max Tok": d["max_tokens"],
         })
     rows.sort(key=lambda x: x["Total Tok"], reverse=True)
     total_chunks = sum(r["Chunks"] for r in rows)
     total_tokens = sum(r["Total Tok"] for r in rows)
     return {
+        "version": STATS_VERSION,
+        "docs": docs,
         "rows": rows,
         "total_docs": len(rows),
         "total_chunks": total_chunks,
@@ -54,19 +75,66 @@ def compute_stats(chunks, sections=None):
     }
 
 
+def compute_stats(chunks):
+    """Pure function: chunks -> stats dict. Chunks from chunks.jsonl or the index_meta.bin store.
+    Section counts are derived from unique section_id in chunks (sections with ≥1 chunk)."""
+    builder = DocStatsBuilder()
+    for c in chunks:
+        builder.add(c)
+    return build_stats(builder.entries())
+
+
+def diff_docs(previous, docs):
+    """{"added", "changed", "removed"} doc_ids between the `previous` stats and this build's `docs`."""
+    old_docs = (previous or {}).get("docs", {})
+    return {
+        "added": [doc_id for doc_id in docs if doc_id not in old_docs],
+        "changed": [doc_id for doc_id, entry in docs.items() if doc_id in old_docs and old_docs[doc_id] != entry],
+        "removed": [doc_id for doc_id in old_docs if doc_id not in docs],
+    }
+
+
+def load_stats(path=STATS_FILE):
+    """Persisted stats, or None when the artifact is missing or from another format version."""
+    try:
+        stats = json.loads(Path(path).read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return None
+    return stats if stats.get("version") == STATS_VERSION else None
+
+
+def save_stats(path, stats):
+    path = Path(path)
+    tmp_path = path.with_suffix(".json.tmp")
+    tmp_path.write_text(json.dumps(stats, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
 def load_jsonl(path):
     with open(path, "r", encoding="utf-8") as f:
         return [json.loads(line) for line in f]
 
 
+def served_stats_file(kb_dir=KB_DIR):
+    """kb_stats.json of the served KB version (kb/ itself when there is no CURRENT pointer)."""
+    import kb_versions  # sibling module; only needed by the CLI (Chat imports this file as ingest.stats)
+
+    _, directory = kb_versions.resolve_kb_dir(kb_dir)
+    return directory / STATS_FILE.name
+
+
 def main():
-    if not CHUNKS_FILE.exists():
-        print("Processed files not found. Run preprocess_kb.py first.")
-        return
+    parser = argparse.ArgumentParser(description="Print per-document KB statistics")
+    parser.add_argument("--recompute", action="store_true",
+                        help=f"Compute from {CHUNKS_FILE} instead of loading the persisted {STATS_FILE.name}")
+    args = parser.parse_args()
 
-    chunks_data = load_jsonl(CHUNKS_FILE)
-    sections_data = load_jsonl(SECTIONS_FILE) if SECTIONS_FILE.exists() else None
-    stats = compute_stats(chunks_data, sections=sections_data)
+    stats = None if args.recompute else load_stats(served_stats_file())
+    if stats is None:
+        if not CHUNKS_FILE.exists():
+            print("Processed files not found. Run preprocess_kb.py first.")
+            return
+        stats = compute_stats(load_jsonl(CHUNKS_FILE))
 
     # Print markdown table manually to avoid pandas dep
     headers = ["File", "Title", "Sections", "Chunks", "Total Tok", "Avg Tok/Chunk", "Max Tok"]
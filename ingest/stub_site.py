@@ -0,0 +1,188 @@
+"""
+Local stand-in website for exercising ingest/crawl.py.
+
+Serves HTML pages plus /sitemap.xml, answers conditional requests
+(If-None-Match / If-Modified-Since) with 304, and can add latency or inject
+429s. Pages come from a directory of .html files (URL path = file path without
+the suffix) or are generated:
+
+  python ingest/stub_site.py --port 8766 --generate 300 --delay 0.05
+  python ingest/crawl.py --sitemap http://127.0.0.1:8766/sitemap.xml --raw-dir /tmp/raw
+
+Or start it in-process with `serve(port=0, ...)`; `server.state.update(path, html)`
+changes a page so the next crawl refetches it.
+"""
+import argparse
+import email.utils
+import hashlib
+import pathlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+GENERATED_PREFIX = "/learn/system-design/generated"
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Local website stub for crawler testing")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8766)
+    p.add_argument("--pages-dir", help="Serve <pages-dir>/<path>.html at /<path>")
+    p.add_argument("--generate", type=int, default=0, help="Serve N generated article pages")
+    p.add_argument("--delay", type=float, default=0.0, help="Seconds to wait before answering each request")
+    p.add_argument("--rate-limit-every", type=int, default=0, help="Answer every Nth request with HTTP 429")
+    p.add_argument("--retry-after", type=float, default=1.0, help="retry-after seconds sent with 429s")
+    return p.parse_args()
+
+
+def generated_page(i):
+    paragraphs = "\n".join(
+        f"<p>Paragraph {j} of generated article {i}: sharding, replication and caching "
+        f"trade-offs discussed for scenario {i * 31 + j}.</p>"
+        for j in range(8)
+    )
+    return (
+        f"<html><head><title>Generated article {i}</title></head><body>"
+        f"<nav>Search</nav><article><h1>Generated article {i}</h1>\n{paragraphs}</article>"
+        f"<footer>Footer</footer></body></html>"
+    )
+
+
+def load_pages_dir(pages_dir):
+    root = pathlib.Path(pages_dir)
+    return {
+        "/" + path.relative_to(root).with_suffix("").as_posix(): path.read_text(encoding="utf-8", errors="ignore")
+        for path in sorted(root.rglob("*.html"))
+    }
+
+
+class SiteState:
+    def __init__(self, pages=None, delay=0.0, rate_limit_every=0, retry_after=1.0):
+        self.lock = threading.Lock()
+        self.pages = {}
+        self.delay = delay
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.requests = 0
+        self.not_modified = 0
+        self.rate_limited = 0
+        for path, html in (pages or {}).items():
+            self.update(path, html)
+
+    def update(self, path, html):
+        """Add or change a page; it gets a new ETag and Last-Modified."""
+        body = html.encode("utf-8")
+        with self.lock:
+            self.pages[path] = {
+                "body": body,
+                "etag": '"' + hashlib.sha256(body).hexdigest()[:16] + '"',
+                # HTTP dates have 1s resolution; never let an update look older than the last one
+                "modified": max(time.time(), self.pages.get(path, {}).get("modified", 0) + 1),
+            }
+
+    def sitemap(self, base_url):
+        with self.lock:
+            paths = sorted(self.pages)
+        urls = "".join(f"<url><loc>{escape(base_url + path)}</loc></url>" for path in paths)
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            f'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{urls}</urlset>'
+        ).encode("utf-8")
+
+    def admit(self):
+        with self.lock:
+            self.requests += 1
+            if self.rate_limit_every and self.requests % self.rate_limit_every == 0:
+                self.rate_limited += 1
+                return False
+            return True
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: SiteState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b"", content_type="text/html; charset=utf-8", headers=None):
+        self.send_response(status)
+        if status != 304:
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        state = self.state
+        time.sleep(state.delay)
+        if not state.admit():
+            self._send(429, b"rate limited", "text/plain", {"Retry-After": str(state.retry_after)})
+            return
+        path = self.path.split("?")[0]
+        if path == "/sitemap.xml":
+            host, port = self.server.server_address[:2]
+            self._send(200, state.sitemap(f"http://{host}:{port}"), "application/xml")
+            return
+        with state.lock:
+            page = state.pages.get(path.rstrip("/"))
+        if page is None:
+            self._send(404, b"not found", "text/plain")
+            return
+
+        headers = {"ETag": page["etag"], "Last-Modified": email.utils.formatdate(page["modified"], usegmt=True)}
+        if_none_match = self.headers.get("If-None-Match")
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_none_match is not None:
+            fresh = page["etag"] in [tag.strip() for tag in if_none_match.split(",")]
+        elif if_modified_since is not None:
+            since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            fresh = int(page["modified"]) <= since
+        else:
+            fresh = False
+        if fresh:
+            with state.lock:
+                state.not_modified += 1
+            self._send(304, headers=headers)
+            return
+        self._send(200, page["body"], headers=headers)
+
+
+def serve(host="127.0.0.1", port=0, **state_kwargs):
+    """Start the stub site in a daemon thread; returns the server (see server.state, server.server_address)."""
+    state = SiteState(**state_kwargs)
+    handler = type("BoundSiteHandler", (SiteHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    args = parse_args()
+    pages = load_pages_dir(args.pages_dir) if args.pages_dir else {}
+    for i in range(args.generate):
+        pages[f"{GENERATED_PREFIX}/article-{i:04d}"] = generated_page(i)
+    server = serve(
+        host=args.host,
+        port=args.port,
+        pages=pages,
+        delay=args.delay,
+        rate_limit_every=args.rate_limit_every,
+        retry_after=args.retry_after,
+    )
+    host, port = server.server_address[:2]
+    print(f"Stub site with {len(pages)} pages on http://{host}:{port} (sitemap: /sitemap.xml, Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
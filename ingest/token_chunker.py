@@ -0,0 +1,117 @@
+"""
+Single-pass token chunker used by preprocess_kb.py.
+
+Each section is BPE-encoded exactly once. Every token boundary is ranked by the
+separator it falls on ("\\n\\n" < "\\n" < " " < inside a word) using the
+character offsets from `decode_with_offsets`. A chunk then ends at the latest
+best-ranked boundary within `chunk_size` tokens, and the next chunk starts at the
+earliest separator boundary within the last `chunk_overlap` tokens. This is the
+same separator hierarchy RecursiveCharacterTextSplitter uses, without
+re-tokenizing every candidate split.
+
+Chunks carry their token and character offsets within the section text, so
+consumers (e.g. rag.pack_context) can compute overlaps without re-tokenizing.
+"""
+import numpy as np
+
+CHUNKER_VERSION = "token-v1"
+SEPARATORS = ("\n\n", "\n", " ")
+# Rank of a boundary that is not on any separator (split inside a word)
+NO_SEPARATOR = len(SEPARATORS)
+
+
+class TokenChunker:
+    def __init__(self, encoder, chunk_size: int, chunk_overlap: int):
+        if chunk_overlap >= chunk_size:
+            raise ValueError(f"chunk_overlap ({chunk_overlap}) must be smaller than chunk_size ({chunk_size})")
+        self.encoder = encoder
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+
+    @staticmethod
+    def _boundary_ranks(text: str, offsets: list[int]) -> np.ndarray:
+        """ranks[i] = separator rank of the boundary before token i (ranks[0] is unused).
+
+        A boundary at character c is on a separator when the separator ends at,
+        starts at or straddles c.
+        """
+        chars = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+        newline = np.pad(chars == ord("\n"), 2)
+        space = np.pad(chars == ord(" "), 2)
+        at = np.asarray(offsets, dtype=np.int64) + 2  # index of the char after each boundary in the padded arrays
+        before, before2, after, after2 = at - 1, at - 2, at, at + 1
+
+        paragraph = (newline[before] & newline[before2]) | (newline[after] & newline[after2]) | (newline[before] & newline[after])
+        line = newline[before] | newline[after]
+        word = space[before] | space[after]
+
+        ranks = np.full(len(offsets) + 1, NO_SEPARATOR, dtype=np.int8)
+        ranks[:-1][word] = 2
+        ranks[:-1][line] = 1
+        ranks[:-1][paragraph] = 0
+        ranks[len(offsets)] = 0
+        return ranks
+
+    def split(self, text: str) -> tuple[int, list[dict]]:
+        """(token count of `text`, chunks) with text, token_count and token/char offsets per chunk."""
+        tokens = self.encoder.encode_ordinary(text)
+        num_tokens = len(tokens)
+        if not num_tokens:
+            return 0, []
+        decoded, offsets = self.encoder.decode_with_offsets(tokens)
+        if decoded != text:
+            raise ValueError("Tokenizer round trip changed the text; cannot map token offsets")
+        char_at = offsets + [len(text)]
+        ranks = self._boundary_ranks(text, offsets)
+
+        chunks = []
+        start = previous_end = 0
+        while start < num_tokens:
+            limit = min(num_tokens, start + self.chunk_size)
+            if limit == num_tokens:
+                end = num_tokens
+            else:
+                # Always end past the previous chunk so overlapping chunks never repeat it
+                first = max(start, previous_end) + 1
+                window = ranks[first:limit + 1]
+                best = window.min()
+                end = first + int(np.flatnonzero(window == best)[-1])
+            previous_end = end
+
+            chunk = self._make_chunk(text, char_at, start, end)
+            # Skip a chunk that only adds whitespace to its predecessor
+            if chunk is not None and (not chunks or chunk["token_end"] > chunks[-1]["token_end"]):
+                chunks.append(chunk)
+            if end == num_tokens:
+                break
+
+            # Start the next chunk on the best boundary inside the overlap window
+            lo = max(start + 1, end - self.chunk_overlap)
+            if lo >= end:
+                start = end
+                continue
+            window = ranks[lo:end]
+            candidates = np.flatnonzero(window < NO_SEPARATOR)
+            start = lo + int(candidates[0] if len(candidates) else 0)
+        return num_tokens, chunks
+
+    @staticmethod
+    def _make_chunk(text, char_at, start, end):
+        # Drop whitespace-only tokens at the edges so offsets match the stripped text
+        while start < end and not text[char_at[start]:char_at[start + 1]].strip():
+            start += 1
+        while end > start and not text[char_at[end - 1]:char_at[end]].strip():
+            end -= 1
+        if start == end:
+            return None
+        raw = text[char_at[start]:char_at[end]]
+        char_start = char_at[start] + (len(raw) - len(raw.lstrip()))
+        char_end = char_at[end] - (len(raw) - len(raw.rstrip()))
+        return {
+            "text": text[char_start:char_end],
+            "token_count": end - start,
+            "token_start": start,
+            "token_end": end,
+            "char_start": char_start,
+            "char_end": char_end,
+        }
@@ -0,0 +1,225 @@
+"""
+Per-stage latency instrumentation for the RAG pipeline.
+
+  - span("index_search") times a block into the rag_stage_seconds histogram
+  - trace("chat") groups the spans of one request; Chat.py renders them and, if
+    RAG_TRACE_FILE is set, each finished trace is appended to that JSONL file
+    (rotated to <file>.1 past RAG_TRACE_FILE_MAX_MB, so at most twice that on disk)
+  - start_http_server(port) exports everything in Prometheus text format at /metrics
+"""
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TRACE_FILE = os.environ.get("RAG_TRACE_FILE")
+TRACE_FILE_MAX_BYTES = int(float(os.environ.get("RAG_TRACE_FILE_MAX_MB", "64")) * 1024 ** 2)
+
+_current_trace = contextvars.ContextVar("rag_trace", default=None)
+_trace_file_lock = threading.Lock()
+
+
+class Histogram:
+    """Cumulative-bucket histogram (Prometheus style) with a running sum and count."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+                    break
+            else:
+                self._counts[-1] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        """{upper bound: cumulative count} including '+Inf', plus sum and count."""
+        with self._lock:
+            cumulative, running = {}, 0
+            for bound, n in zip((*self.buckets, "+Inf"), self._counts):
+                running += n
+                cumulative[bound] = running
+            return {"buckets": cumulative, "sum": self.sum, "count": self.count}
+
+
+class Trace:
+    """Spans recorded for one request."""
+
+    def __init__(self, name, **attrs):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.attrs = attrs
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.spans = []
+        self.total_s = None
+
+    def add(self, stage, seconds, start=None):
+        offset = (start if start is not None else time.perf_counter() - seconds) - self._start
+        self.spans.append({"stage": stage, "seconds": seconds, "offset_s": max(0.0, offset)})
+
+    def breakdown(self):
+        """Total seconds per stage, in order of first appearance."""
+        totals = {}
+        for s in self.spans:
+            totals[s["stage"]] = totals.get(s["stage"], 0.0) + s["seconds"]
+        return totals
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "total_s": self.total_s,
+            "attrs": self.attrs,
+            "spans": self.spans,
+        }
+
+
+_stage_histograms = {}
+_stage_lock = threading.Lock()
+_collectors = []
+
+
+def _stage_histogram(stage):
+    with _stage_lock:
+        histogram = _stage_histograms.get(stage)
+        if histogram is None:
+            histogram = _stage_histograms[stage] = Histogram(STAGE_BUCKETS)
+        return histogram
+
+
+def record(stage, seconds, start=None):
+    """Record a finished stage into its histogram and the current trace, if any."""
+    _stage_histogram(stage).observe(seconds)
+    current = _current_trace.get()
+    if current is not None:
+        current.add(stage, seconds, start)
+
+
+@contextlib.contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start, start)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextlib.contextmanager
+def trace(name, **attrs):
+    """Collect spans for one request; appended to RAG_TRACE_FILE when it finishes."""
+    request_trace = Trace(name, **attrs)
+    token = _current_trace.set(request_trace)
+    try:
+        yield request_trace
+    finally:
+        _current_trace.reset(token)
+        request_trace.total_s = time.perf_counter() - request_trace._start
+        record(f"{name}_total", request_trace.total_s)
+        if TRACE_FILE:
+            _append_trace(json.dumps(request_trace.to_dict()))
+
+
+def _append_trace(line):
+    with _trace_file_lock:
+        try:
+            if os.path.getsize(TRACE_FILE) >= TRACE_FILE_MAX_BYTES:
+                os.replace(TRACE_FILE, TRACE_FILE + ".1")
+        except FileNotFoundError:
+            pass
+        with open(TRACE_FILE, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+async def traced(coro, request_trace):
+    """Await `coro` with `request_trace` as the current trace (for work on another loop/thread)."""
+    token = _current_trace.set(request_trace)
+    try:
+        return await coro
+    finally:
+        _current_trace.reset(token)
+
+
+def register_collector(collect):
+    """Register a callable returning [(name, type, help, [(labels, value or Histogram)])]."""
+    _collectors.append(collect)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{str(v)}"' for k, v in labels.items()) + "}"
+
+
+def _render_family(lines, name, kind, help_text, samples):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+    for labels, value in samples:
+        if isinstance(value, Histogram):
+            snap = value.snapshot()
+            for bound, count in snap["buckets"].items():
+                lines.append(f"{name}_bucket{_labels({**labels, 'le': bound})} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {snap['sum']}")
+            lines.append(f"{name}_count{_labels(labels)} {snap['count']}")
+        else:
+            lines.append(f"{name}{_labels(labels)} {value}")
+
+
+def render_prometheus():
+    lines = []
+    with _stage_lock:
+        stages = sorted(_stage_histograms.items())
+    _render_family(
+        lines, "rag_stage_seconds", "histogram", "Latency of RAG pipeline stages in seconds",
+        [({"stage": stage}, histogram) for stage, histogram in stages],
+    )
+    for collect in _collectors:
+        for name, kind, help_text, samples in collect():
+            _render_family(lines, name, kind, help_text, samples)
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] == "/metrics":
+            body = render_prometheus().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path.split("?")[0] == "/health":
+            body, content_type = b"ok\n", "text/plain"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_http_server(port, host="0.0.0.0"):
+    """Serve /metrics (Prometheus text format) from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="rag-metrics", daemon=True).start()
+    return server
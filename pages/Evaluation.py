@@ -7,7 +7,9 @@ import pandas as pd
 import streamlit as st
 from dotenv import load_dotenv
 
-from evaluation.eval import evaluate_answer, evaluate_retrieval_with_details, load_tests
+import rag
+from evaluation.eval import evaluate_retrieval_batch, keyword_hit_matrix, load_tests
+from evaluation.runner import DEFAULT_CONCURRENCY, iter_answer_eval, summarize
 
 load_dotenv(override=True)
 
@@ -112,6 +114,9 @@ st.header("🔍 Retrieval Evaluation")
 # Load existing results
 retrieval_data = load_results(RETRIEVAL_RESULTS_FILE)
 
+retrieval_mode = st.radio("Retrieval mode", rag.RETRIEVAL_MODES, horizontal=True)
+rerank_results = st.checkbox("Rerank with cross-encoder", value=False)
+
 if st.button("Run Retrieval Evaluation", type="primary"):
     if not selected_tests:
         st.warning("Select at least one test in the table.")
@@ -127,8 +132,11 @@ if st.button("Run Retrieval Evaluation", type="primary"):
         with st.status("Running retrieval evaluation...", expanded=True) as status:
             progress_bar = st.progress(0)
 
-            for i, test in enumerate(selected_tests, start=1):
-                result, retrieved_docs = evaluate_retrieval_with_details(test, k=5)
+            status.write(f"Retrieving {len(selected_tests)} questions in one batch...")
+            batch_results = evaluate_retrieval_batch(
+                selected_tests, k=5, mode=retrieval_mode, rerank_results=rerank_results
+            )
+            for i, (test, (result, retrieved_docs)) in enumerate(zip(selected_tests, batch_results), start=1):
                 prog_value = i / len(selected_tests)
                 count += 1
                 total_mrr += result.mrr
@@ -179,7 +187,9 @@ if st.button("Run Retrieval Evaluation", type="primary"):
                     "mrr": avg_mrr,
                     "ndcg": avg_ndcg,
                     "coverage": avg_coverage,
-                    "count": count
+                    "count": count,
+                    "mode": retrieval_mode,
+                    "rerank": rerank_results,
                 },
                 "category_data": category_data,
                 "per_test": per_test_rows
@@ -200,7 +210,7 @@ if retrieval_data:
     with col3:
         metric_card("Keyword Coverage", metrics["coverage"], "coverage", is_percentage=True)
         
-    st.caption(f"Last run: {metrics['count']} tests evaluated")
+    st.caption(f"Last run: {metrics['count']} tests evaluated ({metrics.get('mode', 'dense')} retrieval{', reranked' if metrics.get('rerank') else ''})")
     
     with st.expander("Retrieval Chart", expanded=False):
         df = pd.DataFrame(retrieval_data["category_data"])
@@ -230,9 +240,9 @@ if retrieval_data:
             selected = per_test[selected_idx]
             st.markdown(f"**Expected keywords:** `{'`, `'.join(selected.get('keywords', []))}`")
             st.markdown("**Retrieved chunks:**")
-            for i, chunk in enumerate(selected.get("retrieved_chunks", []), 1):
-                kws = [kw.lower() for kw in selected.get("keywords", [])]
-                hit = any(kw in chunk["text"].lower() for kw in kws)
+            chunks = selected.get("retrieved_chunks", [])
+            chunk_hits = keyword_hit_matrix(selected.get("keywords", []), [c["text"] for c in chunks]).any(axis=0)
+            for i, (chunk, hit) in enumerate(zip(chunks, chunk_hits), 1):
                 icon = "✅" if hit else "❌"
                 with st.expander(f"{icon} #{i} — {chunk['title']} › {chunk['section_title']}  (score: {chunk['score']})"):
                     st.caption(chunk["doc_id"])
@@ -248,88 +258,56 @@ st.header("💬 Answer Evaluation")
 # Load existing results
 answer_data = load_results(ANSWER_RESULTS_FILE)
 
+concurrency_col, resume_col = st.columns(2)
+with concurrency_col:
+    answer_concurrency = st.slider("Concurrent tests", 1, 32, DEFAULT_CONCURRENCY)
+with resume_col:
+    resume_answers = st.checkbox(
+        "Resume from checkpoint",
+        value=True,
+        help="Skip tests already evaluated with the same model, k and KB build",
+    )
+
 if st.button("Run Answer Evaluation", type="primary"):
     if not selected_tests:
         st.warning("Select at least one test in the table.")
         st.stop()
-    total_accuracy = 0.0
-    total_completeness = 0.0
-    total_relevance = 0.0
-    category_accuracy = defaultdict(list)
-    count = 0
 
     per_test_rows = []
+    failures = []
     try:
         with st.status("Running answer evaluation...", expanded=True) as status:
             progress_bar = st.progress(0)
-
-            for i, test in enumerate(selected_tests, start=1):
-                result, generated_answer, retrieved_docs = evaluate_answer(test)
-                prog_value = i / len(selected_tests)
-                count += 1
-                total_accuracy += result.accuracy
-                total_completeness += result.completeness
-                total_relevance += result.relevance
-
-                category_accuracy[test.category].append(result.accuracy)
-                per_test_rows.append({
-                    "question": test.question,
-                    "category": test.category,
-                    "keywords": test.keywords,
-                    "accuracy": round(result.accuracy, 2),
-                    "completeness": round(result.completeness, 2),
-                    "relevance": round(result.relevance, 2),
-                    "generated_answer": generated_answer,
-                    "reference_answer": test.reference_answer,
-                    "judge_feedback": result.feedback,
-                    "retrieved_chunks": [
-                        {
-                            "title": doc.get("title", ""),
-                            "section_title": doc.get("section_title", ""),
-                            "doc_id": doc.get("doc_id", ""),
-                            "score": round(doc.get("score", 0), 4),
-                            "text": doc.get("text", ""),
-                        }
-                        for doc in retrieved_docs
-                    ],
-                })
-                
-                # Update status
-                status.write(f"Evaluating: {test.question[:60]}...")
-                progress_bar.progress(prog_value)
+            progress_text = st.empty()
+
+            for event in iter_answer_eval(selected_tests, concurrency=answer_concurrency, resume=resume_answers):
+                if event["type"] in ("resumed", "result"):
+                    per_test_rows.append(event["row"])
+                elif event["type"] == "error":
+                    failures.append(event)
+                    status.write(f"Failed: {event['question'][:60]}... ({event['error']})")
+
+                limits = event["rate_limit"]
+                progress_text.caption(
+                    f"{event['done']}/{event['total']} evaluated · "
+                    f"{limits['requests_per_minute']:.0f} req/min, {limits['tokens_per_minute']:,.0f} tok/min · "
+                    f"{limits['rate_limited']} rate-limited, {limits['waited_s']}s throttled across tests"
+                )
+                progress_bar.progress(event["done"] / event["total"] if event["total"] else 1.0)
 
             progress_bar.empty()
             status.update(label="Answer Evaluation Complete!", state="complete", expanded=False)
 
-        if count > 0:
-            avg_accuracy = total_accuracy / count
-            avg_completeness = total_completeness / count
-            avg_relevance = total_relevance / count
-
-            # Prepare data for saving/display
-            category_data = []
-            for category, accuracy_scores in category_accuracy.items():
-                avg_cat_accuracy = sum(accuracy_scores) / len(accuracy_scores)
-                category_data.append({"Category": category, "Average Accuracy": avg_cat_accuracy})
-                
-            answer_data = {
-                "metrics": {
-                    "accuracy": avg_accuracy,
-                    "completeness": avg_completeness,
-                    "relevance": avg_relevance,
-                    "count": count
-                },
-                "category_data": category_data,
-                "per_test": per_test_rows
-            }
+        if failures:
+            st.warning(f"{len(failures)} tests failed; rerun with resume to retry only those.")
+        if per_test_rows:
+            answer_data = summarize(per_test_rows)
             save_results(answer_data, ANSWER_RESULTS_FILE)
-            st.rerun()
-            
-    except openai.RateLimitError:
-        st.error("⚠️ OpenAI API Quota Exceeded. Please check your billing details or try again later.")
-        # Save partial results if any
-        if count > 0:
-             st.warning(f"Evaluation stopped early. Saved results for {count} tests.")
+            if not failures:
+                st.rerun()
+
+    except openai.AuthenticationError:
+        st.error("⚠️ OpenAI API key rejected. Finished tests are kept in the checkpoint.")
     except Exception as e:
         st.error(f"An error occurred during answer evaluation: {str(e)}")
 
@@ -1,107 +1,992 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
 import json
+import re
 import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+import weakref
 from pathlib import Path
 import faiss
+import httpx
 import numpy as np
 import sentence_transformers
 import openai
 import dotenv
 
+import metrics
+from ingest.ann_index import apply_search_params
+from ingest.bm25 import BM25Index
+from ingest import kb_versions
+from ingest.embed_store import DEFAULT_PATH as EMBED_STORE_PATH, EmbeddingStore, content_hash
+from ingest.meta_store import MetaStore
+from ingest.stats import compute_stats, load_stats
+
 # Config
 BASE_DIR = Path(__file__).parent
-INDEX_FILE = BASE_DIR / "kb/index.faiss"
-META_FILE = BASE_DIR / "kb/index_meta.json"
-EMBED_CONFIG_FILE = BASE_DIR / "kb/embed_manifest.json"
+KB_DIR = BASE_DIR / "kb"  # serves kb/versions/<CURRENT>/ when kb/CURRENT exists, else these flat files
+INDEX_FILE = KB_DIR / "index.faiss"
+META_FILE = KB_DIR / "index_meta.bin"
+SPARSE_INDEX_FILE = KB_DIR / "index.bm25.npz"
+EMBED_CONFIG_FILE = KB_DIR / "embed_manifest.json"
+KB_STATS_FILE = KB_DIR / "kb_stats.json"
 MODEL_NAME = 'mixedbread-ai/mxbai-embed-large-v1'
+QUERY_PREFIX = "Represent this sentence for searching relevant passages: "
+
+# Hot reload
+KB_RELOAD_INTERVAL_S = 5.0  # how often the watcher checks kb/CURRENT and the manifest
+
+# Query vector cache
+QUERY_CACHE_SIZE = 2048
+QUERY_CACHE_TTL = 7 * 24 * 3600  # seconds; None disables expiry
+QUERY_CACHE_STORE = BASE_DIR / EMBED_STORE_PATH  # shared with ingest/embed.py; None disables the on-disk tier
+
+# Query encoder micro-batching
+ENCODE_BATCH_WAIT_S = 0.005  # how long the first request waits for company; 0 disables batching
+ENCODE_MAX_BATCH = 32
+
+# Hybrid retrieval
+RETRIEVAL_MODES = ["dense", "hybrid"]
+RRF_K = 60  # reciprocal rank fusion damping constant
+HYBRID_FETCH_K = 50  # candidates taken from each retriever before fusion
+
+# Cross-encoder reranking
+RERANK_MODEL_NAME = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+RERANK_CANDIDATES = 20  # over-fetched candidates scored by the cross-encoder
+RERANK_BUDGET_S = 1.0  # CPU time allowed for scoring before falling back to the first-stage order
+RERANK_CACHE_SIZE = 20000
+
+# Context packing
+CONTEXT_TOKEN_BUDGET = 3000  # total tokens of retrieved text sent to the LLM
+SOURCE_HEADER_TOKENS = 12  # rough cost of each "Source N (title):" line
+CHARS_PER_TOKEN = 4  # fallback estimate when a chunk has no token_count
+
+# Async generation
+LLM_DEADLINE_S = 90.0  # whole answer, including retries and streaming
+LLM_MAX_RETRIES = 4
+LLM_BACKOFF_BASE_S = 0.5
+LLM_BACKOFF_MAX_S = 10.0
+LLM_HEDGE_MODEL = "gpt-3.5-turbo"
+LLM_HEDGE_AFTER_S = 3.0  # start the hedged request if no token arrived by then
+LLM_POOL_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=16, keepalive_expiry=60)
+LLM_RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
 
 # Global state
-_index = None
-_chunks = None
+_kb = None  # current KnowledgeBase snapshot; replaced whole, never mutated
+_kb_lock = threading.Lock()
+_kb_watcher = None
+_kb_reloads = 0
+_kb_reload_failures = 0
+_kb_failed_signature = None  # don't retry (and re-log) a broken publish until it changes
 _embed_model = None
+_embed_model_lock = threading.Lock()
+_encode_batcher = None
+_encode_batcher_lock = threading.Lock()
+_reranker = None
+_reranker_lock = threading.Lock()
+_rerank_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="rag-rerank")
+_search_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="rag-search")
+_async_clients = weakref.WeakKeyDictionary()  # one pooled client per event loop
+_llm_response_observers = []  # callables given every httpx.Response of the async client (e.g. rate-limit headers)
+_loop = None
+_loop_lock = threading.Lock()
 
-def load_resources():
-    """Load and cache resources (FAISS index, chunks, embedding model)."""
-    global _index, _chunks, _embed_model
-    if _index is not None:
-        return _index, _chunks, _embed_model
 
-    if not INDEX_FILE.exists() or not META_FILE.exists():
+class LRUCache:
+    """Thread-safe LRU cache with optional TTL and hit/miss/eviction counters."""
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, stored_at = entry
+            if self.ttl is not None and time.time() - stored_at > self.ttl:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class QueryVectorCache:
+    """Normalized query vectors keyed by content hash of (model name, exact encoder input).
+
+    Lookups go to an in-memory LRU first and then, if `store_path` is set, to the
+    embedding store shared with ingest/embed.py, so repeat questions survive restarts.
+    """
+
+    def __init__(self, max_size=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL, store_path=None):
+        self.memory = LRUCache(max_size, ttl=ttl)
+        self.store_path = Path(store_path) if store_path else None
+        self._store = None
+        self._lock = threading.Lock()
+        self.disk_hits = 0
+        self.disk_errors = 0
+
+    @staticmethod
+    def key(model_name, query):
+        return content_hash(model_name, QUERY_PREFIX + normalize_query(query))
+
+    def _get_store(self):
+        if self._store is None and self.store_path is not None:
+            with self._lock:
+                if self._store is None and self.store_path is not None:
+                    try:
+                        self._store = EmbeddingStore(self.store_path)
+                    except (sqlite3.Error, OSError):
+                        # Read-only or broken cache volume: run memory-only
+                        self.disk_errors += 1
+                        self.store_path = None
+        return self._store
+
+    def get(self, model_name, query):
+        key = self.key(model_name, query)
+        vector = self.memory.get(key)
+        store = self._get_store() if vector is None else None
+        if store is None:
+            return vector
+
+        try:
+            vector = store.get(key)
+        except sqlite3.Error:
+            with self._lock:
+                self.disk_errors += 1
+            return None
+        if vector is None:
+            return None
+        with self._lock:
+            self.disk_hits += 1
+        self.memory.put(key, vector)
+        return vector
+
+    def put(self, model_name, query, vector):
+        key = self.key(model_name, query)
+        vector = np.array(vector, dtype=np.float32)
+        vector.flags.writeable = False
+        self.memory.put(key, vector)
+        store = self._get_store()
+        if store is None:
+            return
+        try:
+            store.put(model_name, key, vector)
+        except sqlite3.Error:
+            with self._lock:
+                self.disk_errors += 1
+
+    def clear(self):
+        self.memory.clear()
+
+    def stats(self):
+        stats = self.memory.stats()
+        with self._lock:
+            stats["disk_hits"] = self.disk_hits
+            stats["disk_errors"] = self.disk_errors
+        stats["store"] = str(self.store_path) if self.store_path else None
+        return stats
+
+
+query_cache = QueryVectorCache(store_path=QUERY_CACHE_STORE)
+
+
+class QueryEncodeBatcher:
+    """Coalesces concurrent query-encode requests into batched encode() calls.
+
+    A worker thread takes the first waiting request, keeps collecting for up to
+    `max_wait_s` or until `max_batch` texts are queued, runs one forward pass and
+    hands each caller its row.
+    """
+
+    SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+    def __init__(self, embed_model, max_wait_s=ENCODE_BATCH_WAIT_S, max_batch=ENCODE_MAX_BATCH):
+        self.embed_model = embed_model
+        self.max_wait_s = max_wait_s
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self.batch_sizes = metrics.Histogram(self.SIZE_BUCKETS)
+        self.queue_depths = metrics.Histogram((0, *self.SIZE_BUCKETS))
+        self._worker = threading.Thread(target=self._run, name="rag-encode-batcher", daemon=True)
+        self._worker.start()
+
+    def encode(self, texts):
+        """Encode texts (blocking); returns an (n, d) float32 array, not normalized."""
+        futures = []
+        for text in texts:
+            future = concurrent.futures.Future()
+            self._queue.put((text, future))
+            futures.append(future)
+        return np.vstack([f.result() for f in futures]).astype(np.float32, copy=False)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait_s
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            self.queue_depths.observe(self._queue.qsize())
+            self.batch_sizes.observe(len(batch))
+            try:
+                vectors = self.embed_model.encode([text for text, _ in batch], convert_to_numpy=True)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), vector in zip(batch, np.asarray(vectors, dtype=np.float32)):
+                future.set_result(vector)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth(),
+            "batch_size": self.batch_sizes.snapshot(),
+            "queue_depth_at_dispatch": self.queue_depths.snapshot(),
+        }
+
+
+def get_encode_batcher(embed_model):
+    """The micro-batcher bound to `embed_model`, created on first use."""
+    global _encode_batcher
+    with _encode_batcher_lock:
+        if _encode_batcher is None or _encode_batcher.embed_model is not embed_model:
+            _encode_batcher = QueryEncodeBatcher(embed_model)
+    return _encode_batcher
+
+
+rerank_cache = LRUCache(RERANK_CACHE_SIZE, ttl=QUERY_CACHE_TTL)
+rerank_fallbacks = 0
+
+
+def normalize_query(query):
+    """Collapse whitespace so trivially different spellings share a cache entry."""
+    return " ".join(query.split())
+
+class KnowledgeBase:
+    """One immutable, fully loaded KB version: index, chunk metadata, sparse index, manifest.
+
+    Requests take a reference to the current snapshot and use it throughout, so a
+    reload swapping in a new version never mixes index ids from one build with
+    metadata from another.
+    """
+
+    def __init__(self, version, directory, index, chunks, sparse_index, manifest, signature, stats=None):
+        self.version = version
+        self.directory = directory
+        self.index = index
+        self.chunks = chunks
+        self.sparse_index = sparse_index
+        self.manifest = manifest
+        self.signature = signature
+        self.loaded_at = time.time()
+        self._stats = stats
+        self._stats_lock = threading.Lock()
+
+    @property
+    def stats(self):
+        """Per-document stats persisted by embed.py; computed once from the chunks for older builds."""
+        if self._stats is None:
+            with self._stats_lock:
+                if self._stats is None:
+                    self._stats = compute_stats(self.chunks)
+        return self._stats
+
+    def __repr__(self):
+        return f"KnowledgeBase(version={self.version!r}, chunks={len(self.chunks)})"
+
+
+def _kb_signature(kb_dir=None):
+    """(served version, manifest mtime/size): changes whenever a new build is published."""
+    version, directory = kb_versions.resolve_kb_dir(kb_dir or KB_DIR)
+    try:
+        stat = (directory / EMBED_CONFIG_FILE.name).stat()
+        manifest_state = (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        manifest_state = None
+    return version, str(directory), manifest_state
+
+def load_knowledge_base(kb_dir=None):
+    """Load the served KB version into a new KnowledgeBase without touching the current one."""
+    kb_dir = kb_dir or KB_DIR
+    signature = _kb_signature(kb_dir)
+    version, directory = kb_versions.resolve_kb_dir(kb_dir)
+    index_file = directory / INDEX_FILE.name
+    meta_file = directory / META_FILE.name
+    sparse_file = directory / SPARSE_INDEX_FILE.name
+    manifest_file = directory / EMBED_CONFIG_FILE.name
+    if not index_file.exists() or not meta_file.exists():
         raise FileNotFoundError("Knowledge base not found. Run ingest pipeline first.")
 
     # Check manifest
-    if EMBED_CONFIG_FILE.exists():
-        embed_manifest = json.loads(EMBED_CONFIG_FILE.read_text())
+    embed_manifest = {}
+    if manifest_file.exists():
+        embed_manifest = json.loads(manifest_file.read_text())
         if embed_manifest["model"] != MODEL_NAME:
              raise RuntimeError(f"Model mismatch: index was built with '{embed_manifest['model']}' but app is configured to use '{MODEL_NAME}'.")
 
-    print("Loading FAISS index...")
-    _index = faiss.read_index(str(INDEX_FILE))
+    print(f"Loading FAISS index ({version or 'kb/'})...")
+    with metrics.span("load_index"):
+        index = faiss.read_index(str(index_file))
+        search_params = embed_manifest.get("index", {}).get("search_params", {})
+        if search_params:
+            print(f"Applying search parameters: {search_params}")
+            apply_search_params(index, search_params)
     
     print("Loading metadata...")
-    with open(META_FILE, "r", encoding="utf-8") as f:
-        _chunks = json.load(f)
-        
-    print("Loading embedding model...")
-    _embed_model = sentence_transformers.SentenceTransformer(MODEL_NAME)
-    
-    # Load OpenAI key
+    with metrics.span("load_metadata"):
+        chunks = MetaStore(meta_file)
+    if len(chunks) != index.ntotal:
+        raise RuntimeError(f"{meta_file} has {len(chunks)} rows but {index_file} has {index.ntotal} vectors.")
+
+    sparse_index = None
+    if sparse_file.exists():
+        print("Loading sparse BM25 index...")
+        with metrics.span("load_sparse_index"):
+            sparse_index = BM25Index.load(sparse_file)
+
+    stats = load_stats(directory / KB_STATS_FILE.name)
+    if stats is not None and stats["total_chunks"] != len(chunks):
+        print(f"Ignoring {KB_STATS_FILE.name}: it describes {stats['total_chunks']} chunks, the index has {len(chunks)}.")
+        stats = None
+
+    return KnowledgeBase(version, directory, index, chunks, sparse_index, embed_manifest, signature, stats)
+
+def get_knowledge_base():
+    """The current KB snapshot, loading it on first use."""
+    global _kb
+    kb = _kb
+    if kb is not None:
+        return kb
+    with _kb_lock:
+        if _kb is None:
+            _kb = load_knowledge_base()
+        return _kb
+
+def reload_knowledge_base(force=False):
+    """Load the published KB version if it changed and swap it in; returns True if swapped.
+
+    Loading happens outside the lock, so requests keep using the old snapshot
+    until the new one is complete; a failed load leaves the old one in place.
+    """
+    global _kb, _kb_reloads, _kb_reload_failures, _kb_failed_signature
+    current = _kb
+    signature = _kb_signature()
+    if not force and (current is not None and signature == current.signature or signature == _kb_failed_signature):
+        return False
+    try:
+        with metrics.span("kb_reload"):
+            new_kb = load_knowledge_base()
+    except Exception as e:
+        _kb_reload_failures += 1
+        _kb_failed_signature = signature
+        print(f"KB reload failed, keeping {current!r}: {e}")
+        return False
+    with _kb_lock:
+        _kb = new_kb
+        _kb_reloads += 1
+    print(f"Swapped in {new_kb!r}")
+    return True
+
+def _watch_knowledge_base(interval_s):
+    while True:
+        time.sleep(interval_s)
+        try:
+            reload_knowledge_base()
+        except Exception as e:  # never let the watcher thread die
+            print(f"KB watcher error: {e}")
+
+def start_kb_watcher(interval_s=KB_RELOAD_INTERVAL_S):
+    """Start (once) a daemon thread that hot-reloads the KB when a new version is published."""
+    global _kb_watcher
+    with _kb_lock:
+        if _kb_watcher is None:
+            _kb_watcher = threading.Thread(
+                target=_watch_knowledge_base, args=(interval_s,), name="rag-kb-watcher", daemon=True
+            )
+            _kb_watcher.start()
+    return _kb_watcher
+
+def load_embed_model():
+    """Load the query embedding model once per process; KB reloads keep it."""
+    global _embed_model
+    if _embed_model is None:
+        with _embed_model_lock:
+            if _embed_model is None:
+                print("Loading embedding model...")
+                with metrics.span("load_model"):
+                    _embed_model = sentence_transformers.SentenceTransformer(MODEL_NAME)
+    return _embed_model
+
+def load_openai_key():
     dotenv.load_dotenv()
     if not os.environ.get("OPENAI_API_KEY"):
          raise RuntimeError("Missing OPENAI_API_KEY in .env")
     openai.api_key = os.environ.get("OPENAI_API_KEY")
 
-    return _index, _chunks, _embed_model
+def load_resources():
+    """Load resources and return (FAISS index, chunks, embedding model) of the current KB."""
+    kb = get_knowledge_base()
+    embed_model = load_embed_model()
+    load_openai_key()
+    return kb.index, kb.chunks, embed_model
+
+def encode_queries(queries, embed_model, cache=None):
+    """Return an (n, d) matrix of L2-normalized query vectors.
 
-def retrieve(query, k=5, resources=None):
-    """Retrieve relevant chunks for a query."""
-    if resources:
+    Cached queries are looked up; the rest are encoded in a single batched call,
+    routed through the micro-batcher when the batch is small.
+    """
+    with metrics.span("query_encode"):
+        return _encode_queries(queries, embed_model, cache or query_cache)
+
+def _encode_queries(queries, embed_model, cache):
+    queries = [normalize_query(q) for q in queries]
+    vectors = [cache.get(MODEL_NAME, q) for q in queries]
+
+    missing = sorted({q for q, v in zip(queries, vectors) if v is None})
+    if missing:
+        texts = [QUERY_PREFIX + q for q in missing]
+        if ENCODE_BATCH_WAIT_S > 0 and len(texts) < ENCODE_MAX_BATCH:
+            # Small requests from concurrent sessions share forward passes
+            encoded = get_encode_batcher(embed_model).encode(texts)
+        else:
+            encoded = embed_model.encode(texts, convert_to_numpy=True)
+        encoded = np.asarray(encoded, dtype=np.float32)
+        faiss.normalize_L2(encoded)
+        by_query = dict(zip(missing, encoded))
+        for q, vector in by_query.items():
+            cache.put(MODEL_NAME, q, vector)
+        vectors = [by_query[q] if v is None else v for q, v in zip(queries, vectors)]
+
+    return np.vstack(vectors).astype(np.float32, copy=False)
+
+def encode_query(query, embed_model, cache=None):
+    """Return the L2-normalized query vector, encoding only on a cache miss."""
+    return encode_queries([query], embed_model, cache=cache)[0]
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """Fuse several best-first id lists into (id, score) pairs sorted by fused score."""
+    scores = collections.defaultdict(float)
+    for ranking in rankings:
+        for rank, idx in enumerate(ranking, start=1):
+            scores[int(idx)] += 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+def _sparse_search_batch(sparse_index, queries, k):
+    with metrics.span("sparse_search"):
+        return [sparse_index.search(normalize_query(q), k)[1] for q in queries]
+
+def load_reranker():
+    """Load the cross-encoder on first use; retrieval without reranking never pays for it."""
+    global _reranker
+    with _reranker_lock:
+        if _reranker is None:
+            print(f"Loading reranker '{RERANK_MODEL_NAME}'...")
+            _reranker = sentence_transformers.CrossEncoder(RERANK_MODEL_NAME, device="cpu")
+    return _reranker
+
+def _rerank_key(query, chunk):
+    # Keyed on the text, not chunk_id: a reloaded KB version may give a chunk_id new text
+    return (query, content_hash(RERANK_MODEL_NAME, chunk["text"]))
+
+def _score_pairs(reranker, query, chunks):
+    scores = reranker.predict([(query, c["text"]) for c in chunks], batch_size=max(len(chunks), 1))
+    scores = [float(s) for s in np.asarray(scores).reshape(-1)]
+    for chunk, score in zip(chunks, scores):
+        rerank_cache.put(_rerank_key(query, chunk), score)
+    return scores
+
+def rerank(query, candidates, k, budget_s=RERANK_BUDGET_S):
+    """Reorder first-stage candidates by cross-encoder score and keep the top k.
+
+    Uncached (query, chunk) pairs are scored in one batched forward pass. If that
+    pass does not finish within `budget_s`, the first-stage order is returned
+    unchanged; the scores still land in the cache once the pass completes.
+    """
+    global rerank_fallbacks
+    if not candidates:
+        return []
+    reranker = load_reranker()
+    query = normalize_query(query)
+    scores = [rerank_cache.get(_rerank_key(query, c)) for c in candidates]
+    missing = [c for c, score in zip(candidates, scores) if score is None]
+    if missing:
+        future = _rerank_pool.submit(_score_pairs, reranker, query, missing)
+        try:
+            new_scores = iter(future.result(timeout=budget_s))
+        except concurrent.futures.TimeoutError:
+            rerank_fallbacks += 1
+            return candidates[:k]
+        scores = [next(new_scores) if score is None else score for score in scores]
+
+    order = sorted(range(len(candidates)), key=lambda i: scores[i], reverse=True)[:k]
+    reranked = []
+    for i in order:
+        chunk = candidates[i]
+        chunk['rerank_score'] = scores[i]
+        reranked.append(chunk)
+    return reranked
+
+def retrieve_batch(queries, k=5, resources=None, mode="dense", rerank_results=False):
+    """Retrieve relevant chunks for several queries with one encode and one search call.
+
+    `resources` is a KnowledgeBase snapshot (default: the current one) or a legacy
+    (index, chunks, embed_model) tuple.
+
+    mode="hybrid" runs BM25 concurrently with the dense search and merges the two
+    rankings with reciprocal rank fusion; 'score' is then the fused score.
+    rerank_results=True over-fetches RERANK_CANDIDATES and reorders them with the
+    cross-encoder (see rerank()).
+    """
+    if isinstance(resources, tuple):
         index, chunks, embed_model = resources
+        kb = get_knowledge_base()
+        sparse_index = kb.sparse_index if kb.index is index else None
     else:
-        index, chunks, embed_model = load_resources()
-    
-    query_text = f"Represent this sentence for searching relevant passages: {query}"
-    query_vector = embed_model.encode([query_text], convert_to_numpy=True)
-    query_vector = np.asarray(query_vector, dtype=np.float32)
-    faiss.normalize_L2(query_vector)
-    
-    distances, indices = index.search(query_vector, k)
-    
-    retrieved_chunks = []
-    for i, idx in enumerate(indices[0]):
-        if idx == -1: continue
-        chunk = chunks[idx].copy() # Copy to avoid modifying global state
-        # Add score to chunk for reference
-        chunk['score'] = float(distances[0][i])
-        retrieved_chunks.append(chunk)
-        
-    return retrieved_chunks
-
-def format_context(retrieved_chunks):
-    """Format chunks into a context string."""
-    context_text = ""
-    for i, chunk in enumerate(retrieved_chunks):
-        context_text += f"Source {i+1} ({chunk['title']}):\n{chunk['text']}\n\n"
-    return context_text
+        kb = resources or get_knowledge_base()
+        index, chunks, sparse_index = kb.index, kb.chunks, kb.sparse_index
+        embed_model = load_embed_model()
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unknown retrieval mode {mode!r}; expected one of {RETRIEVAL_MODES}")
+    if not queries:
+        return []
 
-def generate_answer(query, retrieved_chunks, model="gpt-4o", stream=True):
-    """Generate an answer using OpenAI."""
-    context_text = format_context(retrieved_chunks)
-
-    system_prompt = (
-        "You are a helpful expert System Design assistant. "
-        "You answer questions based ONLY on the provided context. "
-        "If the answer is not in the context, say \"I don't have enough information in my knowledge base to answer that.\" "
-        "Do not use outside knowledge. "
-        "Cite your sources if possible (e.g. 'According to the Redis article...')."
-    )
-
-    messages = [
-        {"role": "system", "content": system_prompt},
+    fetch_k = max(k, RERANK_CANDIDATES) if rerank_results else k
+    sparse_future = None
+    search_k = fetch_k
+    if mode == "hybrid":
+        if sparse_index is None:
+            raise FileNotFoundError(f"{SPARSE_INDEX_FILE.name} not found. Re-run ingest/embed.py to build it.")
+        search_k = max(fetch_k, HYBRID_FETCH_K)
+        sparse_future = _search_pool.submit(
+            contextvars.copy_context().run, _sparse_search_batch, sparse_index, queries, search_k
+        )
+
+    query_vectors = encode_queries(queries, embed_model)
+    with metrics.span("index_search"):
+        distances, indices = index.search(query_vectors, search_k)
+
+    if sparse_future is None:
+        ranked = [
+            [(idx, float(score)) for score, idx in zip(row_distances, row_indices) if idx != -1]
+            for row_distances, row_indices in zip(distances, indices)
+        ]
+    else:
+        ranked = [
+            reciprocal_rank_fusion([[idx for idx in dense_ids if idx != -1], sparse_ids])[:fetch_k]
+            for dense_ids, sparse_ids in zip(indices, sparse_future.result())
+        ]
+
+    results = []
+    for query, row in zip(queries, ranked):
+        retrieved_chunks = []
+        for idx, score in row:
+            chunk = chunks[int(idx)] # Materializes a fresh dict for this row only
+            # Add score to chunk for reference
+            chunk['score'] = score
+            retrieved_chunks.append(chunk)
+        if rerank_results:
+            with metrics.span("rerank"):
+                retrieved_chunks = rerank(query, retrieved_chunks, k)
+        results.append(retrieved_chunks)
+    return results
+
+def retrieve(query, k=5, resources=None, mode="dense", rerank_results=False):
+    """Retrieve relevant chunks for a query."""
+    return retrieve_batch([query], k=k, resources=resources, mode=mode, rerank_results=rerank_results)[0]
+
+_CHUNK_SEQ_RE = re.compile(r"::chunk-(\d+)$")
+
+def _chunk_tokens(chunk):
+    return chunk.get("token_count") or max(1, len(chunk["text"]) // CHARS_PER_TOKEN)
+
+def _chunk_position(chunk):
+    """(section_id, chunk number) for chunks that can be merged with their neighbours."""
+    match = _CHUNK_SEQ_RE.search(chunk.get("chunk_id", ""))
+    if not match or not chunk.get("section_id"):
+        return None
+    return chunk["section_id"], int(match.group(1))
+
+def _overlap_chars(previous_text, next_text, probe_chars=16, max_overlap_chars=4000):
+    """Length of the longest suffix of previous_text that is a prefix of next_text."""
+    probe = next_text[:probe_chars]
+    tail_start = max(0, len(previous_text) - max_overlap_chars)
+    pos = previous_text.find(probe, tail_start)
+    while pos != -1:
+        overlap = len(previous_text) - pos
+        if next_text.startswith(previous_text[pos:]):
+            return overlap
+        pos = previous_text.find(probe, pos + 1)
+    return 0
+
+def _overlap(previous, chunk):
+    """(chars, tokens or None) at the start of `chunk` repeated from the end of `previous`.
+
+    Uses the char/token offsets stored by the preprocessing chunker when both chunks
+    have them; otherwise falls back to matching the texts.
+    """
+    if "char_start" in chunk and "char_end" in previous:
+        chars = min(max(0, previous["char_end"] - chunk["char_start"]), len(chunk["text"]))
+        tokens = None
+        if "token_start" in chunk and "token_end" in previous:
+            tokens = max(0, previous["token_end"] - chunk["token_start"])
+        return chars, tokens
+    return _overlap_chars(previous["text"], chunk["text"]), None
+
+def _trimmed(chunk, previous):
+    """Chunk text with the part shared with its predecessor dropped, and its token cost."""
+    text = chunk["text"]
+    tokens = _chunk_tokens(chunk)
+    overlap, overlap_tokens = _overlap(previous, chunk)
+    if overlap <= 0:
+        return text, tokens
+    kept = text[overlap:]
+    if overlap_tokens is not None:
+        return kept, max(1, tokens - overlap_tokens)
+    return kept, max(1, round(tokens * len(kept) / max(len(text), 1)))
+
+def pack_context(retrieved_chunks, token_budget=CONTEXT_TOKEN_BUDGET):
+    """Pack ranked chunks into a context string that fits `token_budget`.
+
+    Chunks are admitted best-first using their stored token_count, skipping any
+    that no longer fit. Admitted chunks from the same section are merged into one
+    source in chunk order, and the overlap between consecutive chunks is sent once.
+    """
+    selected = {}
+    used = 0
+    for rank, chunk in enumerate(retrieved_chunks):
+        position = _chunk_position(chunk)
+        key = position or ("", rank)
+        if key in selected:
+            continue
+        cost = _chunk_tokens(chunk)
+        previous = selected.get((position[0], position[1] - 1)) if position else None
+        if previous is not None:
+            cost = _trimmed(chunk, previous[1])[1]
+        elif not position or all(k[0] != position[0] for k in selected):
+            cost += SOURCE_HEADER_TOKENS
+        if used + cost > token_budget:
+            continue
+        selected[key] = (rank, chunk)
+        used += cost
+
+    if not selected and retrieved_chunks:
+        # Nothing fits whole: send the top chunk cut down to the budget
+        chunk = retrieved_chunks[0]
+        keep = max(0, token_budget - SOURCE_HEADER_TOKENS) / _chunk_tokens(chunk)
+        chunk = {**chunk, "text": chunk["text"][:int(len(chunk["text"]) * min(keep, 1.0))]}
+        selected[("", 0)] = (0, chunk)
+
+    groups = {}
+    for key, (rank, chunk) in sorted(selected.items(), key=lambda item: (item[0][0], item[0][1])):
+        group_key = key[0] or ("", rank)
+        groups.setdefault(group_key, []).append((key[1], rank, chunk))
+
+    parts = []
+    ordered_groups = sorted(groups.values(), key=lambda members: min(rank for _, rank, _ in members))
+    for source_num, members in enumerate(ordered_groups, start=1):
+        texts = []
+        previous_seq, previous_chunk = None, None
+        for seq, _, chunk in members:
+            if previous_chunk is not None and seq == previous_seq + 1:
+                kept = _trimmed(chunk, previous_chunk)[0]
+                if len(kept) == len(chunk["text"]):
+                    # No shared text (chunks split on whitespace): keep them apart
+                    texts.append("\n")
+                texts.append(kept)
+            else:
+                if texts:
+                    texts.append("\n[...]\n")
+                texts.append(chunk["text"])
+            previous_seq, previous_chunk = seq, chunk
+        parts.extend((f"Source {source_num} ({members[0][2]['title']}):\n", *texts, "\n\n"))
+    return "".join(parts)
+
+SYSTEM_PROMPT = (
+    "You are a helpful expert System Design assistant. "
+    "You answer questions based ONLY on the provided context. "
+    "If the answer is not in the context, say \"I don't have enough information in my knowledge base to answer that.\" "
+    "Do not use outside knowledge. "
+    "Cite your sources if possible (e.g. 'According to the Redis article...')."
+)
+
+def build_messages(query, retrieved_chunks):
+    with metrics.span("context_build"):
+        context_text = pack_context(retrieved_chunks)
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
         {"role": "user", "content": f"Context:\n{context_text}\n\nQuestion: {query}"},
     ]
 
-    return openai.chat.completions.create(
-        model=model,
-        messages=messages,
-        stream=stream,
-    )
+def generate_answer(query, retrieved_chunks, model="gpt-4o", stream=True):
+    """Generate an answer using OpenAI."""
+    with metrics.span("llm_request"):
+        return openai.chat.completions.create(
+            model=model,
+            messages=build_messages(query, retrieved_chunks),
+            stream=stream,
+        )
+
+def add_llm_response_observer(observer):
+    """Call `observer(httpx.Response)` for every response the async client receives (headers only)."""
+    _llm_response_observers.append(observer)
+
+def remove_llm_response_observer(observer):
+    if observer in _llm_response_observers:
+        _llm_response_observers.remove(observer)
+
+async def _observe_llm_response(response):
+    for observer in list(_llm_response_observers):
+        observer(response)
+
+def get_async_client():
+    """Shared AsyncOpenAI client with a pooled HTTP transport for the running event loop.
+
+    Retries are handled by agenerate_answer, so the SDK's own retries are disabled.
+    OPENAI_BASE_URL (e.g. evaluation/stub_openai.py) is honoured like in the sync client.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = openai.AsyncOpenAI(
+            api_key=openai.api_key or os.environ.get("OPENAI_API_KEY"),
+            max_retries=0,
+            http_client=openai.DefaultAsyncHttpxClient(
+                limits=LLM_POOL_LIMITS, event_hooks={"response": [_observe_llm_response]}
+            ),
+        )
+        _async_clients[loop] = client
+    return client
+
+def backoff_delay(attempt, error):
+    """Full-jitter exponential backoff, stretched to the server's retry-after if it sent one."""
+    delay = random.uniform(0, min(LLM_BACKOFF_MAX_S, LLM_BACKOFF_BASE_S * 2 ** attempt))
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return max(delay, float(retry_after)) if retry_after else delay
+    except ValueError:
+        return delay
+
+def _remaining(deadline):
+    remaining = deadline - asyncio.get_running_loop().time()
+    if remaining <= 0:
+        raise TimeoutError("LLM deadline exceeded")
+    return remaining
+
+async def _open_stream(model, messages, deadline, max_retries):
+    """Start a streaming completion and wait for its first content token.
+
+    Returns (stream iterator, first text). Retryable errors are retried with
+    jittered backoff until max_retries or the deadline is hit.
+    """
+    client = get_async_client()
+    for attempt in range(max_retries + 1):
+        try:
+            stream = await asyncio.wait_for(
+                client.chat.completions.create(model=model, messages=messages, stream=True),
+                _remaining(deadline),
+            )
+            chunks = stream.__aiter__()
+            try:
+                while True:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), _remaining(deadline))
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        return stream, chunks, chunk.choices[0].delta.content
+            except StopAsyncIteration:
+                return stream, chunks, ""
+            except BaseException:
+                await stream.close()
+                raise
+        except LLM_RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            await asyncio.sleep(min(backoff_delay(attempt, e), _remaining(deadline)))
+
+async def _cancel(task):
+    task.cancel()
+    try:
+        stream, _, _ = await task
+        await stream.close()
+    except (asyncio.CancelledError, Exception):
+        pass
+
+async def agenerate_answer(
+    query,
+    retrieved_chunks,
+    model="gpt-4o",
+    deadline_s=LLM_DEADLINE_S,
+    max_retries=LLM_MAX_RETRIES,
+    hedge_model=None,
+    hedge_after_s=LLM_HEDGE_AFTER_S,
+):
+    """Stream an answer as text deltas using the shared async client.
+
+    If `hedge_model` is set and no token has arrived after `hedge_after_s`, a second
+    request to `hedge_model` is started; whichever produces a token first wins and
+    the other is cancelled. Raises TimeoutError once `deadline_s` has elapsed.
+    """
+    messages = build_messages(query, retrieved_chunks)
+    started = time.perf_counter()
+    deadline = asyncio.get_running_loop().time() + deadline_s
+
+    hedge = hedge_model if hedge_model and hedge_model != model else None
+    pending = {asyncio.create_task(_open_stream(model, messages, deadline, max_retries))}
+    if hedge:
+        done, _ = await asyncio.wait(pending, timeout=min(hedge_after_s, _remaining(deadline)))
+        if not done:
+            pending.add(asyncio.create_task(_open_stream(hedge, messages, deadline, max_retries)))
+            hedge = None
+
+    winner = None
+    error = None
+    losers = []  # opened streams that finished in the same wait as the winner
+    try:
+        while pending and winner is None:
+            done, pending = await asyncio.wait(
+                pending, timeout=_remaining(deadline), return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                raise TimeoutError("LLM deadline exceeded before the first token")
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                elif winner is None:
+                    winner = task
+                else:
+                    losers.append(task)
+            if winner is None and not pending and hedge:
+                # Primary failed outright before the hedge delay: fall back immediately
+                pending.add(asyncio.create_task(_open_stream(hedge, messages, deadline, max_retries)))
+                hedge = None
+    finally:
+        for task in pending:
+            await _cancel(task)
+        for task in losers:
+            await task.result()[0].close()
+    if winner is None:
+        raise error
+
+    stream, chunks, first_text = winner.result()
+    metrics.record("llm_ttft", time.perf_counter() - started, started)
+    try:
+        if first_text:
+            yield first_text
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), _remaining(deadline))
+            except StopAsyncIteration:
+                return
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        await stream.close()
+        metrics.record("llm_stream_total", time.perf_counter() - started, started)
+
+def background_loop():
+    """Event loop (on its own thread) that owns the pooled async client; sync callers schedule coroutines on it."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="rag-llm-loop", daemon=True).start()
+    return _loop
+
+def run_async(coro):
+    """Run a coroutine on the background loop and wait for its result (keeping the caller's trace)."""
+    coro = metrics.traced(coro, metrics.current_trace())
+    return asyncio.run_coroutine_threadsafe(coro, background_loop()).result()
+
+def stream_answer(query, retrieved_chunks, model="gpt-4o", **kwargs):
+    """Synchronous iterator over agenerate_answer() text deltas (for Streamlit)."""
+    agen = agenerate_answer(query, retrieved_chunks, model=model, **kwargs)
+    try:
+        while True:
+            try:
+                yield run_async(agen.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        run_async(agen.aclose())
+
+def _collect_metrics():
+    """Cache and batcher counters for the Prometheus endpoint."""
+    families = []
+    for name, cache in (("query_vector", query_cache.stats()), ("rerank", rerank_cache.stats())):
+        for counter in ("hits", "misses", "evictions", "expirations", "disk_hits"):
+            if counter in cache:
+                families.append((f"rag_{name}_cache_{counter}_total", "counter", f"{name} cache {counter}", [({}, cache[counter])]))
+        families.append((f"rag_{name}_cache_size", "gauge", f"{name} cache entries", [({}, cache["size"])]))
+    families.append(("rag_rerank_fallbacks_total", "counter", "Rerank passes that exceeded the time budget", [({}, rerank_fallbacks)]))
+    kb = _kb
+    if kb is not None:
+        families.append(("rag_kb_chunks", "gauge", "Chunks in the served KB version", [({"version": kb.version or "kb"}, len(kb.chunks))]))
+        families.append(("rag_kb_loaded_timestamp_seconds", "gauge", "When the served KB version was loaded", [({}, kb.loaded_at)]))
+    families.append(("rag_kb_reloads_total", "counter", "KB hot reloads swapped in", [({}, _kb_reloads)]))
+    families.append(("rag_kb_reload_failures_total", "counter", "KB hot reloads that failed to load", [({}, _kb_reload_failures)]))
+    batcher = _encode_batcher
+    if batcher is not None:
+        families.append(("rag_encode_queue_depth", "gauge", "Encode requests waiting for a batch", [({}, batcher.queue_depth())]))
+        families.append(("rag_encode_batch_size", "histogram", "Texts per batched encode call", [({}, batcher.batch_sizes)]))
+        families.append(("rag_encode_queue_depth_at_dispatch", "histogram", "Queue depth when a batch was dispatched", [({}, batcher.queue_depths)]))
+    return families
+
+metrics.register_collector(_collect_metrics)
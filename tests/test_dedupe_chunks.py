@@ -0,0 +1,53 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+
+# ingest/ scripts import their siblings by name
+sys.path.append(str(Path(__file__).parent.parent / "ingest"))
+from dedupe_chunks import WORD_RE, MinHasher, find_clusters, shingles
+
+THRESHOLD = 0.85
+
+
+def sign(texts, num_perm=128, shingle_size=5):
+    hasher = MinHasher(num_perm)
+    return np.vstack([hasher.signature(shingles(WORD_RE.findall(t.lower()), shingle_size)) for t in texts])
+
+
+def edit_chain(length=7, words=200, edits_per_step=2):
+    """Texts where each one rewrites a couple of words of the previous one, in places not touched before."""
+    base = [f"word{i}" for i in range(words)]
+    texts = [" ".join(base)]
+    for step in range(1, length):
+        for edit in range(edits_per_step):
+            base[(step * edits_per_step + edit) * 13 % words] = f"edit{step}x{edit}"
+        texts.append(" ".join(base))
+    return texts
+
+
+def jaccard(a, b, shingle_size=5):
+    sa, sb = (shingles(WORD_RE.findall(t.lower()), shingle_size) for t in (a, b))
+    return len(sa & sb) / len(sa | sb)
+
+
+def test_edit_chain_does_not_collapse_into_one_chunk():
+    texts = edit_chain()
+    assert jaccard(texts[0], texts[1]) >= THRESHOLD
+    assert jaccard(texts[0], texts[-1]) < 0.6
+
+    signatures = sign(texts)
+    clusters, _, _ = find_clusters(signatures, np.ones(len(texts), dtype=bool), bands=16, threshold=THRESHOLD)
+    roots = [clusters.find(i) for i in range(len(texts))]
+
+    assert roots[0] != roots[-1]
+    for i, root in enumerate(roots):
+        assert np.mean(signatures[i] == signatures[root]) >= THRESHOLD
+
+
+def test_exact_copies_merge_into_first():
+    texts = edit_chain(length=2)
+    texts = [texts[0], texts[1], texts[0], texts[0]]
+    clusters, _, _ = find_clusters(sign(texts), np.ones(len(texts), dtype=bool), bands=16, threshold=THRESHOLD)
+    assert clusters.find(2) == 0
+    assert clusters.find(3) == 0
@@ -1,4 +1,21 @@
+"""
+3D UMAP scatter of the KB embeddings, written to kb/visualizations/.
+
+Scales to large KBs:
+  - vectors are read in blocks from the memory-mapped kb/embeddings.npy (or
+    reconstructed from kb/index.faiss in blocks), never all at once
+  - above --max-points, points are sampled stratified by document so every
+    document stays visible; the plot is a WebGL scatter of at most that many points
+  - UMAP is fitted on at most --fit-sample points and the rest are transformed
+  - the projection (fitted reducer + coordinates per embedding hash) is cached in
+    kb/visualizations/.projections. An unchanged KB re-plots without any
+    fitting, and a KB with a few new chunks only transforms the new vectors
+    (a full refit happens past --refit-fraction new points, or with --refit)
+"""
 import json
+import hashlib
+import pickle
+import sys
 import numpy as np
 import faiss
 import umap
@@ -9,27 +26,77 @@ from pathlib import Path
 import argparse
 import datetime
 
+# Add parent directory to path to import the ingest modules
+sys.path.append(str(Path(__file__).parent.parent))
+from ingest.meta_store import MetaStore
+
 # Config
 INDEX_FILE = Path("kb/index.faiss")
-CHUNKS_FILE = Path("kb/processed/chunks.jsonl")
+META_FILE = Path("kb/index_meta.bin")
+EMBEDDINGS_FILE = Path("kb/embeddings.npy")
+EMBED_HASHES_FILE = Path("kb/embed_hashes.npy")
 EMBED_CONFIG_FILE = Path("kb/embed_manifest.json")
+VIZ_DIR = Path("kb/visualizations")
+PROJECTION_CACHE_DIR = VIZ_DIR / ".projections"
+PROJECTION_VERSION = 1
+BLOCK_SIZE = 8192
+SNIPPET_CHARS = 200
+
+
+class VectorSource:
+    """Row-addressable embeddings: memory-mapped embeddings.npy when it matches the index, else the index."""
+
+    def __init__(self):
+        self.index = faiss.read_index(str(INDEX_FILE))
+        self.ntotal = self.index.ntotal
+        self.embeddings = None
+        if EMBEDDINGS_FILE.exists():
+            embeddings = np.load(EMBEDDINGS_FILE, mmap_mode="r")
+            if embeddings.shape[0] == self.ntotal:
+                self.embeddings = embeddings
+        if self.embeddings is None:
+            try:
+                # IVF indexes need a direct map before vectors can be reconstructed by id
+                faiss.extract_index_ivf(self.index).make_direct_map()
+            except RuntimeError:
+                pass
+        self.hashes = None
+        if EMBED_HASHES_FILE.exists():
+            hashes = np.load(EMBED_HASHES_FILE, mmap_mode="r")
+            if hashes.shape[0] == self.ntotal:
+                self.hashes = hashes
+
+    @property
+    def dimension(self):
+        return self.index.d
+
+    def read(self, ids):
+        """float32 vectors for sorted row ids."""
+        if self.embeddings is not None:
+            return np.asarray(self.embeddings[ids], dtype=np.float32)
+        return self.index.reconstruct_batch(np.asarray(ids, dtype=np.int64))
+
+    def iter_blocks(self, ids, block_size=BLOCK_SIZE):
+        for start in range(0, len(ids), block_size):
+            block = ids[start:start + block_size]
+            yield start, self.read(block)
+
 
 def load_data():
-    if not INDEX_FILE.exists() or not CHUNKS_FILE.exists():
-        raise FileNotFoundError("Index or chunks not found.")
+    if not INDEX_FILE.exists() or not META_FILE.exists():
+        raise FileNotFoundError("Index or chunk metadata not found. Run embed.py first.")
     if not EMBED_CONFIG_FILE.exists():
         raise FileNotFoundError("kb/embed_manifest.json not found. Re-run embed.py first.")
 
-    index = faiss.read_index(str(INDEX_FILE))
-    vectors = index.reconstruct_n(0, index.ntotal)
-
-    with open(CHUNKS_FILE, "r", encoding="utf-8") as f:
-        chunks = [json.loads(line) for line in f]
+    source = VectorSource()
+    chunks = MetaStore(META_FILE)
+    if len(chunks) != source.ntotal:
+        raise RuntimeError(f"{META_FILE} has {len(chunks)} rows but {INDEX_FILE} has {source.ntotal} vectors.")
 
     with open(EMBED_CONFIG_FILE, "r", encoding="utf-8") as f:
         embed_manifest = json.load(f)
 
-    return vectors, chunks, embed_manifest
+    return source, chunks, embed_manifest
 
 def extract_category(doc_id):
     # doc_id example: "learn/system-design/key-technologies/redis.md"
@@ -37,57 +104,171 @@ def extract_category(doc_id):
     path = Path(doc_id)
     return path.stem.replace("-", " ").title() # e.g. "redis.md" -> "Redis"
 
+def stratified_sample(doc_codes, max_points, seed=42):
+    """Sorted row ids: all rows if they fit, else a per-document proportional sample (≥1 row per document)."""
+    num_rows = len(doc_codes)
+    if num_rows <= max_points:
+        return np.arange(num_rows)
+    rng = np.random.default_rng(seed)
+    order = np.argsort(doc_codes, kind="stable")
+    docs, starts, counts = np.unique(doc_codes[order], return_index=True, return_counts=True)
+    quota = np.maximum(1, np.floor(counts * max_points / num_rows)).astype(np.int64)
+    # Hand out the rows lost to rounding to the largest documents first
+    spare = max_points - quota.sum()
+    if spare > 0:
+        for i in np.argsort(-counts)[:spare]:
+            quota[i] += quota[i] < counts[i]
+    picked = [
+        rng.choice(order[start:start + count], size=min(q, count), replace=False)
+        for start, count, q in zip(starts, counts, quota)
+    ]
+    return np.sort(np.concatenate(picked))
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--tag", type=str, default="default", help="Short description tag for filename")
+    parser.add_argument("--max-points", type=int, default=50000,
+                        help="Plot at most this many points (stratified sample by document)")
+    parser.add_argument("--fit-sample", type=int, default=10000,
+                        help="Fit UMAP on at most this many points and transform the rest")
+    parser.add_argument("--refit-fraction", type=float, default=0.2,
+                        help="Refit instead of transforming when more than this share of points is new")
+    parser.add_argument("--refit", action="store_true", help="Ignore the projection cache and refit")
+    parser.add_argument("--seed", type=int, default=42)
     return parser.parse_args()
 
+def projection_cache_file(model_name, args):
+    key = json.dumps({"version": PROJECTION_VERSION, "model": model_name, "seed": args.seed, "n_components": 3})
+    return PROJECTION_CACHE_DIR / f"{hashlib.sha256(key.encode()).hexdigest()[:16]}.pkl"
+
+def fingerprint(source, rows):
+    """Identity of the plotted points: their embedding hashes (or, without them, the index file)."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.ascontiguousarray(rows, dtype=np.int64).tobytes())
+    if source.hashes is not None:
+        for start in range(0, len(rows), BLOCK_SIZE):
+            digest.update(np.ascontiguousarray(source.hashes[rows[start:start + BLOCK_SIZE]]).tobytes())
+    else:
+        stat = INDEX_FILE.stat()
+        digest.update(f"{stat.st_size}:{stat.st_mtime_ns}:{source.ntotal}".encode())
+    return digest.hexdigest()
+
+def load_projection_cache(path):
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return None
+
+def save_projection_cache(path, cache):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".pkl.tmp")
+    with open(tmp_path, "wb") as f:
+        pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+    tmp_path.replace(path)
+
+def transform(source, rows, reducer, pca):
+    coords = np.empty((len(rows), 3), dtype=np.float32)
+    for start, vectors in source.iter_blocks(rows):
+        coords[start:start + len(vectors)] = pca.transform(reducer.transform(vectors))
+    return coords
+
+def fit_projection(source, rows, args):
+    """Fit UMAP (+ PCA to align axes) on a sample of `rows`, then project all of them."""
+    rng = np.random.default_rng(args.seed)
+    fit_rows = rows if len(rows) <= args.fit_sample else np.sort(rng.choice(rows, args.fit_sample, replace=False))
+    print(f"Fitting UMAP on {len(fit_rows)} points (to 3D)...")
+    reducer = umap.UMAP(n_components=3, random_state=args.seed, metric='cosine')
+    fitted = reducer.fit_transform(source.read(fit_rows))
+    pca = sklearn.decomposition.PCA(n_components=3, random_state=args.seed)
+    pca.fit(fitted)
+    if len(fit_rows) == len(rows):
+        return reducer, pca, pca.transform(fitted).astype(np.float32)
+    rest = np.setdiff1d(rows, fit_rows, assume_unique=True)
+    print(f"Transforming the remaining {len(rest)} points in blocks...")
+    coords = np.empty((len(rows), 3), dtype=np.float32)
+    coords[np.searchsorted(rows, fit_rows)] = pca.transform(fitted)
+    coords[np.searchsorted(rows, rest)] = transform(source, rest, reducer, pca)
+    return reducer, pca, coords
+
+def project(source, rows, model_name, args):
+    """(coords for `rows`, how they were obtained)."""
+    cache_file = projection_cache_file(model_name, args)
+    cache = None if args.refit else load_projection_cache(cache_file)
+    points = fingerprint(source, rows)
+    if cache is not None and cache["fingerprint"] == points:
+        return cache["coords"], "cached"
+
+    hashes = None if source.hashes is None else np.asarray(source.hashes[rows])
+    mode = "full fit"
+    if cache is not None and hashes is not None and cache.get("hashes") is not None:
+        known = {h: i for i, h in enumerate(cache["hashes"])}
+        positions = np.array([known.get(h, -1) for h in hashes], dtype=np.int64)
+        new = np.flatnonzero(positions < 0)
+        if len(new) <= args.refit_fraction * len(rows):
+            print(f"Reusing {len(rows) - len(new)} cached points; transforming {len(new)} new ones...")
+            reducer, pca = cache["reducer"], cache["pca"]
+            coords = np.empty((len(rows), 3), dtype=np.float32)
+            reused = positions >= 0
+            coords[reused] = cache["coords"][positions[reused]]
+            if len(new):
+                coords[new] = transform(source, rows[new], reducer, pca)
+            mode = "incremental"
+        else:
+            print(f"{len(new)} of {len(rows)} points are new; refitting.")
+    if mode == "full fit":
+        reducer, pca, coords = fit_projection(source, rows, args)
+
+    save_projection_cache(cache_file, {
+        "fingerprint": points, "hashes": hashes, "coords": coords, "reducer": reducer, "pca": pca,
+    })
+    return coords, mode
+
 def main():
     args = parse_args()
-    
+
     # Create output directory
-    viz_dir = Path("kb/visualizations")
+    viz_dir = VIZ_DIR
     viz_dir.mkdir(parents=True, exist_ok=True)
-    
+
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
     output_filename = viz_dir / f"viz_{timestamp}_{args.tag}.html"
 
     print("Loading data...")
-    vectors, chunks, embed_manifest = load_data()
-    print(f"Loaded {len(vectors)} vectors.")
+    source, chunks, embed_manifest = load_data()
+    num_chunks = source.ntotal
+    print(f"Index has {num_chunks} vectors ({'embeddings.npy' if source.embeddings is not None else 'reconstructed from index'}).")
 
-    print("Running UMAP dimensionality reduction (to 3D)...")
-    reducer = umap.UMAP(n_components=3, random_state=42, metric='cosine')
-    projections = reducer.fit_transform(vectors)
+    doc_codes, doc_ids = chunks.interned_column("doc_id")
+    rows = stratified_sample(np.asarray(doc_codes), args.max_points, args.seed)
+    if len(rows) < num_chunks:
+        print(f"Sampled {len(rows)} points stratified over {len(doc_ids)} documents.")
 
-    pca = sklearn.decomposition.PCA(n_components=3, random_state=42)
-    projections = pca.fit_transform(projections)
+    model_name = embed_manifest["model"]
+    projections, projection_mode = project(source, rows, model_name, args)
+    print(f"Projection: {projection_mode}.")
 
     print("Preparing plot...")
-    data = []
-    for i, chunk in enumerate(chunks):
-        category = extract_category(chunk["doc_id"])
-        text_snippet = chunk["text"][:200] + "..." if len(chunk["text"]) > 200 else chunk["text"]
-        data.append({
-            "x": projections[i, 0],
-            "y": projections[i, 1],
-            "z": projections[i, 2],
-            "Title": chunk["title"],
-            "Category": category,
-            "Snippet": text_snippet,
-            "DocID": chunk["doc_id"]
-        })
-
-    df = pd.DataFrame(data)
-
-    dimension = vectors.shape[1]
-    num_chunks = len(chunks)
+    titles = [chunks.value(int(i), "title") for i in rows]
+    texts = [chunks.value(int(i), "text") for i in rows]
+    row_doc_ids = [doc_ids[code] for code in np.asarray(doc_codes)[rows]]
+    df = pd.DataFrame({
+        "x": projections[:, 0],
+        "y": projections[:, 1],
+        "z": projections[:, 2],
+        "Title": titles,
+        "Category": [extract_category(d) for d in row_doc_ids],
+        "Snippet": [t[:SNIPPET_CHARS] + "..." if len(t) > SNIPPET_CHARS else t for t in texts],
+        "DocID": row_doc_ids,
+    })
+
+    dimension = source.dimension
     contextual = embed_manifest.get("contextual", True)
-    model_name = embed_manifest["model"]
+    sampled_note = f" (plotted {len(rows)})" if len(rows) < num_chunks else ""
 
     subtitle = (
         f"Model: {model_name} | Dims: {dimension} | "
-        f"Chunks: {num_chunks} | Contextual: {'Yes' if contextual else 'No'}"
+        f"Chunks: {num_chunks}{sampled_note} | Contextual: {'Yes' if contextual else 'No'}"
     )
 
     print("Generating interactive 3D plot...")
@@ -101,7 +282,8 @@ def main():
         size_max=10,
         color_discrete_sequence=px.colors.qualitative.Dark24,
     )
-    fig.update_traces(marker=dict(size=4))
+    # Smaller markers keep large (WebGL-rendered) point clouds readable
+    fig.update_traces(marker=dict(size=4 if len(rows) <= 10000 else 2))
 
     # Fixed camera so initial view is same across all visualizations
     fig.update_layout(
@@ -124,6 +306,8 @@ def main():
         "model": model_name,
         "dimension": dimension,
         "num_chunks": num_chunks,
+        "num_points": int(len(rows)),
+        "projection": projection_mode,
         "contextual": contextual,
         "embed_timestamp": embed_manifest.get("timestamp", "unknown"),
     }